@@ -1,11 +1,100 @@
 # -*- coding: utf-8 -*-
 
 import numpy as np
-from gamestate import GameState
-from local_db import DB
+from gamestate import GameState, ONGOING, DRAW, outcome_message
+from local_db import DB, update_from_games, game_keys
 import array_comparison as ac
 from abc import ABC, abstractmethod
 from typing import Iterable
+from collections import OrderedDict
+
+
+class SuccessorCache:
+    """Cache of the (move, gamestate) pairs that follow a gamestate. Moves
+    are (row, col) tuples.
+
+    Entries are keyed by the board and the ternary code of the gamestate
+    rather than its canonical key so that cached gamestates keep the
+    orientation of the previous gamestate. Without maxsize the cache holds
+    every gamestate it has seen, which is 5478 gamestates for 3X3. With
+    maxsize the least recently used gamestates are evicted, which bounds
+    the memory used on larger boards.
+
+    Cached gamestates are shared between callers and must not be modified."""
+    def __init__(self, maxsize=None):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._successors = OrderedDict()
+
+    def get(self, previous_gamestate, only_unique=False):
+        """Returns a tuple of (move, gamestate) pairs that follow from
+        given previous gamestate."""
+        successors = self._lookup(previous_gamestate, only_unique)
+        if successors is not None:
+            self.hits += 1
+            return successors
+
+        self.misses += 1
+        if only_unique:
+            # The successors with duplicates are reused without counting
+            # a second lookup.
+            all_successors = self._lookup(previous_gamestate, False)
+            if all_successors is None:
+                all_successors = self._add(
+                    previous_gamestate, False,
+                    self._successors_of(previous_gamestate))
+            keys = set()
+            successors = []
+            for move, gs in all_successors:
+                if gs.canonical_key not in keys:
+                    keys.add(gs.canonical_key)
+                    successors.append((move, gs))
+            successors = tuple(successors)
+        else:
+            successors = self._successors_of(previous_gamestate)
+        return self._add(previous_gamestate, only_unique, successors)
+
+    def _lookup(self, previous_gamestate, only_unique):
+        key = (previous_gamestate.board, previous_gamestate.code, only_unique)
+        successors = self._successors.get(key)
+        if successors is not None and self.maxsize is not None:
+            self._successors.move_to_end(key)
+        return successors
+
+    def _add(self, previous_gamestate, only_unique, successors):
+        key = (previous_gamestate.board, previous_gamestate.code, only_unique)
+        self._successors[key] = successors
+        if self.maxsize is not None and len(self._successors) > self.maxsize:
+            self._successors.popitem(last=False)
+        return successors
+
+    def _successors_of(self, previous_gamestate):
+        return tuple(
+            (move, previous_gamestate.apply_move(*move))
+            for move in (divmod(cell, previous_gamestate.size)
+                         for cell in previous_gamestate.empty_cells()))
+
+    def clear(self):
+        self._successors.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def cache_info(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "size": len(self._successors),
+            "maxsize": self.maxsize
+        }
+
+
+# Cache used by get_possible_states. It holds every 3X3 gamestate with
+# and without duplicate successors, larger boards evict the least recently
+# used gamestates.
+successor_cache = SuccessorCache(maxsize=16384)
 
 
 def get_possible_states(previous_gamestate: GameState, 
@@ -15,31 +104,25 @@ def get_possible_states(previous_gamestate: GameState,
     
     If only unique is set to True, only unique game states are
     yielded."""
-    next_to_move = previous_gamestate.next_to_move()
-    indexes = np.nonzero(previous_gamestate.state == "-")
-    
-    def move_generator():
-        for i in range(len(indexes[0])):
-            ndarr = np.copy(previous_gamestate.state)
-            ndarr[indexes[0][i], indexes[1][i]] = next_to_move
-            yield GameState(ndarr)
-
-    if not only_unique:
-        for gs in move_generator():
-            yield gs
-
-    else:
-        gamestates = set()
-        for gs in move_generator():
-            if gs not in gamestates:
-                gamestates.add(gs)
-                yield gs
+    for move, gs in successor_cache.get(previous_gamestate, only_unique):
+        yield gs
 
 
 class AI(ABC):
     """Base abstract class for all AIs. They should implement a method for
     deriving next gamestate from previous one as well as a method for updating
-    the AI that is called when a game is finished."""
+    the AI that is called when a game is finished.
+
+    AIs draw random numbers from their own generator, which can be seeded
+    for reproducible games."""
+    def __init__(self, seed=None):
+        self.rng = np.random.default_rng(seed)
+
+    def seed(self, seed):
+        """Reseeds the random number generator of the AI. Seed can be
+        anything accepted by np.random.default_rng."""
+        self.rng = np.random.default_rng(seed)
+
     @abstractmethod
     def get_next_gamestate(self, previous_gamestate):
         pass
@@ -51,58 +134,299 @@ class AI(ABC):
 
 class WeightedGameStateAI(AI):
     """Machine learning AI that uses weights to select game states."""
-    def __init__(self, update_database=True):
-        self.db = DB()
+    def __init__(self, update_database=True, db=None, seed=None,
+                 learning=None):
+        """Db is any database with the interface of local_db.DB, a new DB
+        for 3X3 boards is created by default. Other board sizes need a
+        database created for them.
+
+        Learning is a learning rule such as learning.TDLambda. By default
+        the weights are running averages of the outcomes of the games
+        where their states were played."""
+        super().__init__(seed)
+        self.db = db if db is not None else DB()
         self.update_database = update_database
+        self.learning = learning
 
     def get_next_gamestate(self, previous_gamestate):
         """Returns next game state based on the previous state."""
         # Check if game has ended either in victory or draw
-        ended, message = previous_gamestate.is_game_over()
-        if ended:
+        outcome = previous_gamestate.outcome()
+        if outcome != ONGOING:
             return {
-                "outcome": message
+                "outcome": outcome_message(outcome)
             }
 
-        # Check if possible states are in the database and randomize
-        # the weight a bit.
-        def move_randomizer():
-            for gs in get_possible_states(previous_gamestate):
-                weight = self.db.get_weight(gs)
-                randomized_weight = np.random.normal(loc=1.0, scale=0.1) * weight.weight
-                yield {
-                    "state": gs,
-                    "randomized_weight": randomized_weight
-                }
+        # Look up the weights of all possible states at once and
+        # randomize them a bit.
+        cells, keys = previous_gamestate.successor_keys()
+        randomized_weights = self.rng.normal(
+            loc=1.0, scale=0.1, size=len(keys)) * self.db.get_weights(keys)
 
         # 'X' player tries to find the state with maximum weight while
         # 'O' player goes for the state with lowest weight.
         if previous_gamestate.next_to_move() == "X":
-            next_move = max(
-                move_randomizer(), key=lambda x: x["randomized_weight"])
+            cell = cells[np.argmax(randomized_weights)]
         else:
-            next_move = min(
-                move_randomizer(), key=lambda x: x["randomized_weight"])
+            cell = cells[np.argmin(randomized_weights)]
+        selected_state = previous_gamestate.apply_move(
+            *divmod(cell, previous_gamestate.size))
 
         # If it's the first turn, randomly rotate the state
-        selected_state = next_move["state"]
         if previous_gamestate.rounds_played == 0:
-            selected_state.rotate(np.random.randint(0, high=3))
+            selected_state = selected_state.rotated(
+                self.rng.integers(0, high=3))
 
         return selected_state
 
+    def get_next_gamestates(self, previous_gamestates):
+        """Returns the next game state for each of the previous states,
+        selected like get_next_gamestate does. The weights of all possible
+        states are looked up with one get_weights call and randomized with
+        one draw from the random number generator. All gamestates must be
+        on the same board."""
+        if len(set(gs.board for gs in previous_gamestates)) > 1:
+            raise ValueError("Gamestates of a batch must be on one board.")
+        results = [None] * len(previous_gamestates)
+        ongoing = []
+        for i, gs in enumerate(previous_gamestates):
+            outcome = gs.outcome()
+            if outcome != ONGOING:
+                results[i] = {
+                    "outcome": outcome_message(outcome)
+                }
+            else:
+                ongoing.append(i)
+        if not ongoing:
+            return results
+
+        # Find the empty cells and the canonical keys of the states that
+        # follow from them for all gamestates at once, in the same order
+        # as successor_keys returns them.
+        gamestates = [previous_gamestates[i] for i in ongoing]
+        board = gamestates[0].board
+        if board.has_tables:
+            codes = np.array([gs.code for gs in gamestates], dtype=np.int64)
+            empty = codes[:, np.newaxis] // board.power_array % 3 == 0
+            marks = np.array(
+                [1 + gs.rounds_played % 2 for gs in gamestates])
+            rows, cells = np.nonzero(empty)
+            keys = board.canonical_codes[
+                codes[rows] + marks[rows] * board.power_array[cells]]
+        else:
+            successors = [gs.successor_keys() for gs in gamestates]
+            lengths = [len(cells) for cells, keys in successors]
+            rows = np.repeat(np.arange(len(gamestates)), lengths)
+            cells = np.concatenate([cells for cells, keys in successors])
+            keys = np.concatenate([keys for cells, keys in successors])
+        randomized_weights = self.rng.normal(
+            loc=1.0, scale=0.1, size=len(keys)) * self.db.get_weights(keys)
+
+        # Weights are negated for 'O' so that argmax finds the selected
+        # state of both players.
+        signs = np.array([
+            1.0 if gs.rounds_played % 2 == 0 else -1.0 for gs in gamestates])
+        scores = np.full((len(gamestates), board.cell_count), -np.inf)
+        scores[rows, cells] = signs[rows] * randomized_weights
+        selected = np.argmax(scores, axis=1).tolist()
+
+        for i, cell in zip(ongoing, selected):
+            gs = previous_gamestates[i]
+            selected_state = gs.apply_move(*divmod(cell, gs.size))
+            if gs.rounds_played == 0:
+                selected_state = selected_state.rotated(
+                    self.rng.integers(0, high=3))
+            results[i] = selected_state
+        return results
+
     def update_db(self, gamestates):
         if self.update_database:
-            is_game_over, message = gamestates[-1].is_game_over()
+            outcome = gamestates[-1].outcome()
+            keys = [gamestate.canonical_key for gamestate in gamestates]
+            self.db.games_trained += 1
+            if self.learning is not None:
+                self.learning.update(
+                    self.db, np.array([keys]),
+                    np.ones((1, len(keys)), dtype=bool), [outcome])
+            else:
+                self.db.update_many(keys, outcome)
 
-            for gamestate in gamestates:
-                self.db.add_or_update(gamestate, message)
+    def update_db_many(self, moves, outcomes):
+        """Updates the database with a batch of games as if update_db was
+        called for each of them. Moves is an (N, L) array of cell indexes
+        padded with -1 and outcomes holds the outcome code of each game."""
+        if not self.update_database:
+            return
+        if self.learning is not None:
+            keys, valid = game_keys(self.db.board, moves)
+            self.learning.update(self.db, keys, valid, outcomes)
+            self.db.games_trained += len(outcomes)
+        else:
+            update_from_games(self.db, moves, outcomes)
 
 
 class RandomAI(AI):
     def get_next_gamestate(self, previous_gamestate):
-        return np.random.choice(
-            list(get_possible_states(previous_gamestate)), size=1)[0]
+        gamestates = tuple(get_possible_states(previous_gamestate))
+        return gamestates[self.rng.integers(len(gamestates))]
+
+    def update_db(self, gamestates):
+        pass
+
+
+# Game values and search bounds shared by all SolverAIs of a board. Keyed
+# by the Board, the values map canonical keys to exact values and the
+# bounds map canonical keys to (lower, upper) bounds from cut off searches.
+_solver_tables = {}
+
+
+class SolverAI(AI):
+    """Perfect player that searches the game tree with alpha-beta negamax.
+
+    Values are from the point of view of the player next to move: a win
+    is worth one more than the number of empty cells left after it, a
+    draw is worth 0 and a loss is negative, so faster wins are preferred.
+    Searched gamestates are stored in a transposition table keyed by
+    canonical key and shared by all SolverAIs playing on the same board.
+
+    Call precompute to solve every reachable gamestate up front, which
+    takes well under a second for 3X3."""
+    def __init__(self, seed=None):
+        super().__init__(seed)
+
+    def _tables(self, board):
+        if board not in _solver_tables:
+            _solver_tables[board] = ({}, {})
+        return _solver_tables[board]
+
+    def get_next_gamestate(self, previous_gamestate):
+        """Returns a gamestate reached by an optimal move. Ties between
+        equally good moves are broken randomly."""
+        outcome = previous_gamestate.outcome()
+        if outcome != ONGOING:
+            return {
+                "outcome": outcome_message(outcome)
+            }
+
+        cells = self.optimal_moves(previous_gamestate)
+        cell = cells[self.rng.integers(len(cells))]
+        return previous_gamestate.apply_move(
+            *divmod(cell, previous_gamestate.size))
 
     def update_db(self, gamestates):
         pass
+
+    def value(self, gamestate):
+        """Returns the exact value of the gamestate for the player next to
+        move."""
+        limit = gamestate.board.cell_count + 1
+        return self._negamax(gamestate, -limit, limit)
+
+    def game_value(self, gamestate):
+        """Returns 1 if the player next to move wins with perfect play,
+        0 for a draw and -1 for a loss."""
+        return int(np.sign(self.value(gamestate)))
+
+    def optimal_moves(self, gamestate):
+        """Returns the empty cells whose moves keep the value of the
+        gamestate."""
+        size = gamestate.size
+        scores = [
+            (-self.value(gamestate.apply_move(*divmod(cell, size))), cell)
+            for cell in gamestate.empty_cells()
+        ]
+        best = max(score for score, cell in scores)
+        return [cell for score, cell in scores if score == best]
+
+    def precompute(self, gamestate=None):
+        """Solves every ongoing gamestate reachable from the given one, the
+        empty 3X3 board by default. Returns the number of solved
+        gamestates."""
+        if gamestate is None:
+            gamestate = GameState()
+        values, bounds = self._tables(gamestate.board)
+        solved = set()
+
+        def solve(gs):
+            outcome = gs.outcome()
+            if outcome != ONGOING:
+                return _terminal_value(gs, outcome)
+            key = gs.canonical_key
+            if key not in solved:
+                solved.add(key)
+                values[key] = max(
+                    -solve(gs.apply_move(*divmod(cell, gs.size)))
+                    for cell in gs.empty_cells())
+                bounds.pop(key, None)
+            return values[key]
+
+        solve(gamestate)
+        return len(solved)
+
+    def accuracy(self, ai, gamestates=None):
+        """Returns the share of gamestates where ai makes an optimal move.
+        By default every reachable ongoing 3X3 gamestate is checked."""
+        if gamestates is None:
+            self.precompute()
+            values, bounds = self._tables(GameState().board)
+            gamestates = [GameState.from_code(key) for key in values]
+
+        optimal = 0
+        for gs in gamestates:
+            next_gamestate = gs.advance_to(ai.get_next_gamestate(gs))
+            if gs.get_move(next_gamestate) in self.optimal_moves(gs):
+                optimal += 1
+        return optimal / len(gamestates)
+
+    def _negamax(self, gs, alpha, beta):
+        outcome = gs.outcome()
+        if outcome != ONGOING:
+            return _terminal_value(gs, outcome)
+
+        values, bounds = self._tables(gs.board)
+        key = gs.canonical_key
+        if key in values:
+            return values[key]
+        lower, upper = bounds.get(key, (None, None))
+        if lower is not None:
+            if lower >= beta:
+                return lower
+            if upper <= alpha:
+                return upper
+            alpha = max(alpha, lower)
+            beta = min(beta, upper)
+
+        original_alpha = alpha
+        best = None
+        size = gs.size
+        for cell in gs.empty_cells():
+            value = -self._negamax(
+                gs.apply_move(*divmod(cell, size)), -beta, -alpha)
+            if best is None or value > best:
+                best = value
+            if best > alpha:
+                alpha = best
+            if alpha >= beta:
+                break
+
+        limit = gs.board.cell_count + 1
+        lower, upper = bounds.get(key, (-limit, limit))
+        if best <= original_alpha:
+            upper = min(upper, best)
+        elif best >= beta:
+            lower = max(lower, best)
+        else:
+            lower = upper = best
+        if lower == upper:
+            values[key] = lower
+            bounds.pop(key, None)
+        else:
+            bounds[key] = (lower, upper)
+        return best
+
+
+def _terminal_value(gamestate, outcome):
+    # The player next to move has lost if the game was won.
+    if outcome == DRAW:
+        return 0
+    return -(1 + gamestate.board.cell_count - gamestate.rounds_played)
@@ -1,6 +1,11 @@
 # -*- coding: utf-8 -*-
 
 import numpy as np
+from functools import lru_cache
+
+
+# Largest number of cells whose ternary code fits into a signed 64 bit int.
+_max_ternary_cells = 39
 
 
 def are_sqr_arrays_equal(array1, array2):
@@ -45,3 +50,66 @@ def rotate(arr, turns=1):
 def reflect(arr):
     # Mirrors the array
     return np.fliplr(arr)
+
+
+@lru_cache(maxsize=None)
+def symmetry_permutations(size):
+    """Returns an (8, size * size) array of cell permutations, one for each
+    array yielded by generate_equal_arrays and in the same order.
+
+    Indexing a flattened board with permutations[t] gives the flattened
+    board of the t:th transformation."""
+    cells = np.arange(size * size).reshape((size, size))
+    permutations = np.array(
+        [a.ravel() for a in generate_equal_arrays(cells)])
+    permutations.flags.writeable = False
+    return permutations
+
+
+def ternary_codes(boards):
+    """Returns the base 3 integer code of each flattened board whose cells
+    are 0 (empty), 1 (X) or 2 (O). Cell i is the i:th ternary digit."""
+    boards = np.asarray(boards)
+    cell_count = boards.shape[-1]
+    if cell_count > _max_ternary_cells:
+        raise ValueError(
+            "Boards with more than {0} cells do not fit in 64 bit codes.".format(
+                _max_ternary_cells))
+    powers = 3 ** np.arange(cell_count, dtype=np.int64)
+    return boards.astype(np.int64) @ powers
+
+
+def canonicalize(boards):
+    """Maps each board to its canonical symmetry representative.
+
+    Boards are given as an (N, size, size) or (N, size * size) array of
+    0 (empty), 1 (X) and 2 (O) cells. Returns a tuple of two arrays: the
+    smallest ternary code among the eight symmetric boards and the index of
+    the transformation in symmetry_permutations that produces it."""
+    boards = np.asarray(boards)
+    if boards.ndim == 3:
+        boards = boards.reshape((boards.shape[0], -1))
+    if boards.ndim != 2:
+        raise ValueError("Boards must be a two or three dimensional array.")
+
+    size = int(round(boards.shape[1] ** 0.5))
+    if size * size != boards.shape[1]:
+        raise ValueError("Boards must be square arrays.")
+
+    codes = ternary_codes(boards[:, symmetry_permutations(size)])
+    transforms = np.argmin(codes, axis=1)
+    return codes[np.arange(len(codes)), transforms], transforms
+
+
+@lru_cache(maxsize=None)
+def canonical_table(size):
+    """Returns canonical codes and transformation indexes for every
+    possible ternary code of a size X size board, so that canonicalizing a
+    single board is a lookup. Only feasible for small boards."""
+    cell_count = size * size
+    codes = np.arange(3 ** cell_count, dtype=np.int64)
+    boards = (codes[:, np.newaxis] // 3 ** np.arange(cell_count)) % 3
+    canonical_codes, transforms = canonicalize(boards)
+    canonical_codes.flags.writeable = False
+    transforms.flags.writeable = False
+    return canonical_codes, transforms
@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+
+"""Benchmarks for the hot paths of the game engine.
+
+Run with python benchmarks.py --output results.json and compare two runs
+with python benchmarks.py --compare old.json new.json. Run with
+--convergence to count the self-play games the learning rules need to
+draw against a perfect player instead."""
+
+import argparse
+import contextlib
+import io
+import json
+import platform
+import sys
+import time
+import timeit
+
+import numpy as np
+from gamestate import GameState, DRAW
+from learning import TDLambda
+from local_db import DB, ArrayDB, DenseDB
+from player import Player
+from tictactoe import TicTacToe
+import AI
+
+
+# Registered benchmarks as (name, kind, setup) tuples. Setup functions
+# return a function to time and the number of operations it performs.
+_benchmarks = []
+
+
+def benchmark(name, kind="micro"):
+    def register(setup):
+        _benchmarks.append((name, kind, setup))
+        return setup
+    return register
+
+
+_midgame = [
+    ["X", "O", "-"],
+    ["-", "X", "-"],
+    ["-", "-", "O"]
+]
+
+
+def _game_histories(count, seed=0):
+    # Returns gamestate histories of games between two random AIs.
+    game = TicTacToe()
+    x_player = Player("x", AI.RandomAI(seed=seed))
+    o_player = Player("o", AI.RandomAI(seed=seed + 1))
+    return [game._play_game(x_player, o_player)[1] for i in range(count)]
+
+
+def _all_gamestates(histories):
+    return [gs for history in histories for gs in history]
+
+
+@benchmark("gamestate_from_array")
+def _bench_gamestate_from_array():
+    return lambda: GameState(_midgame), 1
+
+
+@benchmark("gamestate_apply_move")
+def _bench_gamestate_apply_move():
+    gs = GameState(_midgame)
+    return lambda: gs.apply_move(1, 0), 1
+
+
+@benchmark("gamestate_hash")
+def _bench_gamestate_hash():
+    gamestates = _all_gamestates(_game_histories(20))
+    return lambda: [hash(gs) for gs in gamestates], len(gamestates)
+
+
+@benchmark("is_game_over")
+def _bench_is_game_over():
+    gamestates = _all_gamestates(_game_histories(20))
+    return lambda: [gs.is_game_over() for gs in gamestates], len(gamestates)
+
+
+@benchmark("get_possible_states")
+def _bench_get_possible_states():
+    gamestates = _all_gamestates(_game_histories(20))
+
+    def run():
+        for gs in gamestates:
+            for successor in AI.get_possible_states(gs):
+                pass
+    return run, len(gamestates)
+
+
+@benchmark("get_possible_states_cold")
+def _bench_get_possible_states_cold():
+    gamestates = _all_gamestates(_game_histories(20))
+
+    def run():
+        AI.successor_cache.clear()
+        for gs in gamestates:
+            for successor in AI.get_possible_states(gs):
+                pass
+    return run, len(gamestates)
+
+
+def _trained_db(db):
+    for history in _game_histories(200):
+        db.update_many(
+            [gs.canonical_key for gs in history], history[-1].outcome())
+    return db
+
+
+@benchmark("db_get_weight")
+def _bench_db_get_weight():
+    db = _trained_db(DB())
+    gamestates = _all_gamestates(_game_histories(20, seed=100))
+    return lambda: [db.get_weight(gs) for gs in gamestates], len(gamestates)
+
+
+@benchmark("db_add_or_update")
+def _bench_db_add_or_update():
+    db = _trained_db(DB())
+    gamestates = _all_gamestates(_game_histories(20, seed=100))
+    return (lambda: [db.add_or_update(gs, "Draw.") for gs in gamestates],
+            len(gamestates))
+
+
+@benchmark("array_db_get_weight")
+def _bench_array_db_get_weight():
+    db = _trained_db(ArrayDB())
+    gamestates = _all_gamestates(_game_histories(20, seed=100))
+    return lambda: [db.get_weight(gs) for gs in gamestates], len(gamestates)
+
+
+@benchmark("array_db_get_weights")
+def _bench_array_db_get_weights():
+    db = _trained_db(ArrayDB())
+    keys = np.array([
+        gs.canonical_key
+        for gs in _all_gamestates(_game_histories(20, seed=100))])
+    return lambda: db.get_weights(keys), len(keys)
+
+
+@benchmark("dense_db_get_weights")
+def _bench_dense_db_get_weights():
+    db = _trained_db(DenseDB())
+    keys = np.array([
+        gs.canonical_key
+        for gs in _all_gamestates(_game_histories(20, seed=100))])
+    return lambda: db.get_weights(keys), len(keys)
+
+
+@benchmark("array_db_update_many")
+def _bench_array_db_update_many():
+    db = _trained_db(ArrayDB())
+    keys = np.array([
+        gs.canonical_key
+        for gs in _all_gamestates(_game_histories(20, seed=100))])
+    return lambda: db.update_many(keys, "Draw."), len(keys)
+
+
+@benchmark("weighted_ai_get_next_gamestate")
+def _bench_weighted_ai_get_next_gamestate():
+    ai = AI.WeightedGameStateAI(db=_trained_db(ArrayDB()), seed=0)
+    gamestates = [
+        gs for gs in _all_gamestates(_game_histories(20, seed=100))
+        if not gs.is_game_over()[0]]
+    return (lambda: [ai.get_next_gamestate(gs) for gs in gamestates],
+            len(gamestates))
+
+
+@benchmark("weighted_ai_get_next_gamestates")
+def _bench_weighted_ai_get_next_gamestates():
+    ai = AI.WeightedGameStateAI(db=_trained_db(ArrayDB()), seed=0)
+    gamestates = [
+        gs for gs in _all_gamestates(_game_histories(20, seed=100))
+        if not gs.is_game_over()[0]]
+    return lambda: ai.get_next_gamestates(gamestates), len(gamestates)
+
+
+@benchmark("play_game_random", kind="macro")
+def _bench_play_game_random():
+    game = TicTacToe()
+    x_player = Player("x", AI.RandomAI(seed=0))
+    o_player = Player("o", AI.RandomAI(seed=1))
+    return lambda: game.play_game(x_player, o_player), 1
+
+
+@benchmark("play_game_weighted", kind="macro")
+def _bench_play_game_weighted():
+    game = TicTacToe()
+    x_player = Player("x", AI.WeightedGameStateAI(seed=0))
+    o_player = Player("o", AI.RandomAI(seed=1))
+    return lambda: game.play_game(x_player, o_player), 1
+
+
+@benchmark("tournament", kind="macro")
+def _bench_tournament():
+    game = TicTacToe()
+    players = [
+        Player("player1", AI.WeightedGameStateAI(seed=0)),
+        Player("player2", AI.WeightedGameStateAI(seed=1)),
+        Player("player3", AI.RandomAI(seed=2))
+    ]
+    rounds = 20
+
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            game.play_tournament(rounds, players, seed=0)
+    return run, rounds * 6
+
+
+def run_benchmarks(names=None, repeat=5, min_time=0.2):
+    """Runs the benchmarks and returns a dictionary of their results.
+    Times are the best of repeat runs, each lasting at least min_time
+    seconds."""
+    results = {}
+    for name, kind, setup in _benchmarks:
+        if names and name not in names:
+            continue
+        function, operations = setup()
+        timer = timeit.Timer(function)
+        number = 1
+        while timer.timeit(number) < min_time:
+            number *= 2
+        best = min(timer.repeat(repeat=repeat, number=number)) / number
+        results[name] = {
+            "kind": kind,
+            "seconds_per_call": best,
+            "operations_per_call": operations,
+            "operations_per_second": operations / best
+        }
+    return {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "benchmarks": results
+    }
+
+
+def convergence(learning=None, target_draw_rate=0.95, batch_size=200,
+                max_games=40000, evaluation_games=100, seed=0):
+    """Trains a WeightedGameStateAI with given learning rule by self-play
+    until it draws target_draw_rate of its games against SolverAI, playing
+    evaluation_games on each side without learning after every batch.
+    Returns the number of games trained, None if the target was not
+    reached in max_games, and the last draw rate."""
+    import selfplay
+    ai = AI.WeightedGameStateAI(db=ArrayDB(), seed=seed, learning=learning)
+    trained = Player("trained", ai)
+    solver = Player("solver", AI.SolverAI(seed=seed))
+    game = TicTacToe()
+    rng = np.random.default_rng(seed)
+    games = 0
+    draw_rate = 0.0
+    while games < max_games:
+        selfplay.train(ai, batch_size, batch_size, rng=rng)
+        games += batch_size
+        ai.update_database = False
+        draws = 0
+        for i in range(evaluation_games):
+            draws += game._play_game(trained, solver)[0] == DRAW
+            draws += game._play_game(solver, trained)[0] == DRAW
+        ai.update_database = True
+        draw_rate = draws / (2 * evaluation_games)
+        if draw_rate >= target_draw_rate:
+            return games, draw_rate
+    return None, draw_rate
+
+
+def compare(old_results, new_results, threshold=0.1):
+    """Returns rows of (name, old ops/s, new ops/s, speedup, regressed)
+    for benchmarks found in both results. A benchmark has regressed if its
+    throughput fell by more than threshold."""
+    rows = []
+    for name, new in new_results["benchmarks"].items():
+        old = old_results["benchmarks"].get(name)
+        if old is None:
+            continue
+        speedup = new["operations_per_second"] / old["operations_per_second"]
+        rows.append((
+            name, old["operations_per_second"], new["operations_per_second"],
+            speedup, speedup < 1 - threshold))
+    return rows
+
+
+def _print_results(results):
+    for name, result in results["benchmarks"].items():
+        print("{0:<34} {1:>14.1f} ops/s".format(
+            name, result["operations_per_second"]))
+
+
+def _print_comparison(rows):
+    for name, old, new, speedup, regressed in rows:
+        print("{0:<34} {1:>14.1f} {2:>14.1f} {3:>7.2f}x{4}".format(
+            name, old, new, speedup, "  REGRESSION" if regressed else ""))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--output", help="file to write the results to")
+    parser.add_argument("--only", nargs="*", help="benchmarks to run")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--min-time", type=float, default=0.2)
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"),
+                        help="compare two result files instead of running")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="relative slowdown reported as a regression")
+    parser.add_argument("--convergence", action="store_true",
+                        help="compare the games the learning rules need "
+                             "to draw against a perfect player")
+    parser.add_argument("--seeds", type=int, default=3,
+                        help="training runs of each rule with --convergence")
+    args = parser.parse_args()
+
+    if args.convergence:
+        rules = [("running_average", lambda: None),
+                 ("td_lambda", lambda: TDLambda())]
+        for name, rule in rules:
+            runs = [convergence(rule(), seed=seed)
+                    for seed in range(args.seeds)]
+            print("{0:<34} {1}".format(name, " ".join(
+                "{0}".format(games) if games is not None else ">max"
+                for games, draw_rate in runs)))
+        sys.exit(0)
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            old_results = json.load(f)
+        with open(args.compare[1]) as f:
+            new_results = json.load(f)
+        rows = compare(old_results, new_results, args.threshold)
+        _print_comparison(rows)
+        sys.exit(1 if any(row[4] for row in rows) else 0)
+
+    results = run_benchmarks(args.only, args.repeat, args.min_time)
+    _print_results(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
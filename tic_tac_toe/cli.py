@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+
+"""Command-line interface for training, evaluating and playing.
+
+    python cli.py train --games 100000 --db weights.db
+    python cli.py evaluate --db weights.db --opponent random --games 1000
+    python cli.py tournament --players trained=weighted:weights.db random
+    python cli.py play --db weights.db --side O
+
+Every command except play prints a JSON summary of its results as the
+last line of stdout, progress goes to stderr. Databases ending with
+.sqlite are SQLiteDBs, other paths are files of local_db.save_db.
+
+Modules are imported by the commands that need them, so that starting
+the CLI does not load NumPy or the engine."""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+
+_sqlite_extensions = (".sqlite", ".sqlite3")
+
+
+def main(argv=None):
+    parser = _parser()
+    args = parser.parse_args(argv)
+    start = time.perf_counter()
+    summary = args.command(args)
+    if summary is not None:
+        summary = dict(command=args.command_name, **summary)
+        summary["elapsed_seconds"] = round(time.perf_counter() - start, 6)
+        print(json.dumps(summary))
+    return 0
+
+
+def _parser():
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(
+        title="commands", dest="command_name", required=True)
+
+    def add_command(name, command, help):
+        subparser = commands.add_parser(name, help=help, description=help)
+        subparser.set_defaults(command=command)
+        subparser.add_argument("--board-size", type=int, default=3)
+        subparser.add_argument("-k", type=int,
+                               help="marks in a row needed to win")
+        subparser.add_argument("--seed", type=int)
+        return subparser
+
+    train = add_command("train", _train, "train a weighted AI by self-play")
+    train.add_argument("--db", help="database to train and save")
+    train.add_argument("--games", type=int, default=10000)
+    train.add_argument("--batch-size", type=int, default=10000,
+                       help="games played with the same weights")
+    train.add_argument("--learning", default="average",
+                       choices=("average", "td"),
+                       help="running average of the outcomes or "
+                            "TD(lambda)")
+    train.add_argument("--learning-rate", type=float, default=0.4,
+                       help="learning rate of TD(lambda)")
+    train.add_argument("--lam", type=float, default=0.2,
+                       help="lambda of TD(lambda)")
+    train.add_argument("--max-memory", type=float,
+                       help="memory budget in MiB, trains a bounded "
+                            "database that evicts rarely played states")
+    train.add_argument("--eviction", default="lfu", choices=("lfu", "lru"))
+    train.add_argument("--weight-dtype", default="uint8",
+                       choices=("uint8", "float16", "float32"),
+                       help="storage of the weights of a bounded database")
+
+    evaluate = add_command(
+        "evaluate", _evaluate,
+        "play a weighted AI against an opponent without learning")
+    evaluate.add_argument("--db", help="database of the evaluated AI")
+    evaluate.add_argument("--opponent", default="random",
+                          choices=("random", "solver", "weighted"))
+    evaluate.add_argument("--opponent-db",
+                          help="database of a weighted opponent")
+    evaluate.add_argument("--games", type=int, default=1000,
+                          help="games played on each side")
+    evaluate.add_argument("--workers", type=int, default=1)
+    evaluate.add_argument("--accuracy", action="store_true",
+                          help="also measure the share of optimal moves, "
+                               "3X3 only")
+
+    tournament = add_command(
+        "tournament", _tournament, "play a round robin tournament")
+    tournament.add_argument(
+        "--players", nargs="+", required=True,
+        help="players as [name=]kind[:db] where kind is weighted, random "
+             "or solver")
+    tournament.add_argument("--rounds", type=int, default=10)
+    tournament.add_argument("--workers", type=int, default=1)
+    tournament.add_argument("--chunk-size", type=int)
+    tournament.add_argument("--save", action="store_true",
+                            help="save the weighted players' databases")
+    tournament.add_argument("--progress", default="dots",
+                            choices=("dots", "log", "none"))
+
+    play = add_command("play", _play, "play against the AI in the terminal")
+    play.add_argument("--db", help="database of the AI")
+    play.add_argument("--opponent", default="weighted",
+                      choices=("random", "solver", "weighted"))
+    play.add_argument("--side", default="X", choices=("X", "O"))
+    return parser
+
+
+def _train(args):
+    from AI import WeightedGameStateAI
+    import numpy as np
+
+    if args.max_memory is not None:
+        from local_db import BoundedDB
+        if args.db is not None and (os.path.exists(args.db) or
+                                    args.db.endswith(_sqlite_extensions)):
+            raise SystemExit(
+                "Bounded databases are trained from scratch and saved as "
+                "files of local_db.save_db.")
+        db = BoundedDB(board_size=args.board_size, k=args.k,
+                       max_bytes=int(args.max_memory * 2 ** 20),
+                       policy=args.eviction, weight_dtype=args.weight_dtype,
+                       seed=args.seed)
+    else:
+        db = _open_db(args.db, args.board_size, args.k)
+    learning = None
+    if args.learning == "td":
+        from learning import TDLambda
+        learning = TDLambda(args.learning_rate, args.lam)
+    ai = WeightedGameStateAI(db=db, seed=args.seed, learning=learning)
+    if db.board.size == 3 and db.board.k == 3:
+        import selfplay
+        results = selfplay.train(ai, args.games, args.batch_size,
+                                 rng=np.random.default_rng(args.seed))
+    else:
+        from gamestate import outcome_message
+        from player import Player
+        from tictactoe import TicTacToe
+        game = TicTacToe(board_size=db.board.size, k=db.board.k)
+        player = Player("self", ai)
+        results = {"X won!": 0, "O won!": 0, "Draw.": 0}
+        for i in range(args.games):
+            # The AI plays both sides but learns from each game once.
+            outcome, history, moves = game._play_game(player, player)
+            ai.update_db(history)
+            results[outcome_message(outcome)] += 1
+    _save_db(db, args.db)
+    summary = {
+        "games": args.games,
+        "results": results,
+        "games_trained": db.games_trained,
+        "db_size": len(db),
+        "db": args.db
+    }
+    if hasattr(db, "memory_report"):
+        summary["memory"] = db.memory_report()
+    return summary
+
+
+def _evaluate(args):
+    from player import Player
+    from tictactoe import TicTacToe
+    import progress
+
+    evaluated = Player(
+        "evaluated", _create_ai("weighted", args.db, args, learn=False))
+    opponent = Player(
+        "opponent", _create_ai(args.opponent, args.opponent_db, args,
+                               learn=False))
+    game = TicTacToe(board_size=args.board_size, k=args.k)
+    results = game.play_tournament(
+        args.games, [evaluated, opponent], workers=args.workers,
+        seed=args.seed, progress=progress.DotReporter(stream=sys.stderr))
+    summary = {
+        "games": 2 * args.games,
+        "opponent": args.opponent,
+        "results": results["evaluated"],
+        "db": args.db
+    }
+    if args.accuracy and (args.board_size, args.k or 3) == (3, 3):
+        from AI import SolverAI
+        summary["optimal_move_share"] = SolverAI(seed=args.seed).accuracy(
+            evaluated.ai)
+    return summary
+
+
+def _tournament(args):
+    from player import Player
+    from tictactoe import TicTacToe
+    import progress
+
+    players = []
+    paths = {}
+    for index, spec in enumerate(args.players):
+        name, kind, path = _parse_player(spec, index)
+        players.append(Player(name, _create_ai(kind, path, args, learn=True)))
+        if kind == "weighted":
+            paths[name] = path
+    if len(set(p.name for p in players)) != len(players):
+        raise SystemExit("Player names must be unique.")
+
+    if args.progress == "log":
+        import logging
+        logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    reporter = {
+        "dots": progress.DotReporter(stream=sys.stderr),
+        "log": progress.LogReporter(),
+        "none": progress.ProgressReporter()
+    }[args.progress]
+    game = TicTacToe(board_size=args.board_size, k=args.k)
+    results = game.play_tournament(
+        args.rounds, players, workers=args.workers,
+        chunk_size=args.chunk_size, seed=args.seed, progress=reporter)
+    if args.save:
+        for p in players:
+            if paths.get(p.name):
+                _save_db(p.ai.db, paths[p.name])
+    return {
+        "rounds": args.rounds,
+        "players": dict((p.name, paths.get(p.name, None))
+                        for p in players),
+        "results": results
+    }
+
+
+def _play(args):
+    from player import Player
+    from tictactoe import TicTacToe
+
+    human = _TerminalPlayer("you")
+    computer = Player("computer", _create_ai(
+        args.opponent, args.db, args, learn=False))
+    players = (human, computer) if args.side == "X" else (computer, human)
+    game = TicTacToe(print_moves=True, board_size=args.board_size, k=args.k)
+    try:
+        outcome = game.play_game(*players)
+    except (EOFError, KeyboardInterrupt):
+        print()
+        return None
+    print(outcome)
+    return None
+
+
+def _parse_player(spec, index):
+    # Parses [name=]kind[:db] player specifications.
+    name, separator, rest = spec.partition("=")
+    if not separator:
+        name, rest = None, spec
+    kind, separator, path = rest.partition(":")
+    if kind not in ("weighted", "random", "solver"):
+        raise SystemExit("Unknown player kind {0}.".format(kind))
+    return name or "{0}{1}".format(kind, index + 1), kind, path or None
+
+
+def _create_ai(kind, path, args, learn=True):
+    if kind == "random":
+        from AI import RandomAI
+        return RandomAI(seed=args.seed)
+    if kind == "solver":
+        from AI import SolverAI
+        return SolverAI(seed=args.seed)
+    from AI import WeightedGameStateAI
+    return WeightedGameStateAI(
+        update_database=learn,
+        db=_open_db(path, args.board_size, args.k, read_only=not learn),
+        seed=args.seed)
+
+
+def _open_db(path, board_size=3, k=None, read_only=False):
+    # Opens the database at path, or creates a new one if there is none.
+    # Existing databases must be for the board of the arguments.
+    from gamestate import get_board
+    from local_db import ArrayDB, DB, SQLiteDB, load_db
+    if path is not None and path.endswith(_sqlite_extensions):
+        try:
+            return SQLiteDB(path, board_size=board_size, k=k,
+                            read_only=read_only and os.path.exists(path))
+        except ValueError as e:
+            raise SystemExit(str(e))
+    if path is not None and os.path.exists(path):
+        db = load_db(path, mode="r" if read_only else "c")
+        board = get_board(board_size, k)
+        if (db.board.size, db.board.k) != (board.size, board.k):
+            raise SystemExit(
+                "{0} has weights for {1}X{1} boards with k = {2}, not "
+                "{3}X{3} with k = {4}.".format(
+                    path, db.board.size, db.board.k, board.size, board.k))
+        return db
+    if board_size * board_size > 39:
+        return DB(board_size=board_size, k=k)
+    return ArrayDB(board_size=board_size, k=k)
+
+
+def _save_db(db, path):
+    from local_db import SQLiteDB, save_db
+    if isinstance(db, SQLiteDB):
+        db.commit()
+    elif path is not None:
+        save_db(db, path)
+
+
+class _TerminalPlayer:
+    # Human player that types moves as row and column numbers.
+    def __init__(self, name):
+        self.name = name
+        self.ai = None
+
+    def get_next_gamestate(self, previous_gamestate):
+        size = previous_gamestate.size
+        while True:
+            text = input("Your move as row col (0-{0}): ".format(size - 1))
+            try:
+                row, col = (int(value) for value in text.split())
+                if not (0 <= row < size and 0 <= col < size):
+                    raise ValueError("Cell is not on the board.")
+                return previous_gamestate.apply_move(row, col)
+            except ValueError as e:
+                print("Invalid move: {0}".format(e))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 
-"""This module is deprecated."""
+"""This module is deprecated, use remote_db.CloudantStore with
+remote_db.RemoteDB instead."""
 
+import warnings
 from cloudant.client import Cloudant
 from cloudant.error import CloudantException
 from cloudant.result import Result, ResultByKey
@@ -11,6 +13,10 @@ import array_comparison as ac
 import time
 
 
+warnings.warn("cloudant_database is deprecated, use remote_db instead.",
+              DeprecationWarning, stacklevel=2)
+
+
 def get_database(dbname, user_name, password, url):
     client = Cloudant(user_name, password, url=url)
     client.connect()
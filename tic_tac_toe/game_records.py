@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+
+"""Append-only log of played games.
+
+A record file starts with a header of the magic bytes, a uint16 format
+version, the board size and k as uint8s and the number of bytes used for
+each cell index. Every game is then stored as its number of moves, its
+outcome code and its moved cell indexes. Cell indexes and move counts take
+one byte on boards of up to 255 cells and two bytes otherwise, so a 3X3
+game takes at most 11 bytes.
+
+Games can be written from many processes to separate files and replayed
+later into a database in chunks without building gamestates."""
+
+import os
+import struct
+import numpy as np
+from local_db import update_from_games
+
+
+_file_magic = b"TTTREC"
+_file_version = 1
+_file_header = struct.Struct("<6sHBBB")
+
+
+class GameRecordWriter:
+    """Appends games to a record file. The header is written when the file
+    is created, an existing file must be for the same board."""
+    def __init__(self, path, board_size=3, k=None):
+        self.path = path
+        self.board_size = board_size
+        self.k = board_size if k is None else k
+        self._width = _cell_width(board_size)
+        self._dtype = np.dtype(np.uint8 if self._width == 1 else "<u2")
+        self.games_written = 0
+
+        exists = os.path.exists(path) and os.path.getsize(path) > 0
+        if exists:
+            header = read_header(path)
+            if (header["board_size"], header["k"]) != (board_size, self.k):
+                raise ValueError(
+                    "{0} has records for {1}X{1} boards with k = {2}.".format(
+                        path, header["board_size"], header["k"]))
+        self._file = open(path, "ab")
+        if not exists:
+            self._file.write(_file_header.pack(
+                _file_magic, _file_version, board_size, self.k, self._width))
+
+    def write(self, moves, outcome):
+        """Appends a game given as a sequence of moved cell indexes and
+        its outcome code."""
+        record = np.empty(len(moves) + 2, dtype=self._dtype)
+        record[0] = len(moves)
+        record[1] = outcome
+        record[2:] = moves
+        self._file.write(record.tobytes())
+        self.games_written += 1
+
+    def write_many(self, moves, outcomes):
+        """Appends a batch of games given as an (N, L) array of moved cell
+        indexes padded with -1 and an array of outcome codes."""
+        moves = np.asarray(moves)
+        outcomes = np.asarray(outcomes)
+        lengths = np.count_nonzero(moves >= 0, axis=1)
+        records = np.column_stack((lengths, outcomes, moves))
+        keep = np.ones(records.shape, dtype=bool)
+        keep[:, 2:] = moves >= 0
+        self._file.write(records[keep].astype(self._dtype).tobytes())
+        self.games_written += len(outcomes)
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def read_header(path):
+    """Returns the board size, k and cell index width of a record file."""
+    with open(path, "rb") as f:
+        header = f.read(_file_header.size)
+    if len(header) != _file_header.size:
+        raise ValueError("{0} is not a game record file.".format(path))
+    magic, version, board_size, k, width = _file_header.unpack(header)
+    if magic != _file_magic:
+        raise ValueError("{0} is not a game record file.".format(path))
+    if version != _file_version:
+        raise ValueError(
+            "Unsupported game record version {0}.".format(version))
+    return {"board_size": board_size, "k": k, "width": width}
+
+
+def read_records(paths, chunk_size=65536):
+    """Yields the games of one or more record files in chunks of at most
+    chunk_size games. Each chunk is a tuple of an (N, L) array of moved
+    cell indexes padded with -1 and an array of outcome codes."""
+    if isinstance(paths, (str, bytes, os.PathLike)):
+        paths = [paths]
+
+    for path in paths:
+        header = read_header(path)
+        dtype = np.dtype(np.uint8 if header["width"] == 1 else "<u2")
+        # Reading chunk_size full length games is always enough for a
+        # chunk, shorter games leave the rest for the next read.
+        read_size = (chunk_size * (header["board_size"] ** 2 + 2)
+                     * dtype.itemsize)
+        pending = np.zeros(0, dtype=dtype)
+
+        with open(path, "rb") as f:
+            f.seek(_file_header.size)
+            while True:
+                data = f.read(read_size)
+                buffer = np.concatenate(
+                    (pending, np.frombuffer(data, dtype=dtype)))
+                if len(buffer) == 0:
+                    break
+                starts, consumed = _find_records(buffer, chunk_size)
+                if len(starts) == 0:
+                    if not data:
+                        raise ValueError(
+                            "{0} ends with a partial record.".format(path))
+                    pending = buffer
+                    continue
+                yield _decode(buffer, starts)
+                pending = buffer[consumed:]
+
+
+def replay_records(paths, db, chunk_size=65536):
+    """Updates a database with every game in one or more record files, a
+    chunk of games at a time. Returns the number of replayed games."""
+    games = 0
+    for moves, outcomes in read_records(paths, chunk_size):
+        update_from_games(db, moves, outcomes)
+        games += len(outcomes)
+    return games
+
+
+def _cell_width(board_size):
+    return 1 if board_size * board_size <= 255 else 2
+
+
+def _find_records(buffer, limit):
+    # Returns the start offsets of at most limit complete records in the
+    # buffer and the offset after the last of them.
+    values = buffer.tolist()
+    starts = []
+    offset = 0
+    while len(starts) < limit and offset < len(values):
+        end = offset + 2 + values[offset]
+        if end > len(values):
+            break
+        starts.append(offset)
+        offset = end
+    return np.array(starts, dtype=np.int64), offset
+
+
+def _decode(buffer, starts):
+    lengths = buffer[starts].astype(np.int64)
+    outcomes = buffer[starts + 1].astype(np.int8)
+    width = max(int(lengths.max()), 1)
+    columns = np.arange(width)
+    played = columns < lengths[:, np.newaxis]
+    indexes = np.where(played, starts[:, np.newaxis] + 2 + columns, 0)
+    moves = np.where(played, buffer[indexes].astype(np.int16), -1)
+    return moves, outcomes
@@ -2,6 +2,7 @@
 
 import numpy as np
 import array_comparison as ac
+from functools import lru_cache
 
 
 # Initial empty gamestate
@@ -11,97 +12,557 @@ _initial_gamestate = [
     ["-", "-", "-"]
 ]
 
+# Outcome codes
+ONGOING = 0
+X_WON = 1
+O_WON = 2
+DRAW = 3
+
+_outcome_messages = {
+    ONGOING: "Game continues",
+    X_WON: "X won!",
+    O_WON: "O won!",
+    DRAW: "Draw."
+}
+_message_outcomes = dict(
+    (message, outcome) for outcome, message in _outcome_messages.items())
+
+# Boards with at most this many cells get lookup tables indexed by
+# bitboards and ternary codes.
+_max_table_cells = 9
+
+# Largest number of cells whose ternary codes fit into int64 keys.
+_max_key_cells = 39
+
+# Number of non-zero digits in every 9 digit ternary number, used to count
+# the marks of large boards' codes a chunk at a time.
+_chunk_base = 3 ** 9
+_chunk_marks = np.count_nonzero(
+    (np.arange(_chunk_base)[:, np.newaxis] // 3 ** np.arange(9)) % 3,
+    axis=1).tolist()
+
+
+class Board:
+    """Size of an N X N board and the number of marks in a row (k) that
+    wins, along with precomputed tables shared by all gamestates on the
+    board. Use get_board to get the shared instance.
+
+    Boards of at most _max_table_cells cells have lookup tables for cell
+    indexes, ternary codes, canonical keys and outcomes. On larger boards
+    the same values are computed from the set bits."""
+    def __init__(self, size, k):
+        if size < 1:
+            raise ValueError("Board size must be at least 1.")
+        if not 1 <= k <= size:
+            raise ValueError("Line length must be between 1 and board size.")
+
+        self.size = size
+        self.k = k
+        self.cell_count = size * size
+        self.full_mask = (1 << self.cell_count) - 1
+        self.powers = [3 ** i for i in range(self.cell_count)]
+        self.inverse_permutations = np.argsort(
+            ac.symmetry_permutations(size), axis=1).tolist()
+
+        # Cells of every k long line and the lines through each cell.
+        windows = []
+        for dr, dc in ((0, 1), (1, 0), (1, 1), (1, -1)):
+            for r in range(size):
+                for c in range(size):
+                    cells = [(r + i * dr, c + i * dc) for i in range(k)]
+                    if all(0 <= cr < size and 0 <= cc < size
+                           for cr, cc in cells):
+                        windows.append([cr * size + cc for cr, cc in cells])
+        self.window_cells = np.array(windows, dtype=np.int64)
+        self.window_masks = [sum(1 << cell for cell in w) for w in windows]
+        self.windows_through = tuple(
+            tuple(m for m in self.window_masks if m >> cell & 1)
+            for cell in range(self.cell_count))
+
+        self.has_tables = self.cell_count <= _max_table_cells
+        if self.has_tables:
+            self.bit_indexes = tuple(
+                tuple(i for i in range(self.cell_count) if bits >> i & 1)
+                for bits in range(1 << self.cell_count))
+            self.ternary_values = [
+                sum(self.powers[i] for i in cells)
+                for cells in self.bit_indexes]
+            self.power_array = np.array(self.powers, dtype=np.int64)
+            codes = np.arange(3 ** self.cell_count, dtype=np.int64)
+            digits = (codes[:, np.newaxis] // self.power_array) % 3
+            self.canonical_codes = ac.canonical_table(size)[0]
+            self.canonical_code_list = self.canonical_codes.tolist()
+            self.outcome_codes = self.outcomes(digits)
+            self.outcome_code_list = self.outcome_codes.tolist()
+            self.rounds_played_list = np.count_nonzero(
+                digits, axis=1).tolist()
+
+    def __reduce__(self):
+        # Unpickled boards are the shared instances.
+        return get_board, (self.size, self.k)
+
+    def cells_of(self, bits):
+        """Returns a tuple of the indexes of the set bits."""
+        if self.has_tables:
+            return self.bit_indexes[bits]
+        cells = []
+        while bits:
+            low = bits & -bits
+            cells.append(low.bit_length() - 1)
+            bits ^= low
+        return tuple(cells)
+
+    def code_of(self, x_bits, o_bits):
+        """Returns the ternary code of a board."""
+        if self.has_tables:
+            return self.ternary_values[x_bits] + 2 * self.ternary_values[o_bits]
+        powers = self.powers
+        return (sum(powers[i] for i in self.cells_of(x_bits)) +
+                2 * sum(powers[i] for i in self.cells_of(o_bits)))
+
+    def transformed_codes(self, x_bits, o_bits):
+        """Returns the ternary codes of the eight rotations and reflections
+        of a board, in the order of ac.symmetry_permutations."""
+        powers = self.powers
+        x_cells = self.cells_of(x_bits)
+        o_cells = self.cells_of(o_bits)
+        return [
+            sum(powers[inverse[i]] for i in x_cells) +
+            2 * sum(powers[inverse[i]] for i in o_cells)
+            for inverse in self.inverse_permutations]
+
+    def canonical_key_of(self, x_bits, o_bits):
+        """Returns the smallest ternary code among the symmetric boards."""
+        if self.has_tables:
+            return self.canonical_code_list[self.code_of(x_bits, o_bits)]
+        return min(self.transformed_codes(x_bits, o_bits))
+
+    def outcome_of(self, x_bits, o_bits):
+        """Returns the outcome code of a board by checking every line."""
+        if self.has_tables:
+            return self.outcome_code_list[self.code_of(x_bits, o_bits)]
+        for mask in self.window_masks:
+            if x_bits & mask == mask:
+                return X_WON
+        for mask in self.window_masks:
+            if o_bits & mask == mask:
+                return O_WON
+        if x_bits | o_bits == self.full_mask:
+            return DRAW
+        return ONGOING
+
+    def rounds_played_of_key(self, key):
+        """Returns the number of marks on a board with given ternary
+        code."""
+        if self.has_tables:
+            return self.rounds_played_list[key]
+        rounds_played = 0
+        while key:
+            key, chunk = divmod(key, _chunk_base)
+            rounds_played += _chunk_marks[chunk]
+        return rounds_played
+
+    def outcomes(self, boards):
+        """Returns the outcome code of each board in a batch.
+
+        Boards are given as an (N, size, size) or (N, size * size) array of
+        0 (empty), 1 (X) and 2 (O) cells. If both players have a line, X is
+        reported as the winner."""
+        boards = np.asarray(boards)
+        boards = boards.reshape((boards.shape[0], self.cell_count))
+        lines = boards[:, self.window_cells]
+        x_won = np.all(lines == 1, axis=2).any(axis=1)
+        o_won = np.all(lines == 2, axis=2).any(axis=1)
+        full = np.all(boards != 0, axis=1)
+        return np.where(
+            x_won, X_WON, np.where(
+                o_won, O_WON, np.where(full, DRAW, ONGOING))).astype(np.int8)
+
+
+def get_board(size=3, k=None):
+    """Returns the shared Board for size X size boards where k marks in a
+    row win. K defaults to the board size."""
+    return _get_board(size, size if k is None else k)
+
+
+@lru_cache(maxsize=None)
+def _get_board(size, k):
+    return Board(size, k)
+
+
+def outcomes(boards, k=None):
+    """Returns the outcome code of each board in a batch.
+
+    Boards are given as an (N, size, size) or (N, size * size) array of
+    0 (empty), 1 (X) and 2 (O) cells. K is the winning line length and
+    defaults to the board size. If both players have a line, X is reported
+    as the winner."""
+    boards = np.asarray(boards)
+    if boards.ndim == 3:
+        size = boards.shape[1]
+    else:
+        size = int(round(boards.shape[1] ** 0.5))
+    return get_board(size, k).outcomes(boards)
+
+
+def outcome_message(outcome):
+    """Returns the message shown for an outcome code."""
+    return _outcome_messages[outcome]
+
+
+def to_outcome(result):
+    """Converts an outcome message such as 'X won!' to its outcome code.
+    Outcome codes are returned as is."""
+    if isinstance(result, str):
+        return _message_outcomes[result]
+    return result
+
+
+def rounds_played_of(codes, size=3):
+    """Returns the number of marks on each board in an array of ternary
+    codes of size X size boards."""
+    codes = np.asarray(codes, dtype=np.int64)
+    digits = (codes[..., np.newaxis] //
+              3 ** np.arange(size * size, dtype=np.int64)) % 3
+    return np.count_nonzero(digits, axis=-1)
+
+
+# Standard 3X3 board. The batch functions below work on it.
+_standard_board = get_board(3, 3)
+_size = _standard_board.size
+_cell_count = _standard_board.cell_count
+_powers = _standard_board.power_array
+_canonical_codes = _standard_board.canonical_codes
+_outcome_codes = _standard_board.outcome_codes
+_rounds_played_list = _standard_board.rounds_played_list
+
+
+def canonical_keys(codes):
+    """Returns the canonical key of each 3X3 board in an array of ternary
+    codes."""
+    return _canonical_codes[codes]
+
+
+def code_outcomes(codes):
+    """Returns the outcome code of each 3X3 board in an array of ternary
+    codes."""
+    return _outcome_codes[codes]
+
+
+def history_keys(moves):
+    """Returns the canonical keys of every gamestate in a batch of 3X3
+    games.
+
+    Moves is an (N, L) array of cell indexes padded with -1 after the end
+    of each game. Returns an (N, L + 1) array of keys, starting from the
+    empty board, and a boolean array that is True where the gamestate was
+    part of the game."""
+    moves = np.asarray(moves, dtype=np.int64)
+    played = moves >= 0
+    marks = np.where(np.arange(moves.shape[1]) % 2 == 0, 1, 2)
+    steps = np.where(played, marks * 3 ** np.where(played, moves, 0), 0)
+    codes = np.zeros((moves.shape[0], moves.shape[1] + 1), dtype=np.int64)
+    np.cumsum(steps, axis=1, out=codes[:, 1:])
+    valid = np.ones(codes.shape, dtype=bool)
+    valid[:, 1:] = played
+    return canonical_keys(codes), valid
+
+
+def replay(moves, size=3, k=None):
+    """Returns the list of gamestates, starting from the empty board, that
+    results from marking the given cell indexes in order."""
+    gamestates = [GameState.empty(size, k)]
+    for cell in moves:
+        gamestates.append(gamestates[-1].apply_move(*divmod(cell, size)))
+    return gamestates
+
+
+def _bits_of(cells):
+    # Returns a bitboard of the True cells of a flat boolean array.
+    return sum(1 << i for i in np.flatnonzero(cells).tolist())
+
 
 class GameState:
-    def __init__(self, array=_initial_gamestate):
-        self.state = np.array(array)
+    """Tic tac toe board stored as two bitboards, one for X's and one for
+    O's. Bit i of a bitboard corresponds to cell (i // size, i % size).
+
+    Boards are size X size squares where k marks in a row win, the
+    standard game is 3X3 with k = 3. The shared Board of a gamestate holds
+    its size and k.
+
+    Equal gamestates are the ones that are symmetric to each other. They
+    share the same canonical_key.
+
+    The string array representation is only built when the state
+    attribute is accessed."""
+    __slots__ = ("x_bits", "o_bits", "rounds_played", "board", "_state",
+                 "_key", "_outcome")
+
+    def __init__(self, array=_initial_gamestate, k=None):
+        state = np.array(array)
+        if state.ndim != 2 or state.shape[0] != state.shape[1] or state.size == 0:
+            raise ValueError(
+                "Not a valid game state: State is not a square array.")
         try:
-            self.char_counts = self.count_chars()
-        except TypeError as e:
+            self.board = get_board(state.shape[0], k)
+        except ValueError as e:
             raise ValueError("Not a valid game state: " + str(e))
-        self.rounds_played = self.get_rounds_played()
-        self.is_valid, message = self.is_state_valid()
-        if not self.is_valid:
+
+        flat = state.ravel()
+        self.x_bits = _bits_of(flat == "X")
+        self.o_bits = _bits_of(flat == "O")
+        self._state = None
+        self._key = None
+        self._outcome = None
+
+        x_count = len(self.board.cells_of(self.x_bits))
+        o_count = len(self.board.cells_of(self.o_bits))
+        if x_count + o_count + np.count_nonzero(flat == "-") != self.board.cell_count:
+            raise ValueError(
+                "Not a valid game state: Wrong number of characters.")
+        self.rounds_played = x_count + o_count
+
+        is_valid, message = self.is_state_valid()
+        if not is_valid:
             raise ValueError("Not a valid game state: " + message)
 
+    @classmethod
+    def _from_bits(cls, x_bits, o_bits, rounds_played, board=_standard_board,
+                   outcome=None):
+        # Skips parsing and validation, callers must pass a valid board.
+        gamestate = object.__new__(cls)
+        gamestate.x_bits = x_bits
+        gamestate.o_bits = o_bits
+        gamestate.rounds_played = rounds_played
+        gamestate.board = board
+        gamestate._state = None
+        gamestate._key = None
+        gamestate._outcome = outcome
+        return gamestate
+
+    @classmethod
+    def empty(cls, size=3, k=None):
+        """Returns an empty size X size gamestate where k marks in a row
+        win. K defaults to the board size."""
+        board = get_board(size, k)
+        return cls._from_bits(0, 0, 0, board, ONGOING)
+
+    @classmethod
+    def from_code(cls, code, size=3, k=None):
+        """Returns the gamestate that has the given ternary code."""
+        board = get_board(size, k)
+        x_bits = o_bits = 0
+        for i in range(board.cell_count):
+            code, digit = divmod(code, 3)
+            if digit == 1:
+                x_bits |= 1 << i
+            elif digit == 2:
+                o_bits |= 1 << i
+        rounds_played = len(board.cells_of(x_bits)) + len(board.cells_of(o_bits))
+        return cls._from_bits(x_bits, o_bits, rounds_played, board)
+
     def __eq__(self, other_gamestate):
         if not isinstance(other_gamestate, GameState):
             return NotImplemented
 
-        return ac.are_sqr_arrays_equal(self.state, other_gamestate.state)
+        return (self.board is other_gamestate.board and
+                self.canonical_key == other_gamestate.canonical_key)
 
     def __str__(self):
         return str(self.state)
 
     def __hash__(self):
-        arr = [str(a) for a in ac.generate_equal_arrays(self.state)]
-        arr.sort()
-        return hash("".join(arr))
+        return hash(self.canonical_key)
 
-    def is_state_valid(self):
-        if not self.state.shape == (3, 3):
-            return False, "State is not an 3X3 square."
+    @property
+    def size(self):
+        return self.board.size
+
+    @property
+    def k(self):
+        return self.board.k
+
+    @property
+    def code(self):
+        """Ternary code of the board where each cell is a digit that is
+        0 for '-', 1 for 'X' and 2 for 'O'."""
+        return self.board.code_of(self.x_bits, self.o_bits)
+
+    @property
+    def canonical_key(self):
+        """Smallest ternary code among the board and its rotations and
+        reflections. Symmetric gamestates have the same key."""
+        if self._key is None:
+            self._key = self.board.canonical_key_of(self.x_bits, self.o_bits)
+        return self._key
 
-        # Count number of X's, O's and -'s
-        if self.char_counts["X"] + self.char_counts["O"] + self.char_counts["-"] != 9:
+    @property
+    def state(self):
+        """Read-only size X size array of 'X', 'O' and '-' characters."""
+        if self._state is None:
+            board = self.board
+            cells = np.full(board.cell_count, "-")
+            cells[list(board.cells_of(self.x_bits))] = "X"
+            cells[list(board.cells_of(self.o_bits))] = "O"
+            cells = cells.reshape((board.size, board.size))
+            cells.flags.writeable = False
+            self._state = cells
+        return self._state
+
+    @property
+    def char_counts(self):
+        return self.count_chars()
+
+    @property
+    def is_valid(self):
+        return self.is_state_valid()[0]
+
+    def is_state_valid(self):
+        if self.x_bits & self.o_bits:
             return False, "Wrong number of characters."
 
-        if self.char_counts["O"] > self.char_counts["X"]:
+        x_count = len(self.board.cells_of(self.x_bits))
+        o_count = len(self.board.cells_of(self.o_bits))
+        if o_count > x_count:
             return False, "Too many O's"
 
-        if self.char_counts["O"] + 1 < self.char_counts["X"]:
+        if o_count + 1 < x_count:
             return False, "Too may X's"
 
         # TODO check that no two winning lines exist
 
         return True, "State is valid"
 
+    def outcome(self):
+        """Returns ONGOING, X_WON, O_WON or DRAW."""
+        if self._outcome is None:
+            self._outcome = self.board.outcome_of(self.x_bits, self.o_bits)
+        return self._outcome
+
     def is_game_over(self):
-        # Row check
-        for row in self.state:
-            if "-" != row[0] == row[1] == row[2]:
-                return True, "{0} won!".format(row[0])
+        outcome = self.outcome()
+        return outcome != ONGOING, _outcome_messages[outcome]
 
-        # Column check
-        for column in self.state.T:
-            if "-" != column[0] == column[1] == column[2]:
-                return True, "{0} won!".format(column[0])
+    def count_chars(self):
+        x_count = (self.rounds_played + 1) // 2
+        o_count = self.rounds_played // 2
+        return {
+            "X": x_count,
+            "O": o_count,
+            "-": self.board.cell_count - x_count - o_count
+        }
 
-        # Diagonal checks
-        diag = np.diag(self.state)
-        if "-" != diag[0] == diag[1] == diag[2]:
-            return True, "{0} won!".format(diag[0])
+    def get_rounds_played(self):
+        return self.rounds_played
 
-        diag = np.diag(np.rot90(self.state))
-        if "-" != diag[0] == diag[1] == diag[2]:
-            return True, "{0} won!".format(diag[0])
+    def next_to_move(self):
+        return "X" if self.rounds_played % 2 == 0 else "O"
 
-        if self.char_counts["-"] == 0:
-            return True, "Draw."
+    def empty_cells(self):
+        """Returns the indexes of empty cells in row-major order."""
+        board = self.board
+        return board.cells_of(board.full_mask & ~(self.x_bits | self.o_bits))
 
-        return False, "Game continues"
+    def apply_move(self, row, col):
+        """Returns a new gamestate where the player next to move has
+        placed a mark in the given cell.
 
-    def count_chars(self):
-        unique, counts = np.unique(self.state, return_counts=True)
-        counts_dict = dict(zip(unique, counts))
+        If this gamestate is ongoing, the outcome of the new one is found
+        by only checking the lines through the new mark."""
+        board = self.board
+        cell = int(row) * board.size + int(col)
+        bit = 1 << cell
+        if (self.x_bits | self.o_bits) & bit:
+            raise ValueError(
+                "Cell ({0}, {1}) is already taken.".format(row, col))
 
-        if "X" not in counts_dict:
-            counts_dict["X"] = 0
-        if "O" not in counts_dict:
-            counts_dict["O"] = 0
-        if "-" not in counts_dict:
-            counts_dict["-"] = 0
+        if self.rounds_played % 2 == 0:
+            x_bits, o_bits = self.x_bits | bit, self.o_bits
+            mover_bits, win = x_bits, X_WON
+        else:
+            x_bits, o_bits = self.x_bits, self.o_bits | bit
+            mover_bits, win = o_bits, O_WON
+        rounds_played = self.rounds_played + 1
 
-        return counts_dict
+        outcome = None
+        if self.outcome() == ONGOING:
+            outcome = ONGOING
+            for mask in board.windows_through[cell]:
+                if mover_bits & mask == mask:
+                    outcome = win
+                    break
+            else:
+                if rounds_played == board.cell_count:
+                    outcome = DRAW
 
-    def get_rounds_played(self):
-        rounds = self.char_counts["O"] + self.char_counts["X"]
-        if type(rounds) is np.int64:
-            return rounds.item()
-        return rounds
+        return GameState._from_bits(
+            x_bits, o_bits, rounds_played, board, outcome)
 
-    def next_to_move(self):
-        return "X" if self.rounds_played % 2 == 0 else "O"
+    def advance_to(self, next_gamestate):
+        """Returns the gamestate that follows from this one when the player
+        next to move makes the move that leads to next_gamestate. Raises
+        ValueError if next_gamestate does not follow from a single move.
+
+        The returned gamestate knows its outcome from this gamestate and
+        the move, so it is never checked from scratch."""
+        move = self.get_move(next_gamestate)
+        bit = 1 << move if move >= 0 else 0
+        if self.rounds_played % 2 == 0:
+            expected = (self.x_bits | bit, self.o_bits)
+        else:
+            expected = (self.x_bits, self.o_bits | bit)
+        if (not bit or (self.x_bits | self.o_bits) & bit or
+                next_gamestate.board is not self.board or
+                (next_gamestate.x_bits, next_gamestate.o_bits) != expected):
+            raise ValueError("Not a valid move.")
+
+        if next_gamestate._outcome is not None:
+            return next_gamestate
+        return self.apply_move(*divmod(move, self.board.size))
+
+    def successor_keys(self):
+        """Returns an array of the empty cells and an array of the
+        canonical keys of the gamestates that follow from marking them."""
+        board = self.board
+        cells = self.empty_cells()
+        mark = 1 if self.rounds_played % 2 == 0 else 2
+        if board.has_tables:
+            cells = np.array(cells, dtype=np.int64)
+            return cells, board.canonical_codes[
+                self.code + mark * board.power_array[cells]]
+
+        # The code of a successor's transformation is the code of this
+        # board's transformation plus the new mark at its moved cell.
+        codes = board.transformed_codes(self.x_bits, self.o_bits)
+        transforms = list(zip(codes, board.inverse_permutations))
+        powers = board.powers
+        keys = [
+            min(code + mark * powers[inverse[cell]]
+                for code, inverse in transforms)
+            for cell in cells]
+        # Keys of larger boards may not fit into 64 bits.
+        return np.array(cells, dtype=np.int64), np.array(
+            keys, dtype=np.int64 if board.cell_count <= _max_key_cells
+            else object)
+
+    def get_move(self, next_gamestate):
+        """Returns the index of the cell that was marked to get from this
+        gamestate to the next one."""
+        taken = self.x_bits | self.o_bits
+        return ((next_gamestate.x_bits | next_gamestate.o_bits) ^ taken).bit_length() - 1
+
+    def rotated(self, turns):
+        """Returns a copy of the gamestate rotated counterclockwise."""
+        state = ac.rotate(self.state, turns=turns).ravel()
+        return GameState._from_bits(
+            _bits_of(state == "X"), _bits_of(state == "O"),
+            self.rounds_played, self.board, self._outcome)
 
     def rotate(self, turns):
-        self.state = ac.rotate(self.state, turns=turns)
+        """Rotates the gamestate in place. Gamestates returned by
+        get_possible_states are shared and must not be rotated in place,
+        use rotated instead."""
+        state = ac.rotate(self.state, turns=turns).ravel()
+        self.x_bits = _bits_of(state == "X")
+        self.o_bits = _bits_of(state == "O")
+        self._state = None
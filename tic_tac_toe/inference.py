@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+
+"""Front-end that batches move requests to a WeightedGameStateAI.
+
+When many games ask the same AI for moves at once, for example the
+sessions of server.GameServer, the requests are collected and answered
+together with WeightedGameStateAI.get_next_gamestates, which looks up the
+weights of all requests in one gather."""
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from AI import AI
+
+
+class BatchingAI(AI):
+    """AI that passes move requests to a WeightedGameStateAI in batches.
+
+    A worker thread waits for a request, then collects more until it has
+    max_batch_size of them or max_wait_us microseconds have passed since
+    the first one, and answers them all at once. Submit returns a future
+    of the next gamestate and get_next_gamestate waits for it, so the AI
+    can be called from any number of threads.
+
+    Requests for gamestates of different boards are answered in separate
+    batches. The wrapped AI is only used from the worker thread. Updates
+    are passed to it directly, so it should not learn while it is being
+    served."""
+    def __init__(self, ai, max_batch_size=64, max_wait_us=500):
+        self.ai = ai
+        self.max_batch_size = max_batch_size
+        self.max_wait_us = max_wait_us
+        self.batches = 0
+        self.requests = 0
+        self._requests = queue.Queue()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    @property
+    def rng(self):
+        return self.ai.rng
+
+    def seed(self, seed):
+        self.ai.seed(seed)
+
+    def submit(self, previous_gamestate):
+        """Returns a future of the next gamestate."""
+        future = Future()
+        self._requests.put((previous_gamestate, future))
+        return future
+
+    def get_next_gamestate(self, previous_gamestate):
+        return self.submit(previous_gamestate).result()
+
+    def update_db(self, gamestates):
+        self.ai.update_db(gamestates)
+
+    def close(self):
+        """Stops the worker thread after the pending requests."""
+        self._requests.put(None)
+        self._worker.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+            self._answer(batch)
+
+    def _collect(self):
+        # Returns the next batch of requests or None when the worker is
+        # closed. A None request ends the batch it is in and is put back
+        # for the next call.
+        request = self._requests.get()
+        if request is None:
+            return None
+        batch = [request]
+        deadline = time.monotonic() + self.max_wait_us / 1e6
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    request = self._requests.get(timeout=remaining)
+                else:
+                    request = self._requests.get_nowait()
+            except queue.Empty:
+                break
+            if request is None:
+                self._requests.put(None)
+                break
+            batch.append(request)
+        return batch
+
+    def _answer(self, batch):
+        # Requests whose futures were cancelled are dropped.
+        batch = [(gs, future) for gs, future in batch
+                 if future.set_running_or_notify_cancel()]
+        boards = {}
+        for gs, future in batch:
+            boards.setdefault(gs.board, []).append((gs, future))
+        for requests in boards.values():
+            self._answer_board(requests)
+
+    def _answer_board(self, batch):
+        # Answers requests for gamestates of the same board.
+        gamestates = [gs for gs, future in batch]
+        futures = [future for gs, future in batch]
+        try:
+            results = self.ai.get_next_gamestates(gamestates)
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+            return
+        self.batches += 1
+        self.requests += len(futures)
+        for future, result in zip(futures, results):
+            future.set_result(result)
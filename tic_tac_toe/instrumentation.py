@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+
+"""Opt-in counters and timers for the hot paths of the engine.
+
+Enable replaces the instrumented functions and methods with wrappers that
+count and time their calls, and disable puts the originals back, so the
+engine runs at full speed when instrumentation is off. As
+get_possible_states is a generator, its work is timed in
+SuccessorCache.get. Snapshot returns
+the collected numbers along with cache hit rates and database sizes per
+round. While enabled, play_tournament logs a snapshot to the
+"instrumentation" logger every log_interval seconds.
+
+Profile runs a function, such as a whole tournament, under cProfile."""
+
+import cProfile
+import functools
+import io
+import json
+import logging
+import pstats
+import time
+import AI
+import array_comparison
+import gamestate
+import local_db
+
+
+logger = logging.getLogger("instrumentation")
+
+# Instrumented attributes as (owner, attribute name) pairs. Functions are
+# replaced in their modules, so calls through the module globals are
+# counted too.
+_targets = [
+    (gamestate.GameState, "__init__"),
+    (gamestate.GameState, "__hash__"),
+    (gamestate.GameState, "is_game_over"),
+    (gamestate.GameState, "apply_move"),
+    (gamestate.GameState, "advance_to"),
+    (gamestate.GameState, "outcome"),
+    (gamestate.GameState, "successor_keys"),
+    (AI, "get_possible_states"),
+    (AI.SuccessorCache, "get"),
+] + [
+    (db_class, name)
+    for db_class in (local_db.DB, local_db.ArrayDB, local_db.DenseDB,
+                     local_db.BoundedDB, local_db.SQLiteDB)
+    for name in ("get_weight", "get_weights", "add_or_update", "update_many")
+]
+
+_originals = {}
+_counts = {}
+_times = {}
+_state = {
+    "log_interval": 10.0,
+    "last_log": 0.0
+}
+
+
+def enable(log_interval=10.0):
+    """Starts counting and timing calls. Counters are kept from earlier
+    runs, use reset to clear them."""
+    _state["log_interval"] = log_interval
+    _state["last_log"] = time.monotonic()
+    for owner, name in _targets:
+        if (owner, name) in _originals:
+            continue
+        original = owner.__dict__[name]
+        _originals[(owner, name)] = original
+        setattr(owner, name, _instrumented(
+            "{0}.{1}".format(owner.__name__, name), original))
+
+
+def disable():
+    """Restores the original functions and methods."""
+    for (owner, name), original in _originals.items():
+        setattr(owner, name, original)
+    _originals.clear()
+
+
+def is_enabled():
+    return bool(_originals)
+
+
+def reset():
+    for name in _counts:
+        _counts[name] = 0
+        _times[name] = 0
+    AI.successor_cache.hits = 0
+    AI.successor_cache.misses = 0
+
+
+def snapshot(dbs=None):
+    """Returns a dictionary of the call counts and times, the hit rates of
+    the caches and, for databases given as a dictionary from names to
+    databases, the number of states per round and the memory reports of
+    bounded databases."""
+    calls = dict(
+        (name, {
+            "count": count,
+            "total_seconds": _times[name] / 1e9,
+            "mean_us": _times[name] / count / 1e3 if count else 0.0
+        }) for name, count in sorted(_counts.items()))
+    caches = {
+        "successor_cache": AI.successor_cache.cache_info()
+    }
+    for function in (array_comparison.symmetry_permutations,
+                     array_comparison.canonical_table,
+                     gamestate._get_board):
+        info = function.cache_info()
+        lookups = info.hits + info.misses
+        caches[function.__name__] = {
+            "hits": info.hits,
+            "misses": info.misses,
+            "hit_rate": info.hits / lookups if lookups else 0.0,
+            "size": info.currsize,
+            "maxsize": info.maxsize
+        }
+    db_sizes = {}
+    db_memory = {}
+    for name, db in (dbs or {}).items():
+        if hasattr(db, "round_sizes"):
+            db_sizes[name] = db.round_sizes()
+        if hasattr(db, "memory_report"):
+            db_memory[name] = db.memory_report()
+    return {
+        "enabled": is_enabled(),
+        "calls": calls,
+        "caches": caches,
+        "db_sizes": db_sizes,
+        "db_memory": db_memory
+    }
+
+
+def log_snapshot(dbs=None):
+    """Logs a snapshot as a JSON line."""
+    logger.info(json.dumps(snapshot(dbs)))
+    _state["last_log"] = time.monotonic()
+
+
+def maybe_log(dbs=None):
+    """Logs a snapshot if instrumentation is enabled and log_interval
+    seconds have passed since the last one."""
+    if _originals and (time.monotonic() - _state["last_log"] >=
+                       _state["log_interval"]):
+        log_snapshot(dbs)
+
+
+def profile(function, *args, output=None, sort="cumulative", limit=30,
+            **kwargs):
+    """Runs function with given arguments under cProfile and returns its
+    result and the profile report as text. The raw statistics are written
+    to output if given. Only the calling process is profiled, so parallel
+    tournaments show the time spent waiting for the workers."""
+    profiler = cProfile.Profile()
+    result = profiler.runcall(function, *args, **kwargs)
+    if output is not None:
+        profiler.dump_stats(output)
+    report = io.StringIO()
+    pstats.Stats(profiler, stream=report).sort_stats(sort).print_stats(limit)
+    return result, report.getvalue()
+
+
+def _instrumented(name, function):
+    _counts.setdefault(name, 0)
+    _times.setdefault(name, 0)
+    perf_counter_ns = time.perf_counter_ns
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        start = perf_counter_ns()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _times[name] += perf_counter_ns() - start
+            _counts[name] += 1
+    return wrapper
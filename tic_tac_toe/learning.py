@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+"""Learning rules for WeightedGameStateAI.
+
+By default the AI moves the weight of every gamestate of a game toward
+the game's outcome with a running average. A learning rule given to the
+AI replaces that update."""
+
+import numpy as np
+from local_db import _weight_adjustment_array, _grouped_updates
+
+
+class TDLambda:
+    """Offline TD(lambda) on the weights of the gamestates of a game.
+
+    Weights are estimates of the outcome value of a gamestate for 'X', as
+    in the running average: 1 for a win, 0 for a loss and the draw
+    adjustment of local_db for a draw. Each gamestate of a game moves
+    toward its lambda-return, the average of the weights of the following
+    gamestates weighted by powers of lambda, with the outcome value in
+    place of the weight of the final gamestate. The final gamestate moves
+    toward the outcome value. Lambda 1 moves every gamestate toward the
+    outcome like the running average does, but with a constant learning
+    rate. Lambda 0 only looks one move ahead.
+
+    Games are updated as a batch. Errors of a gamestate that appears n
+    times in the batch are averaged and applied with the rate
+    1 - (1 - learning_rate) ** n, the rate of n consecutive updates toward
+    the same target."""
+    def __init__(self, learning_rate=0.4, lam=0.2):
+        if not 0 < learning_rate <= 1:
+            raise ValueError("Learning rate must be in (0, 1].")
+        if not 0 <= lam <= 1:
+            raise ValueError("Lambda must be in [0, 1].")
+        self.learning_rate = learning_rate
+        self.lam = lam
+
+    def update(self, db, keys, valid, outcomes):
+        """Updates db with a batch of games. Keys is an (N, L) array of the
+        canonical keys of the gamestates of each game, starting from the
+        empty board, valid masks the keys that belong to a game and
+        outcomes holds the outcome code of each game."""
+        keys = np.asarray(keys)
+        valid = np.asarray(valid, dtype=bool)
+        outcomes = np.asarray(outcomes, dtype=np.int64)
+        count, length = keys.shape
+        targets = _weight_adjustment_array[outcomes]
+        last = np.count_nonzero(valid, axis=1) - 1
+
+        values = np.zeros(keys.shape)
+        values[valid] = db.get_weights(keys[valid])
+        # The weight of the final gamestate is replaced by the outcome.
+        next_values = values.copy()
+        next_values[np.arange(count), last] = targets
+
+        # Lambda-returns from the end of the games backwards.
+        returns = np.zeros(keys.shape)
+        returns[np.arange(count), last] = targets
+        for t in range(length - 2, -1, -1):
+            ongoing = t < last
+            returns[ongoing, t] = (
+                (1 - self.lam) * next_values[ongoing, t + 1] +
+                self.lam * returns[ongoing, t + 1])
+
+        unique_keys, counts, error_sums = _grouped_updates(
+            keys[valid], (returns - values)[valid])
+        mean_errors = error_sums / counts
+        rates = 1 - (1 - self.learning_rate) ** counts
+        db.add_weights(unique_keys, rates * mean_errors, counts)
@@ -1,15 +1,45 @@
 # -*- coding: utf-8 -*-
 
-import array_comparison as ac
-from gamestate import GameState
+import json
+import os
+import sqlite3
+import struct
+import sys
+import numpy as np
+from gamestate import (GameState, X_WON, O_WON, DRAW, to_outcome,
+                       outcome_message, rounds_played_of, get_board,
+                       history_keys, replay, _max_key_cells)
+from state_graph import get_graph
 
 
 _weight_adjustements = {
-    "X won!": 1.0,
-    "O won!": 0.0,
-    "Draw.": 0.7
+    X_WON: 1.0,
+    O_WON: 0.0,
+    DRAW: 0.7
 }
 
+# Keys looked up per query by SQLiteDB. Statements are cached for each
+# batch length, so repeated lookups reuse prepared statements.
+_sqlite_batch_size = 500
+
+_sqlite_schema = """
+CREATE TABLE IF NOT EXISTS states (
+    id INTEGER PRIMARY KEY,
+    rounds_played INTEGER NOT NULL,
+    weight REAL NOT NULL,
+    playcount INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS states_rounds_played ON states (rounds_played);
+CREATE TABLE IF NOT EXISTS metadata (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+_weight_adjustment_array = np.full(max(_weight_adjustements) + 1, np.nan)
+for outcome, adjustment in _weight_adjustements.items():
+    _weight_adjustment_array[outcome] = adjustment
+
 
 class Weight:
     def __init__(self, weigth=0.7, playcount=0):
@@ -19,48 +49,1005 @@ class Weight:
 
 class DB:
     """Database contains all unique gamestates that the AI has encountered
-    as well as their weights and play counts.
-
-    TODO serialize this to file."""
-    def __init__(self, default_weight=0.7):
-        self.rounds = {
-            0: {},
-            1: {},
-            2: {},
-            3: {},
-            4: {},
-            5: {},
-            6: {},
-            7: {},
-            8: {},
-            9: {}
-        }
+    as well as their weights and play counts. Gamestates are stored by
+    their canonical keys.
+
+    Use save_db and load_db to store the database to a file."""
+    def __init__(self, default_weight=0.7, board_size=3, k=None):
+        self.board = get_board(board_size, k)
+        self.rounds = dict(
+            (r, {}) for r in range(self.board.cell_count + 1))
         self.default_weight = default_weight
+        self.games_trained = 0
 
     def add_or_update(self, gamestate, result):
         """If the gamestate is already in the database, its values
         will be updated, otherwise the state is added to the
-        database."""
-        weight = self.get_weight(gamestate)
-        if weight.playcount == 0:
-            self.rounds[gamestate.rounds_played][gamestate] = weight
+        database.
+
+        Result is either an outcome code or an outcome message."""
+        self._update(
+            gamestate.canonical_key, gamestate.rounds_played, result)
 
-        weight_adjustment = _weight_adjustements[result]
+    def update_many(self, ids, results):
+        """Updates the gamestates with given canonical keys. Results
+        are given for each key or as a single result for all of them."""
+        results = _outcomes_of(results, len(ids)).tolist()
+        for key, result in zip(np.asarray(ids).tolist(), results):
+            self._update(key, self.board.rounds_played_of_key(key), result)
+
+    def _update(self, key, rounds_played, result):
+        weight = self.rounds[rounds_played].get(key)
+        if weight is None:
+            weight = Weight(self.default_weight)
+            self.rounds[rounds_played][key] = weight
+
+        weight_adjustment = _weight_adjustements[to_outcome(result)]
 
         weight.playcount += 1
         weight.weight = ((weight.playcount * weight.weight) + weight_adjustment) / (weight.playcount + 1)
 
+    def add_weights(self, ids, deltas, playcounts):
+        """Adds deltas to the weights and playcounts to the play counts of
+        the gamestates with given unique canonical keys. Missing states
+        are added with the default weight first."""
+        for key, delta, playcount in zip(
+                np.asarray(ids).tolist(), np.asarray(deltas).tolist(),
+                np.asarray(playcounts).tolist()):
+            states = self.rounds[self.board.rounds_played_of_key(key)]
+            weight = states.get(key)
+            if weight is None:
+                weight = states[key] = Weight(self.default_weight)
+            weight.weight += delta
+            weight.playcount += playcount
+
+    def get_weighted_states(self, rounds=[]):
+        """Returns all known states for given rounds."""
+        res = []
+        for r in rounds:
+            res += [GameState.from_code(key, self.board.size, self.board.k)
+                    for key in self.rounds[r]]
+        return res
+
+    def get_weight(self, gamestate):
+        """Returns weight that corresponds to the given gamestate.
+
+        If gamestate is not in database, default value is returned."""
+        return self.rounds[gamestate.rounds_played].get(
+            gamestate.canonical_key, Weight(self.default_weight))
+
+    def get_weights(self, ids):
+        """Returns an array of weights for given canonical keys."""
+        default = Weight(self.default_weight)
+        return np.array([
+            self.rounds[self.board.rounds_played_of_key(key)].get(
+                key, default).weight
+            for key in np.asarray(ids).tolist()
+        ])
+
+    def round_sizes(self):
+        """Returns a dictionary from rounds to the number of known states
+        for them."""
+        return dict((r, len(states)) for r, states in self.rounds.items())
+
+    def __len__(self):
+        return sum(len(states) for states in self.rounds.values())
+
+
+class ArrayDB:
+    """Database that stores weights and play counts in NumPy arrays instead
+    of Weight objects. It has the same interface as DB.
+
+    Every known gamestate takes a slot in the keys, weights and playcounts
+    arrays. On boards small enough to have lookup tables, slots are found
+    through a table indexed by canonical key, so looking up a batch of keys
+    is a single gather. Larger boards use a dictionary from keys to slots.
+    Keys must fit into 64 bit integers, which limits boards to 6X6."""
+    def __init__(self, default_weight=0.7, capacity=1024, board_size=3,
+                 k=None):
+        self.board = get_board(board_size, k)
+        if self.board.cell_count > _max_key_cells:
+            raise ValueError(
+                "ArrayDB supports boards of at most {0} cells, use DB for "
+                "larger boards.".format(_max_key_cells))
+        self.default_weight = default_weight
+        self.games_trained = 0
+        self.size = 0
+        self.keys = np.zeros(capacity, dtype=np.int64)
+        self.weights = np.zeros(capacity, dtype=np.float32)
+        self.playcounts = np.zeros(capacity, dtype=np.uint32)
+        if self.board.has_tables:
+            self._slots = np.full(
+                3 ** self.board.cell_count, -1, dtype=np.int32)
+        else:
+            self._slots = {}
+
+    @classmethod
+    def from_arrays(cls, keys, weights, playcounts, slots=None,
+                    default_weight=0.7, games_trained=0, board_size=3,
+                    k=None):
+        """Creates a database that uses given arrays, for example memory
+        mapped ones, without copying them. All slots of the arrays are
+        considered to be in use. Boards without lookup tables take no
+        slots array, the slots are built from the keys instead."""
+        db = cls.__new__(cls)
+        db.board = get_board(board_size, k)
+        db.default_weight = default_weight
+        db.games_trained = games_trained
+        db.size = len(keys)
+        db.keys = keys
+        db.weights = weights
+        db.playcounts = playcounts
+        if db.board.has_tables:
+            db._slots = slots
+        else:
+            db._slots = dict(
+                (key, slot) for slot, key in enumerate(keys.tolist()))
+        return db
+
+    def add_or_update(self, gamestate, result):
+        """If the gamestate is already in the database, its values
+        will be updated, otherwise the state is added to the
+        database.
+
+        Result is either an outcome code or an outcome message."""
+        self.update_many([gamestate.canonical_key], [result])
+
+    def update_many(self, ids, results):
+        """Updates the gamestates with given canonical keys. Results
+        are given for each key or as a single result for all of them.
+        Keys may repeat, each occurrence counts as one update."""
+        ids = np.asarray(ids, dtype=np.int64)
+        adjustments = _adjustments_of(results, len(ids))
+        slots = self._get_or_add_slots(ids)
+        touched, counts, sums = _grouped_updates(slots, adjustments)
+        self.weights[touched] = _running_averages(
+            self.weights[touched], self.playcounts[touched], counts, sums)
+        self.playcounts[touched] += counts.astype(np.uint32)
+
+    def add_weights(self, ids, deltas, playcounts):
+        """Adds deltas to the weights and playcounts to the play counts of
+        the gamestates with given unique canonical keys. Missing states
+        are added with the default weight first."""
+        slots = self._get_or_add_slots(np.asarray(ids, dtype=np.int64))
+        self.weights[slots] += np.asarray(deltas, dtype=np.float32)
+        self.playcounts[slots] += np.asarray(playcounts, dtype=np.uint32)
+
+    def get_weighted_states(self, rounds=[]):
+        """Returns all known states for given rounds."""
+        keys = self.keys[:self.size]
+        keys = keys[np.isin(
+            rounds_played_of(keys, self.board.size), list(rounds))]
+        return [GameState.from_code(key, self.board.size, self.board.k)
+                for key in keys.tolist()]
+
+    def get_weight(self, gamestate):
+        """Returns weight that corresponds to the given gamestate.
+
+        If gamestate is not in database, default value is returned."""
+        key = gamestate.canonical_key
+        if isinstance(self._slots, dict):
+            slot = self._slots.get(key, -1)
+        else:
+            slot = self._slots[key]
+        if slot < 0:
+            return Weight(self.default_weight)
+        return Weight(self.weights[slot].item(), self.playcounts[slot].item())
+
+    def get_weights(self, ids):
+        """Returns an array of weights for given canonical keys."""
+        slots = self._find_slots(np.asarray(ids, dtype=np.int64))
+        return np.where(
+            slots < 0, self.default_weight,
+            self.weights[slots].astype(np.float64))
+
+    def round_sizes(self):
+        """Returns a dictionary from rounds to the number of known states
+        for them."""
+        counts = np.bincount(
+            rounds_played_of(self.keys[:self.size], self.board.size),
+            minlength=self.board.cell_count + 1)
+        return dict(enumerate(counts.tolist()))
+
+    def nbytes(self):
+        """Returns the number of bytes used by the arrays."""
+        if isinstance(self._slots, dict):
+            slots_nbytes = sys.getsizeof(self._slots)
+        else:
+            slots_nbytes = self._slots.nbytes
+        return (self.keys.nbytes + self.weights.nbytes +
+                self.playcounts.nbytes + slots_nbytes)
+
+    def __len__(self):
+        return self.size
+
+    def _find_slots(self, ids):
+        # Returns the slots of given keys, -1 for unknown keys.
+        if isinstance(self._slots, dict):
+            return np.fromiter(
+                (self._slots.get(key, -1) for key in ids.tolist()),
+                dtype=np.int64, count=len(ids))
+        return self._slots[ids]
+
+    def _get_or_add_slots(self, ids):
+        slots = self._find_slots(ids)
+        missing = slots < 0
+        if missing.any():
+            new_keys = np.unique(ids[missing])
+            self._reserve(self.size + len(new_keys))
+            new_slots = np.arange(
+                self.size, self.size + len(new_keys), dtype=np.int32)
+            self.keys[new_slots] = new_keys
+            self.weights[new_slots] = self.default_weight
+            self.playcounts[new_slots] = 0
+            if isinstance(self._slots, dict):
+                self._slots.update(zip(new_keys.tolist(), new_slots.tolist()))
+            else:
+                self._slots[new_keys] = new_slots
+            self.size += len(new_keys)
+            slots = self._find_slots(ids)
+        return slots
+
+    def _reserve(self, capacity):
+        if capacity <= len(self.keys):
+            return
+        capacity = max(capacity, 2 * len(self.keys))
+        if isinstance(self._slots, np.memmap):
+            # The slots must not point past the arrays in the file.
+            self._slots = np.array(self._slots)
+        for name in ("keys", "weights", "playcounts"):
+            old = getattr(self, name)
+            new = np.zeros(capacity, dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+
+class DenseDB:
+    """Database with a weight and a play count for every reachable state
+    of a state_graph.StateGraph, in arrays indexed by the states' dense
+    ids. It has the same interface as DB.
+
+    Looking up keys is a gather through the graph's id table and updates
+    never allocate, but only boards with state graphs, at most 3X3, are
+    supported. States count as known once they have been played."""
+    def __init__(self, default_weight=0.7, board_size=3, k=None,
+                 graph=None):
+        self.graph = graph if graph is not None else get_graph(
+            board_size, k)
+        self.board = self.graph.board
+        self.default_weight = default_weight
+        self.games_trained = 0
+        self.weights = np.full(
+            len(self.graph), default_weight, dtype=np.float32)
+        self.playcounts = np.zeros(len(self.graph), dtype=np.uint32)
+
+    def add_or_update(self, gamestate, result):
+        """If the gamestate is already in the database, its values
+        will be updated, otherwise the state is added to the
+        database.
+
+        Result is either an outcome code or an outcome message."""
+        self.update_many([gamestate.canonical_key], [result])
+
+    def update_many(self, ids, results):
+        """Updates the gamestates with given canonical keys. Results
+        are given for each key or as a single result for all of them.
+        Keys may repeat, each occurrence counts as one update."""
+        state_ids = self.graph.ids_of(ids)
+        if (state_ids < 0).any():
+            raise ValueError("Keys of unreachable gamestates.")
+        adjustments = _adjustments_of(results, len(state_ids))
+        touched, counts, sums = _grouped_updates(state_ids, adjustments)
+        self.weights[touched] = _running_averages(
+            self.weights[touched], self.playcounts[touched], counts, sums)
+        self.playcounts[touched] += counts.astype(np.uint32)
+
+    def add_weights(self, ids, deltas, playcounts):
+        """Adds deltas to the weights and playcounts to the play counts of
+        the gamestates with given unique canonical keys."""
+        state_ids = self.graph.ids_of(ids)
+        if (state_ids < 0).any():
+            raise ValueError("Keys of unreachable gamestates.")
+        self.weights[state_ids] += np.asarray(deltas, dtype=np.float32)
+        self.playcounts[state_ids] += np.asarray(playcounts, dtype=np.uint32)
+
     def get_weighted_states(self, rounds=[]):
         """Returns all known states for given rounds."""
         res = []
         for r in rounds:
-            res += self.rounds[r]
+            ids = np.arange(self.graph.round_starts[r],
+                            self.graph.round_starts[r + 1])
+            keys = self.graph.keys[ids[self.playcounts[ids] > 0]]
+            res += [GameState.from_code(key, self.board.size, self.board.k)
+                    for key in keys.tolist()]
         return res
 
     def get_weight(self, gamestate):
         """Returns weight that corresponds to the given gamestate.
 
         If gamestate is not in database, default value is returned."""
-        if gamestate in self.rounds[gamestate.rounds_played]:
-            return self.rounds[gamestate.rounds_played][gamestate]
-        return Weight()
+        state_id = self.graph.id_table[gamestate.canonical_key]
+        if state_id < 0:
+            return Weight(self.default_weight)
+        return Weight(self.weights[state_id].item(),
+                      self.playcounts[state_id].item())
+
+    def get_weights(self, ids):
+        """Returns an array of weights for given canonical keys."""
+        state_ids = self.graph.ids_of(ids)
+        return np.where(
+            state_ids < 0, self.default_weight,
+            self.weights[state_ids].astype(np.float64))
+
+    def round_sizes(self):
+        """Returns a dictionary from rounds to the number of known states
+        for them."""
+        counts = np.bincount(
+            self.graph.rounds_played[self.playcounts > 0],
+            minlength=self.board.cell_count + 1)
+        return dict(enumerate(counts.tolist()))
+
+    def __len__(self):
+        return int(np.count_nonzero(self.playcounts))
+
+
+class BoundedDB:
+    """Database that holds at most as many gamestates as fit into a
+    memory budget of max_bytes. It has the same interface as DB.
+
+    States are kept in fixed arrays of slots found through a dictionary
+    from keys to slots, so keys of any board size are supported. Weights
+    are stored quantized as weight_dtype: uint8 weights are rounded
+    stochastically to steps of 1/255 so that small updates are not lost on
+    average, float16 weights are rounded to the nearest value. Play counts
+    are 16 bit and stop at 65535, after which weights are exponential
+    moving averages.
+
+    The capacity is max_bytes divided by an estimate of the bytes of a
+    state, which is dominated by the dictionary and the key objects rather
+    than the weights: about 170 bytes up to 7X7 and about 210 bytes on
+    15X15. A budget of 20000 bytes holds 119 states on 3X3 and 114 on 7X7.
+
+    When the database is full, a sixteenth of it is evicted at once. The
+    lfu policy evicts the least played states first, and of those the
+    least recently used, while the lru policy only looks at the last use.
+    States of the batch being updated are never evicted, and evictions
+    are counted by round. Evicted states start over from the default
+    weight if they are played again."""
+    _policies = ("lfu", "lru")
+    _weight_dtypes = {
+        "uint8": np.uint8,
+        "float16": np.float16,
+        "float32": np.float32
+    }
+    _max_playcount = np.iinfo(np.uint16).max
+    # Estimated bytes per entry of the slot dictionary, including its
+    # spare capacity, and of the int objects of the slots.
+    _dict_entry_bytes = 90
+    _slot_object_bytes = sys.getsizeof(2 ** 20)
+
+    def __init__(self, default_weight=0.7, board_size=3, k=None,
+                 max_bytes=64 * 2 ** 20, policy="lfu", weight_dtype="uint8",
+                 seed=None):
+        if policy not in self._policies:
+            raise ValueError("Unknown eviction policy {0}.".format(policy))
+        if weight_dtype not in self._weight_dtypes:
+            raise ValueError("Unknown weight dtype {0}.".format(weight_dtype))
+        self.board = get_board(board_size, k)
+        self.default_weight = default_weight
+        self.games_trained = 0
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self._rng = np.random.default_rng(seed)
+
+        key_dtype = (np.int64 if self.board.cell_count <= _max_key_cells
+                     else object)
+        weight_dtype = self._weight_dtypes[weight_dtype]
+        self._key_object_bytes = sys.getsizeof(3 ** self.board.cell_count)
+        state_bytes = (
+            8 + np.dtype(weight_dtype).itemsize + 2 + 4 + 1 + 1 + 4 +
+            self._dict_entry_bytes + self._key_object_bytes +
+            self._slot_object_bytes)
+        self.capacity = max_bytes // state_bytes
+        if self.capacity < 2:
+            raise ValueError("Memory budget of {0} bytes is too small.".format(
+                max_bytes))
+
+        self.keys = np.zeros(self.capacity, dtype=key_dtype)
+        self.weights = np.zeros(self.capacity, dtype=weight_dtype)
+        self.playcounts = np.zeros(self.capacity, dtype=np.uint16)
+        self.last_used = np.zeros(self.capacity, dtype=np.uint32)
+        self.rounds_played = np.zeros(self.capacity, dtype=np.uint8)
+        self._in_use = np.zeros(self.capacity, dtype=bool)
+        # Stack of free slots, popped from the end.
+        self._free = np.arange(self.capacity - 1, -1, -1, dtype=np.int32)
+        self._free_count = self.capacity
+        self._slots = {}
+        self._tick = 0
+        self.insertions = 0
+        self.evictions = 0
+        self.evictions_by_round = np.zeros(
+            self.board.cell_count + 1, dtype=np.int64)
+
+    def add_or_update(self, gamestate, result):
+        """If the gamestate is already in the database, its values
+        will be updated, otherwise the state is added to the
+        database.
+
+        Result is either an outcome code or an outcome message."""
+        self.update_many([gamestate.canonical_key], [result])
+
+    def update_many(self, ids, results):
+        """Updates the gamestates with given canonical keys. Results
+        are given for each key or as a single result for all of them.
+        Keys may repeat, each occurrence counts as one update."""
+        ids = np.asarray(ids)
+        adjustments = _adjustments_of(results, len(ids))
+        for chunk in self._chunks(len(ids)):
+            slots = self._get_or_add_slots(ids[chunk])
+            touched, counts, sums = _grouped_updates(
+                slots, adjustments[chunk])
+            self._store(touched, _running_averages(
+                self._load(touched), self.playcounts[touched], counts, sums))
+            self._add_playcounts(touched, counts)
+
+    def add_weights(self, ids, deltas, playcounts):
+        """Adds deltas to the weights and playcounts to the play counts of
+        the gamestates with given unique canonical keys. Missing states
+        are added with the default weight first."""
+        ids = np.asarray(ids)
+        deltas = np.asarray(deltas, dtype=np.float64)
+        playcounts = np.asarray(playcounts)
+        for chunk in self._chunks(len(ids)):
+            slots = self._get_or_add_slots(ids[chunk])
+            self._store(slots, self._load(slots) + deltas[chunk])
+            self._add_playcounts(slots, playcounts[chunk])
+
+    def get_weighted_states(self, rounds=[]):
+        """Returns all known states for given rounds."""
+        keys = self.keys[self._in_use & np.isin(
+            self.rounds_played, list(rounds))]
+        return [GameState.from_code(key, self.board.size, self.board.k)
+                for key in keys.tolist()]
+
+    def get_weight(self, gamestate):
+        """Returns weight that corresponds to the given gamestate.
+
+        If gamestate is not in database, default value is returned."""
+        slot = self._slots.get(gamestate.canonical_key, -1)
+        if slot < 0:
+            return Weight(self.default_weight)
+        return Weight(self._load(np.array([slot]))[0].item(),
+                      self.playcounts[slot].item())
+
+    def get_weights(self, ids):
+        """Returns an array of weights for given canonical keys. Known
+        states count as used."""
+        slots = self._find_slots(np.asarray(ids).tolist())
+        found = slots >= 0
+        self._tick += 1
+        self.last_used[slots[found]] = self._tick
+        weights = np.full(len(slots), self.default_weight)
+        weights[found] = self._load(slots[found])
+        return weights
+
+    def round_sizes(self):
+        """Returns a dictionary from rounds to the number of known states
+        for them."""
+        counts = np.bincount(self.rounds_played[self._in_use],
+                             minlength=self.board.cell_count + 1)
+        return dict(enumerate(counts.tolist()))
+
+    def nbytes(self):
+        """Returns the number of bytes used by the arrays, the slot
+        dictionary and the key and slot objects in it."""
+        arrays = (self.keys, self.weights, self.playcounts, self.last_used,
+                  self.rounds_played, self._in_use, self._free)
+        return (sum(array.nbytes for array in arrays) +
+                sys.getsizeof(self._slots) +
+                len(self._slots) * (
+                    self._key_object_bytes + self._slot_object_bytes))
+
+    def memory_report(self):
+        """Returns a dictionary of the memory footprint, the fill rate and
+        the evictions of the database. The eviction rate is the share of
+        inserted states that have been evicted."""
+        return {
+            "max_bytes": self.max_bytes,
+            "nbytes": self.nbytes(),
+            "capacity": self.capacity,
+            "size": len(self),
+            "fill_rate": len(self) / self.capacity,
+            "weight_dtype": self.weights.dtype.name,
+            "policy": self.policy,
+            "insertions": self.insertions,
+            "evictions": self.evictions,
+            "eviction_rate": (self.evictions / self.insertions
+                              if self.insertions else 0.0),
+            "evictions_by_round": dict(
+                enumerate(self.evictions_by_round.tolist()))
+        }
+
+    def __len__(self):
+        return len(self._slots)
+
+    def _chunks(self, count):
+        # Splits batches so that the states of a chunk fit into the
+        # database along with the states it protects from eviction.
+        step = self.capacity // 2
+        return [slice(start, start + step) for start in range(0, count, step)]
+
+    def _find_slots(self, keys):
+        return np.fromiter((self._slots.get(key, -1) for key in keys),
+                           dtype=np.int64, count=len(keys))
+
+    def _get_or_add_slots(self, ids):
+        keys = ids.tolist()
+        slots = self._find_slots(keys)
+        missing = slots < 0
+        self._tick += 1
+        if missing.any():
+            new_keys = list(dict.fromkeys(
+                key for key, is_missing in zip(keys, missing.tolist())
+                if is_missing))
+            self._make_room(len(new_keys), slots[~missing])
+            top = self._free_count
+            new_slots = self._free[top - len(new_keys):top][::-1].copy()
+            self._free_count -= len(new_keys)
+
+            self.keys[new_slots] = new_keys
+            self._store(new_slots, np.full(len(new_slots),
+                                           self.default_weight))
+            self.playcounts[new_slots] = 0
+            if self.keys.dtype == object:
+                self.rounds_played[new_slots] = [
+                    self.board.rounds_played_of_key(key) for key in new_keys]
+            else:
+                self.rounds_played[new_slots] = rounds_played_of(
+                    self.keys[new_slots], self.board.size)
+            self._in_use[new_slots] = True
+            self._slots.update(zip(new_keys, new_slots.tolist()))
+            self.insertions += len(new_keys)
+            slots = self._find_slots(keys)
+        self.last_used[slots] = self._tick
+        return slots
+
+    def _make_room(self, count, protected):
+        # Evicts states until count slots are free, never evicting the
+        # protected slots.
+        shortage = count - self._free_count
+        if shortage <= 0:
+            return
+        if self.policy == "lfu":
+            scores = (self.playcounts.astype(np.int64) << 32) + self.last_used
+        else:
+            scores = self.last_used.astype(np.int64)
+        scores[~self._in_use] = np.iinfo(np.int64).max
+        scores[protected] = np.iinfo(np.int64).max
+        evictable = len(self) - len(np.unique(protected))
+        evict_count = min(max(shortage, self.capacity // 16), evictable)
+        victims = np.argpartition(scores, evict_count - 1)[:evict_count]
+
+        for key in self.keys[victims].tolist():
+            del self._slots[key]
+        if self.keys.dtype == object:
+            self.keys[victims] = 0
+        self._in_use[victims] = False
+        self.evictions += evict_count
+        self.evictions_by_round += np.bincount(
+            self.rounds_played[victims],
+            minlength=len(self.evictions_by_round))
+        top = self._free_count
+        self._free[top:top + evict_count] = victims
+        self._free_count += evict_count
+
+    def _load(self, slots):
+        weights = self.weights[slots].astype(np.float64)
+        if self.weights.dtype == np.uint8:
+            weights /= 255
+        return weights
+
+    def _store(self, slots, weights):
+        if self.weights.dtype == np.uint8:
+            # Stochastic rounding keeps the expected stored weight equal
+            # to the weight.
+            scaled = np.clip(weights, 0, 1) * 255
+            weights = np.minimum(
+                np.floor(scaled + self._rng.random(len(scaled))), 255)
+        self.weights[slots] = weights
+
+    def _add_playcounts(self, slots, counts):
+        self.playcounts[slots] = np.minimum(
+            self.playcounts[slots].astype(np.int64) + counts,
+            self._max_playcount)
+
+
+class SQLiteDB:
+    """Database stored in an SQLite file with one row of canonical key,
+    rounds played, weight and play count per gamestate. It has the same
+    interface as DB.
+
+    Updates are written with executemany and committed once every
+    commit_every calls of update_many, which is once every commit_every
+    games for WeightedGameStateAI. Call commit to write the rest. File
+    databases use write-ahead logging, so other processes can read them,
+    for example with read_only set, while they are being trained. Keys must
+    fit into 64 bit integers, which limits boards to 6X6."""
+    def __init__(self, path=":memory:", default_weight=0.7, board_size=3,
+                 k=None, commit_every=1, read_only=False):
+        self.board = get_board(board_size, k)
+        if self.board.cell_count > _max_key_cells:
+            raise ValueError(
+                "SQLiteDB supports boards of at most {0} cells, use DB for "
+                "larger boards.".format(_max_key_cells))
+        self.path = path
+        self.default_weight = default_weight
+        self.commit_every = commit_every
+        self.read_only = read_only
+        self.games_trained = 0
+        self._uncommitted = 0
+        self._connect()
+
+    def _connect(self):
+        if self.read_only:
+            self._connection = sqlite3.connect(
+                "file:{0}?mode=ro".format(self.path), uri=True,
+                cached_statements=_sqlite_batch_size + 16)
+        else:
+            self._connection = sqlite3.connect(
+                self.path, cached_statements=_sqlite_batch_size + 16)
+            if self.path != ":memory:":
+                self._connection.execute("PRAGMA journal_mode=WAL")
+                self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.executescript(_sqlite_schema)
+
+        metadata = dict(self._connection.execute(
+            "SELECT name, value FROM metadata"))
+        if metadata:
+            metadata = dict((name, json.loads(value))
+                            for name, value in metadata.items())
+            if (metadata["board_size"], metadata["k"]) != (
+                    self.board.size, self.board.k):
+                raise ValueError(
+                    "{0} has weights for {1}X{1} boards with k = {2}.".format(
+                        self.path, metadata["board_size"], metadata["k"]))
+            self.default_weight = metadata["default_weight"]
+            self.games_trained = metadata["games_trained"]
+        elif not self.read_only:
+            self._write_metadata()
+            self._connection.commit()
+
+    def add_or_update(self, gamestate, result):
+        """If the gamestate is already in the database, its values
+        will be updated, otherwise the state is added to the
+        database.
+
+        Result is either an outcome code or an outcome message."""
+        self.update_many([gamestate.canonical_key], [result])
+
+    def update_many(self, ids, results):
+        """Updates the gamestates with given canonical keys. Results
+        are given for each key or as a single result for all of them.
+        Keys may repeat, each occurrence counts as one update."""
+        ids = np.asarray(ids, dtype=np.int64)
+        adjustments = _adjustments_of(results, len(ids))
+        # The running average of the weight is computed in SQL.
+        keys, counts, sums = _grouped_updates(ids, adjustments)
+        rounds = rounds_played_of(keys, self.board.size)
+        self._connection.executemany(
+            "INSERT INTO states (id, rounds_played, weight, playcount) "
+            "VALUES (:id, :rounds, (:default + :sum) / (:count + 1), :count) "
+            "ON CONFLICT (id) DO UPDATE SET "
+            "weight = (weight * (playcount + 1) + :sum) / "
+            "(playcount + :count + 1), "
+            "playcount = playcount + :count",
+            ({"id": key, "rounds": r, "default": self.default_weight,
+              "sum": s, "count": c}
+             for key, r, s, c in zip(keys.tolist(), rounds.tolist(),
+                                     sums.tolist(), counts.tolist())))
+
+        self._uncommitted += 1
+        if self._uncommitted >= self.commit_every:
+            self.commit()
+
+    def add_weights(self, ids, deltas, playcounts):
+        """Adds deltas to the weights and playcounts to the play counts of
+        the gamestates with given unique canonical keys. Missing states
+        are added with the default weight first. Counts as one update for
+        commit_every."""
+        keys = np.asarray(ids, dtype=np.int64)
+        rounds = rounds_played_of(keys, self.board.size)
+        self._connection.executemany(
+            "INSERT INTO states (id, rounds_played, weight, playcount) "
+            "VALUES (:id, :rounds, :default + :delta, :count) "
+            "ON CONFLICT (id) DO UPDATE SET "
+            "weight = weight + :delta, playcount = playcount + :count",
+            ({"id": key, "rounds": r, "default": self.default_weight,
+              "delta": d, "count": c}
+             for key, r, d, c in zip(
+                 keys.tolist(), rounds.tolist(),
+                 np.asarray(deltas).tolist(),
+                 np.asarray(playcounts).tolist())))
+
+        self._uncommitted += 1
+        if self._uncommitted >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        """Commits the updates written since the last commit."""
+        self._write_metadata()
+        self._connection.commit()
+        self._uncommitted = 0
+
+    def get_weighted_states(self, rounds=[]):
+        """Returns all known states for given rounds."""
+        rounds = list(rounds)
+        keys = self._connection.execute(
+            "SELECT id FROM states WHERE rounds_played IN ({0})".format(
+                ", ".join("?" * len(rounds))), rounds)
+        return [GameState.from_code(key, self.board.size, self.board.k)
+                for key, in keys]
+
+    def get_weight(self, gamestate):
+        """Returns weight that corresponds to the given gamestate.
+
+        If gamestate is not in database, default value is returned."""
+        row = self._connection.execute(
+            "SELECT weight, playcount FROM states WHERE id = ?",
+            (gamestate.canonical_key,)).fetchone()
+        if row is None:
+            return Weight(self.default_weight)
+        return Weight(*row)
+
+    def get_weights(self, ids):
+        """Returns an array of weights for given canonical keys."""
+        ids = np.asarray(ids, dtype=np.int64).tolist()
+        weights = {}
+        for start in range(0, len(ids), _sqlite_batch_size):
+            batch = ids[start:start + _sqlite_batch_size]
+            weights.update(self._connection.execute(
+                "SELECT id, weight FROM states WHERE id IN ({0})".format(
+                    ", ".join("?" * len(batch))), batch))
+        return np.array(
+            [weights.get(key, self.default_weight) for key in ids],
+            dtype=np.float64)
+
+    def round_sizes(self):
+        """Returns a dictionary from rounds to the number of known states
+        for them."""
+        sizes = dict.fromkeys(range(self.board.cell_count + 1), 0)
+        sizes.update(self._connection.execute(
+            "SELECT rounds_played, COUNT(*) FROM states "
+            "GROUP BY rounds_played"))
+        return sizes
+
+    def close(self):
+        if not self.read_only:
+            self.commit()
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self._connection.execute(
+            "SELECT COUNT(*) FROM states").fetchone()[0]
+
+    def __getstate__(self):
+        # Copies, such as the ones used by parallel tournaments, open the
+        # same file. Pending updates are committed so the copies see them.
+        if self.path == ":memory:":
+            raise TypeError("In-memory SQLiteDBs cannot be copied.")
+        if not self.read_only:
+            self.commit()
+        state = self.__dict__.copy()
+        del state["_connection"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._connect()
+
+    def _write_metadata(self):
+        self._connection.executemany(
+            "INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?)",
+            ((name, json.dumps(value)) for name, value in (
+                ("board_size", self.board.size),
+                ("k", self.board.k),
+                ("default_weight", self.default_weight),
+                ("games_trained", self.games_trained))))
+
+
+def _outcomes_of(results, count):
+    # Returns an array of outcome codes for results given as a single
+    # result or one result per gamestate, as codes or messages.
+    results = np.asarray(results)
+    if results.dtype.kind in "US":
+        results = np.vectorize(to_outcome, otypes=[np.int64])(results)
+    return np.broadcast_to(results, (count,))
+
+
+def _adjustments_of(results, count):
+    return _weight_adjustment_array[_outcomes_of(results, count)]
+
+
+def _grouped_updates(slots, adjustments):
+    # Weight is the running average of the default weight and all
+    # adjustments, so updates of the same slot can be summed. Returns the
+    # unique slots, the number of updates of each and the sums of their
+    # adjustments.
+    touched, inverse = np.unique(slots, return_inverse=True)
+    return (touched, np.bincount(inverse),
+            np.bincount(inverse, weights=adjustments))
+
+
+def _running_averages(weights, playcounts, counts, sums):
+    # Returns the running averages of weights with given play counts after
+    # counts more updates whose adjustments add up to sums.
+    playcounts = np.asarray(playcounts, dtype=np.float64)
+    return (np.asarray(weights, dtype=np.float64) * (playcounts + 1) +
+            sums) / (playcounts + counts + 1)
+
+
+def game_keys(board, moves):
+    """Returns the canonical keys of every gamestate of a batch of games
+    and a mask of the valid keys.
+
+    Moves is an (N, L) array of cell indexes padded with -1 after the end
+    of each game. The keys are an (N, L + 1) array whose row starts with
+    the empty board, keys after the end of a game are not valid."""
+    moves = np.asarray(moves)
+    if board.size == 3 and board.k == 3:
+        return history_keys(moves)
+    lengths = np.count_nonzero(moves >= 0, axis=1)
+    valid = np.arange(moves.shape[1] + 1) <= lengths[:, np.newaxis]
+    keys = np.zeros(valid.shape, dtype=object)
+    for i, game_moves in enumerate(moves.tolist()):
+        gamestates = replay(
+            [m for m in game_moves if m >= 0], board.size, board.k)
+        keys[i, :len(gamestates)] = [gs.canonical_key for gs in gamestates]
+    if board.cell_count <= _max_key_cells:
+        keys = keys.astype(np.int64)
+    return keys, valid
+
+
+def update_from_games(db, moves, outcomes):
+    """Updates a database with a batch of games. Every gamestate of a game,
+    including the empty board, is updated with the game's outcome.
+
+    Moves is an (N, L) array of cell indexes padded with -1 after the end
+    of each game and outcomes holds the outcome code of each game."""
+    outcomes = np.asarray(outcomes)
+    keys, valid = game_keys(db.board, moves)
+    results = np.broadcast_to(outcomes[:, np.newaxis], keys.shape)
+    db.update_many(keys[valid], results[valid])
+    db.games_trained += len(outcomes)
+
+
+# Database files start with the magic bytes, a uint16 format version and
+# a uint32 length of the JSON metadata that follows them. Arrays are
+# stored after the metadata at offsets aligned to _file_alignment bytes.
+_file_magic = b"TTTWDB"
+_file_version = 1
+_file_header = struct.Struct("<6sHI")
+_file_alignment = 64
+_file_arrays = ("keys", "weights", "playcounts", "slots")
+
+
+def save_db(db, path):
+    """Saves a DB, an ArrayDB or a BoundedDB to a file that load_db can
+    memory map. BoundedDBs are loaded as ArrayDBs."""
+    if isinstance(db, BoundedDB):
+        slots = np.flatnonzero(db._in_use)
+        array_db = ArrayDB(db.default_weight, capacity=max(len(slots), 1),
+                           board_size=db.board.size, k=db.board.k)
+        array_slots = array_db._get_or_add_slots(
+            db.keys[slots].astype(np.int64))
+        array_db.weights[array_slots] = db._load(slots)
+        array_db.playcounts[array_slots] = db.playcounts[slots]
+        array_db.games_trained = db.games_trained
+        return save_db(array_db, path)
+    if isinstance(db, ArrayDB):
+        arrays = {
+            "keys": db.keys[:db.size],
+            "weights": db.weights[:db.size],
+            "playcounts": db.playcounts[:db.size],
+            "slots": db._slots if db.board.has_tables else np.zeros(0, np.int32)
+        }
+    else:
+        array_db = ArrayDB(db.default_weight, capacity=max(len(db), 1),
+                           board_size=db.board.size, k=db.board.k)
+        for states in db.rounds.values():
+            keys = np.fromiter(states.keys(), dtype=np.int64, count=len(states))
+            slots = array_db._get_or_add_slots(keys)
+            array_db.weights[slots] = [w.weight for w in states.values()]
+            array_db.playcounts[slots] = [w.playcount for w in states.values()]
+        array_db.games_trained = db.games_trained
+        return save_db(array_db, path)
+
+    metadata = {
+        "board_size": db.board.size,
+        "k": db.board.k,
+        "default_weight": db.default_weight,
+        "games_trained": db.games_trained,
+        "weight_adjustments": dict(
+            (outcome_message(outcome), adjustment)
+            for outcome, adjustment in _weight_adjustements.items()),
+        "arrays": {}
+    }
+    offset = 0
+    for name in _file_arrays:
+        array = arrays[name]
+        metadata["arrays"][name] = {
+            "dtype": array.dtype.str,
+            "length": len(array),
+            "offset": offset
+        }
+        offset = _aligned(offset + array.nbytes)
+
+    encoded = json.dumps(metadata).encode("utf-8")
+    data_start = _aligned(_file_header.size + len(encoded))
+
+    temp_path = "{0}.tmp{1}".format(path, os.getpid())
+    with open(temp_path, "wb") as f:
+        f.write(_file_header.pack(_file_magic, _file_version, len(encoded)))
+        f.write(encoded)
+        for name in _file_arrays:
+            f.seek(data_start + metadata["arrays"][name]["offset"])
+            f.write(np.ascontiguousarray(arrays[name]).tobytes())
+        f.truncate(data_start + offset)
+    # Readers that have the old file open keep their mapping.
+    os.replace(temp_path, path)
+
+
+def read_db_metadata(path):
+    """Returns the metadata dictionary of a database file."""
+    with open(path, "rb") as f:
+        header = f.read(_file_header.size)
+        if len(header) != _file_header.size:
+            raise ValueError("{0} is not a database file.".format(path))
+        magic, version, length = _file_header.unpack(header)
+        if magic != _file_magic:
+            raise ValueError("{0} is not a database file.".format(path))
+        if version != _file_version:
+            raise ValueError(
+                "Unsupported database file version {0}.".format(version))
+        metadata = json.loads(f.read(length).decode("utf-8"))
+    metadata["data_start"] = _aligned(_file_header.size + length)
+    return metadata
+
+
+def load_db(path, mode="r"):
+    """Loads a database file as an ArrayDB whose arrays are memory mapped.
+
+    With the default mode 'r' the database is read-only and can be shared
+    by many processes without copying. Mode 'c' gives a private
+    copy-on-write database and 'r+' writes updates back to the file.
+    Adding new gamestates always moves the arrays to memory. Loading
+    databases of boards without lookup tables builds a dictionary of their
+    keys."""
+    metadata = read_db_metadata(path)
+
+    arrays = {}
+    for name in _file_arrays:
+        info = metadata["arrays"][name]
+        if info["length"] == 0:
+            arrays[name] = np.zeros(0, dtype=info["dtype"])
+            continue
+        arrays[name] = np.memmap(
+            path, dtype=np.dtype(info["dtype"]), mode=mode,
+            offset=metadata["data_start"] + info["offset"],
+            shape=(info["length"],))
+
+    return ArrayDB.from_arrays(
+        arrays["keys"], arrays["weights"], arrays["playcounts"],
+        arrays["slots"], default_weight=metadata["default_weight"],
+        games_trained=metadata["games_trained"],
+        board_size=metadata["board_size"], k=metadata["k"])
+
+
+def _aligned(offset):
+    return -(-offset // _file_alignment) * _file_alignment
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+import asyncio
 from gamestate import GameState
 
 
@@ -13,3 +14,45 @@ class Player(object):
             return self.ai.get_next_gamestate(previous_gamestate)
         else:
             raise NotImplementedError("Human player not yet implemented")
+
+    async def get_next_gamestate_async(self, previous_gamestate,
+                                       executor=None):
+        """Awaitable version of get_next_gamestate. The move is computed in
+        executor, the default executor of the event loop if None, so other
+        coroutines keep running while the AI thinks."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            executor, self.get_next_gamestate, previous_gamestate)
+
+
+class RemotePlayer(Player):
+    """Player whose moves arrive from outside the game, for example from a
+    network connection. Moves are put into the moves queue as (row, col)
+    tuples and the player only plays asynchronously.
+
+    Moves to taken or nonexistent cells are passed to the on_invalid
+    coroutine function with an error message, if given, and skipped."""
+    def __init__(self, name, on_invalid=None):
+        super().__init__(name)
+        self.moves = asyncio.Queue()
+        self.on_invalid = on_invalid
+
+    def get_next_gamestate(self, previous_gamestate):
+        raise NotImplementedError(
+            "Remote players only play with get_next_gamestate_async")
+
+    async def get_next_gamestate_async(self, previous_gamestate,
+                                       executor=None):
+        size = previous_gamestate.size
+        while True:
+            row, col = await self.moves.get()
+            if 0 <= row < size and 0 <= col < size:
+                try:
+                    return previous_gamestate.apply_move(row, col)
+                except ValueError as e:
+                    message = str(e)
+            else:
+                message = "Cell ({0}, {1}) is not on the board.".format(
+                    row, col)
+            if self.on_invalid is not None:
+                await self.on_invalid(message)
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+"""Progress reporting for tournaments.
+
+play_tournament keeps a TournamentProgress up to date and passes it to a
+reporter after every game. DotReporter prints a line of dots to stdout
+and LogReporter logs structured records with the throughput, the
+estimated time left, the completion of each pairing and the sizes of the
+players' databases. Other reporters can subclass ProgressReporter."""
+
+import json
+import logging
+import sys
+import time
+from itertools import permutations
+
+
+class TournamentProgress:
+    """Games played in a tournament, in total and for each pairing."""
+    def __init__(self, rounds, players):
+        self.rounds = rounds
+        self.players = list(players)
+        self.pairings = [
+            "{0} vs {1}".format(p1.name, p2.name)
+            for p1, p2 in permutations(self.players, 2)]
+        self.total = rounds * len(self.pairings)
+        self.played = 0
+        self.pairing_played = [0] * len(self.pairings)
+        self.start_time = time.perf_counter()
+
+    def game_played(self, pairing):
+        """Counts a game of the pairing with given index."""
+        self.played += 1
+        self.pairing_played[pairing] += 1
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.start_time
+
+    @property
+    def games_per_second(self):
+        elapsed = self.elapsed
+        return self.played / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def eta(self):
+        """Estimated seconds until the tournament is finished, None before
+        the first game."""
+        games_per_second = self.games_per_second
+        if games_per_second == 0:
+            return None
+        return (self.total - self.played) / games_per_second
+
+    def db_sizes(self):
+        """Returns the number of known states in each player's database."""
+        return dict(
+            (p.name, len(p.ai.db)) for p in self.players
+            if getattr(p.ai, "db", None) is not None)
+
+    def record(self):
+        """Returns the progress as a dictionary. Database sizes are
+        included, so this may take a while for remote databases."""
+        return {
+            "played": self.played,
+            "total": self.total,
+            "fraction": self.played / self.total if self.total else 1.0,
+            "elapsed_seconds": self.elapsed,
+            "games_per_second": self.games_per_second,
+            "eta_seconds": self.eta,
+            "pairings": dict(
+                (name, {"played": played, "total": self.rounds})
+                for name, played in zip(self.pairings, self.pairing_played)),
+            "db_sizes": self.db_sizes()
+        }
+
+
+class ProgressReporter:
+    """Base class for reporters. The methods are called with the
+    TournamentProgress when the tournament starts, after every game and
+    when it has finished."""
+    def start(self, progress):
+        pass
+
+    def update(self, progress):
+        pass
+
+    def finish(self, progress):
+        pass
+
+
+class DotReporter(ProgressReporter):
+    """Prints the number of matches, up to dots dots as the games are
+    played and the throughput at the end."""
+    def __init__(self, dots=50, stream=None):
+        self.dots = dots
+        self.stream = stream
+        self._printed = 0
+
+    def start(self, progress):
+        self._printed = 0
+        print("Running a tournament. Total number of matches to be played "
+              "{0}.".format(progress.total), file=self._stream())
+
+    def update(self, progress):
+        dots = progress.played * self.dots // max(progress.total, 1)
+        if dots > self._printed:
+            print("." * (dots - self._printed), end="", file=self._stream(),
+                  flush=True)
+            self._printed = dots
+
+    def finish(self, progress):
+        print("\nTournament finished, {0} games at {1:.1f} games/s".format(
+            progress.played, progress.games_per_second), file=self._stream())
+
+    def _stream(self):
+        # Stdout is looked up on every print so that redirecting it works.
+        return self.stream if self.stream is not None else sys.stdout
+
+
+class LogReporter(ProgressReporter):
+    """Logs progress records as JSON messages every interval seconds and
+    when the tournament starts and finishes. The record is also attached
+    to the log record as its progress attribute."""
+    def __init__(self, logger=None, interval=10.0, level=logging.INFO):
+        self.logger = logger or logging.getLogger("progress")
+        self.interval = interval
+        self.level = level
+        self._last = 0.0
+
+    def start(self, progress):
+        self._log("start", progress)
+
+    def update(self, progress):
+        if time.monotonic() - self._last >= self.interval:
+            self._log("progress", progress)
+
+    def finish(self, progress):
+        self._log("finish", progress)
+
+    def _log(self, event, progress):
+        record = progress.record()
+        record["event"] = event
+        self.logger.log(self.level, json.dumps(record),
+                        extra={"progress": record})
+        self._last = time.monotonic()
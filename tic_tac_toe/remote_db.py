@@ -0,0 +1,371 @@
+# -*- coding: utf-8 -*-
+
+"""Weight database backed by a shared document store.
+
+RemoteDB has the interface of local_db.DB but keeps its weights in a
+document store, so that several machines can train and play with the same
+weights. Documents are keyed by canonical key and hold the round of the
+gamestate, the sum of its weight adjustments and its play count. The
+weight is the running average of the default weight and the adjustments,
+so updates from different clients are increments that can be applied in
+any order.
+
+Lookups go through a local cache and updates are written back in batches
+when flush is called or enough updates are pending. MemoryStore keeps the
+documents in process and CloudantStore in a Cloudant or CouchDB
+database."""
+
+import queue
+import threading
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+import numpy as np
+from gamestate import GameState, get_board
+from local_db import Weight, _adjustments_of
+
+
+class DocumentStore(ABC):
+    """Base class for the stores used by RemoteDB. Stores map canonical
+    keys to documents of (rounds, adjustments, playcount) and must apply
+    increments atomically, as many clients may update the same keys."""
+    @abstractmethod
+    def get_many(self, keys):
+        """Returns a dictionary from the given keys that are in the store to
+        their (adjustments, playcount) tuples."""
+        pass
+
+    @abstractmethod
+    def increment_many(self, increments):
+        """Adds (adjustments, playcount) increments given as a dictionary
+        from keys to (rounds, adjustments, playcount) tuples, creating the
+        missing documents. Returns the new (adjustments, playcount) tuples
+        of the keys."""
+        pass
+
+    @abstractmethod
+    def keys_for_rounds(self, rounds):
+        """Returns the keys of all documents for the given rounds."""
+        pass
+
+    @abstractmethod
+    def count(self):
+        """Returns the number of documents in the store."""
+        pass
+
+    def close(self):
+        pass
+
+
+class MemoryStore(DocumentStore):
+    """Document store that keeps its documents in a dictionary. It is
+    thread safe and counts the requests made to it, which makes it a stand
+    in for remote stores in tests."""
+    def __init__(self):
+        self.documents = {}
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def get_many(self, keys):
+        with self._lock:
+            self.requests += 1
+            return dict(
+                (key, self.documents[key][1:])
+                for key in keys if key in self.documents)
+
+    def increment_many(self, increments):
+        with self._lock:
+            self.requests += 1
+            result = {}
+            for key, (rounds, adjustments, playcount) in increments.items():
+                old = self.documents.get(key, (rounds, 0.0, 0))
+                document = (rounds, old[1] + adjustments, old[2] + playcount)
+                self.documents[key] = document
+                result[key] = document[1:]
+            return result
+
+    def keys_for_rounds(self, rounds):
+        rounds = set(rounds)
+        with self._lock:
+            self.requests += 1
+            return [key for key, document in self.documents.items()
+                    if document[0] in rounds]
+
+    def count(self):
+        with self._lock:
+            self.requests += 1
+            return len(self.documents)
+
+
+class ConnectionPool:
+    """Pool of at most size connections created with connect. Threads
+    borrow connections with the connection context manager and wait when
+    all of them are in use. Close is called on each connection when the
+    pool is closed."""
+    def __init__(self, connect, size=4, close=None):
+        self.size = size
+        self._connect = connect
+        self._close = close
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def connection(self):
+        connection = self._acquire()
+        try:
+            yield connection
+        finally:
+            self._idle.put(connection)
+
+    def close(self):
+        while self._created:
+            connection = self._idle.get()
+            self._created -= 1
+            if self._close is not None:
+                self._close(connection)
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            create = self._created < self.size
+            if create:
+                self._created += 1
+        if create:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        return self._idle.get()
+
+
+class CloudantStore(DocumentStore):
+    """Document store in a Cloudant or CouchDB database. Documents are
+    fetched with _all_docs and written with _bulk_docs, retrying writes
+    that conflict with other clients. Requires the cloudant package."""
+    def __init__(self, dbname, user_name, password, url, pool_size=4,
+                 max_retries=10):
+        from cloudant.client import Cloudant
+
+        def connect():
+            client = Cloudant(user_name, password, url=url, connect=True)
+            return client, client.get(dbname, remote=True)
+
+        self.max_retries = max_retries
+        self._pool = ConnectionPool(
+            connect, pool_size, close=lambda c: c[0].disconnect())
+
+    def get_many(self, keys):
+        with self._pool.connection() as (client, db):
+            return dict(
+                (key, (doc["adjustments"], doc["playcount"]))
+                for key, doc in self._fetch(db, keys).items())
+
+    def increment_many(self, increments):
+        result = {}
+        with self._pool.connection() as (client, db):
+            pending = dict(increments)
+            for i in range(self.max_retries):
+                if not pending:
+                    return result
+                documents = self._fetch(db, list(pending))
+                updated = {}
+                for key, (rounds, adjustments, playcount) in pending.items():
+                    doc = documents.get(key, {
+                        "_id": str(key),
+                        "rounds": rounds,
+                        "adjustments": 0.0,
+                        "playcount": 0
+                    })
+                    doc["adjustments"] += adjustments
+                    doc["playcount"] += playcount
+                    updated[key] = doc
+                responses = db.bulk_docs(list(updated.values()))
+                conflicts = set(
+                    int(response["id"]) for response in responses
+                    if "error" in response)
+                for key, doc in updated.items():
+                    if key not in conflicts:
+                        result[key] = (doc["adjustments"], doc["playcount"])
+                pending = dict(
+                    (key, pending[key]) for key in conflicts)
+        if pending:
+            raise RuntimeError(
+                "Could not update {0} documents after {1} tries.".format(
+                    len(pending), self.max_retries))
+        return result
+
+    def keys_for_rounds(self, rounds):
+        from cloudant.query import Query
+        with self._pool.connection() as (client, db):
+            query = Query(db, selector={"rounds": {"$in": list(rounds)}},
+                          fields=["_id"])
+            return [int(doc["_id"]) for doc in query.result]
+
+    def count(self):
+        with self._pool.connection() as (client, db):
+            return db.doc_count()
+
+    def close(self):
+        self._pool.close()
+
+    def _fetch(self, db, keys):
+        # Returns a dictionary from keys to the documents that exist.
+        rows = db.all_docs(keys=[str(key) for key in keys],
+                           include_docs=True)["rows"]
+        return dict(
+            (int(row["key"]), row["doc"]) for row in rows
+            if row.get("doc") is not None)
+
+
+class RemoteDB:
+    """Database with the interface of DB that keeps weights in a
+    DocumentStore.
+
+    Documents that have been looked up are cached locally and updates are
+    collected into pending increments. Pending increments are written in
+    batches of batch_size documents when flush is called, when more than
+    max_pending keys have pending increments, and when the database is
+    closed. Writing returns the latest documents, so the cache also picks
+    up updates from other clients. Call refresh to drop the cache."""
+    def __init__(self, store, default_weight=0.7, board_size=3, k=None,
+                 batch_size=500, max_pending=10000):
+        self.store = store
+        self.board = get_board(board_size, k)
+        self.default_weight = default_weight
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.games_trained = 0
+        # Keys map to [adjustments, playcount] lists.
+        self._cache = {}
+        self._pending = {}
+        self._lock = threading.RLock()
+
+    def add_or_update(self, gamestate, result):
+        """If the gamestate is already in the database, its values
+        will be updated, otherwise the state is added to the
+        database.
+
+        Result is either an outcome code or an outcome message."""
+        self.update_many([gamestate.canonical_key], [result])
+
+    def update_many(self, ids, results):
+        """Updates the gamestates with given canonical keys. Results
+        are given for each key or as a single result for all of them."""
+        ids = np.asarray(ids).tolist()
+        adjustments = _adjustments_of(results, len(ids)).tolist()
+        with self._lock:
+            for key, adjustment in zip(ids, adjustments):
+                pending = self._pending.get(key)
+                if pending is None:
+                    pending = self._pending[key] = [0.0, 0]
+                pending[0] += adjustment
+                pending[1] += 1
+            if len(self._pending) > self.max_pending:
+                self.flush()
+
+    def add_weights(self, ids, deltas, playcounts):
+        """Adds deltas to the weights and playcounts to the play counts of
+        the gamestates with given unique canonical keys. Weights are kept
+        as sums of adjustments, so the adjustments are incremented by the
+        amount that moves the weight by delta at the new play count.
+        Increments are computed from the weights known to this client."""
+        ids = np.asarray(ids).tolist()
+        with self._lock:
+            self._fetch(ids)
+            for key, delta, playcount in zip(
+                    ids, np.asarray(deltas).tolist(),
+                    np.asarray(playcounts).tolist()):
+                adjustments, total = self._totals(key)
+                weight = (self.default_weight + adjustments) / (total + 1)
+                pending = self._pending.get(key)
+                if pending is None:
+                    pending = self._pending[key] = [0.0, 0]
+                pending[0] += ((weight + delta) * (total + playcount + 1) -
+                               self.default_weight - adjustments)
+                pending[1] += playcount
+            if len(self._pending) > self.max_pending:
+                self.flush()
+
+    def get_weighted_states(self, rounds=[]):
+        """Returns all known states for given rounds."""
+        self.flush()
+        return [GameState.from_code(key, self.board.size, self.board.k)
+                for key in self.store.keys_for_rounds(rounds)]
+
+    def get_weight(self, gamestate):
+        """Returns weight that corresponds to the given gamestate.
+
+        If gamestate is not in database, default value is returned."""
+        key = gamestate.canonical_key
+        with self._lock:
+            self._fetch([key])
+            adjustments, playcount = self._totals(key)
+        return Weight(
+            (self.default_weight + adjustments) / (playcount + 1), playcount)
+
+    def get_weights(self, ids):
+        """Returns an array of weights for given canonical keys."""
+        ids = np.asarray(ids).tolist()
+        with self._lock:
+            self._fetch(ids)
+            totals = np.array(
+                [self._totals(key) for key in ids], dtype=np.float64)
+        totals = totals.reshape(len(ids), 2)
+        return (self.default_weight + totals[:, 0]) / (totals[:, 1] + 1)
+
+    def flush(self):
+        """Writes the pending increments to the store."""
+        with self._lock:
+            items = list(self._pending.items())
+            for start in range(0, len(items), self.batch_size):
+                batch = items[start:start + self.batch_size]
+                documents = self.store.increment_many(dict(
+                    (key, (self.board.rounds_played_of_key(key),
+                           adjustments, playcount))
+                    for key, (adjustments, playcount) in batch))
+                for key, document in documents.items():
+                    self._cache[key] = list(document)
+                    del self._pending[key]
+
+    def refresh(self):
+        """Drops the cached documents, so they are fetched again."""
+        with self._lock:
+            self._cache.clear()
+
+    def close(self):
+        self.flush()
+        self.store.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        self.flush()
+        return self.store.count()
+
+    def _fetch(self, keys):
+        # Fetches the keys missing from the cache in batches. Keys that
+        # are not in the store are cached with zero totals.
+        missing = list(dict.fromkeys(
+            key for key in keys if key not in self._cache))
+        for start in range(0, len(missing), self.batch_size):
+            batch = missing[start:start + self.batch_size]
+            documents = self.store.get_many(batch)
+            for key in batch:
+                self._cache[key] = list(documents.get(key, (0.0, 0)))
+
+    def _totals(self, key):
+        adjustments, playcount = self._cache[key]
+        pending = self._pending.get(key)
+        if pending is not None:
+            adjustments += pending[0]
+            playcount += pending[1]
+        return adjustments, playcount
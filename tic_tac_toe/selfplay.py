@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+"""Batched self-play for training WeightedGameStateAI.
+
+Games are played in lockstep on an (N, 9) array of boards where 0 is an
+empty cell, 1 is 'X' and 2 is 'O'. Every ply is a handful of NumPy
+operations over all unfinished games."""
+
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from gamestate import ONGOING, canonical_keys, code_outcomes
+
+
+def self_play(db, game_count, rng=None, noise=0.1):
+    """Plays game_count games where both players select moves the same
+    way as WeightedGameStateAI: each candidate gamestate's weight is
+    multiplied by normally distributed noise around 1.0 and 'X' picks the
+    largest while 'O' picks the smallest randomized weight.
+
+    Db needs a get_weights method, such as local_db.ArrayDB, and a 3X3
+    board with three in a row to win. Returns a (game_count, 9) array of
+    the moved cell indexes, padded with -1 after the end of the game, and
+    an array of the outcome codes."""
+    if (db.board.size, db.board.k) != (3, 3):
+        raise ValueError(
+            "Self-play only supports 3X3 boards with k 3, not {0}X{0} "
+            "with k {1}.".format(db.board.size, db.board.k))
+    if rng is None:
+        rng = np.random.default_rng()
+    cell_count = db.board.cell_count
+    powers = db.board.power_array
+
+    boards = np.zeros((game_count, cell_count), dtype=np.int8)
+    codes = np.zeros(game_count, dtype=np.int64)
+    moves = np.full((game_count, cell_count), -1, dtype=np.int8)
+    outcomes = np.full(game_count, ONGOING, dtype=np.int8)
+
+    for ply in range(cell_count):
+        active = np.flatnonzero(outcomes == ONGOING)
+        if len(active) == 0:
+            break
+        mark = 1 if ply % 2 == 0 else 2
+
+        legal = boards[active] == 0
+        child_codes = codes[active, np.newaxis] + mark * powers
+        weights = db.get_weights(
+            canonical_keys(np.where(legal, child_codes, 0)).ravel())
+        randomized = rng.normal(
+            loc=1.0, scale=noise, size=legal.shape) * weights.reshape(legal.shape)
+
+        if mark == 1:
+            cells = np.argmax(np.where(legal, randomized, -np.inf), axis=1)
+        else:
+            cells = np.argmin(np.where(legal, randomized, np.inf), axis=1)
+
+        boards[active, cells] = mark
+        codes[active] += mark * powers[cells]
+        moves[active, ply] = cells
+        outcomes[active] = code_outcomes(codes[active])
+
+    return moves, outcomes
+
+
+def train(ai, game_count, batch_size=10000, rng=None):
+    """Trains a WeightedGameStateAI by self-play in batches of batch_size
+    games. Each batch is played with the weights learned from the previous
+    batches. Returns the number of X wins, O wins and draws."""
+    if rng is None:
+        rng = np.random.default_rng()
+
+    totals = np.zeros(4, dtype=np.int64)
+    for start in range(0, game_count, batch_size):
+        moves, outcomes = self_play(
+            ai.db, min(batch_size, game_count - start), rng=rng)
+        ai.update_db_many(moves, outcomes)
+        totals += np.bincount(outcomes, minlength=4)
+
+    return {
+        "X won!": int(totals[1]),
+        "O won!": int(totals[2]),
+        "Draw.": int(totals[3])
+    }
+
+
+def train_parallel(ai, game_count, workers=None, batch_size=1000, seed=None):
+    """Trains a WeightedGameStateAI whose database is a shared_db.SharedDB
+    in a pool of workers processes. Each worker plays batches of
+    batch_size games and updates the shared weights in place, so the
+    batches of the other workers are played with the weights learned so
+    far. Returns the number of X wins, O wins and draws."""
+    if not getattr(ai.db, "shared", False):
+        raise ValueError("Parallel training needs a shared_db.SharedDB.")
+
+    games_trained = ai.db.games_trained
+    sizes = [min(batch_size, game_count - start)
+             for start in range(0, game_count, batch_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    totals = np.zeros(4, dtype=np.int64)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_trainer,
+                             initargs=(ai,)) as executor:
+        for counts in executor.map(_train_batch, zip(sizes, seeds)):
+            totals += counts
+    # Concurrent increments of the game count may have been lost.
+    ai.db.games_trained = games_trained + game_count
+
+    return {
+        "X won!": int(totals[1]),
+        "O won!": int(totals[2]),
+        "Draw.": int(totals[3])
+    }
+
+
+# AI of a training worker process, set by _init_trainer.
+_trainer = {}
+
+
+def _init_trainer(ai):
+    _trainer["ai"] = ai
+
+
+def _train_batch(task):
+    # Plays and learns a batch of games, returns the counts of outcomes.
+    size, seed = task
+    ai = _trainer["ai"]
+    moves, outcomes = self_play(ai.db, size, rng=np.random.default_rng(seed))
+    ai.update_db_many(moves, outcomes)
+    return np.bincount(outcomes, minlength=4)
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+
+"""Game server where people play against an AI over TCP.
+
+Clients and the server exchange JSON objects, one per line. Clients send
+
+    {"type": "new_game", "side": "X"}     start a game, side is X or O
+    {"type": "move", "row": 1, "col": 2}  mark a cell in the current game
+    {"type": "quit"}                      close the connection
+
+and the server answers with
+
+    {"type": "state", "board": ["X--", "-O-", "---"], "next": "X",
+     "side": "X", "outcome": null}
+    {"type": "error", "message": "..."}
+
+A state is sent for every gamestate of a game, starting from the empty
+board. The last state of a game has its outcome message set.
+
+Run with python server.py --port 8765 --db weights.db."""
+
+import argparse
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+from player import Player, RemotePlayer
+from tictactoe import TicTacToe
+
+
+class GameServer:
+    """Asyncio server that plays every connection against the same AI.
+
+    Each connection runs its own play_game_async coroutine, so thousands
+    of games can be in progress at once. AI moves are computed in a pool
+    of worker threads, so a slow move does not hold up other games.
+
+    The games only read the AI's weights unless learn is set, in which
+    case the database is updated after every game while other threads may
+    be reading it."""
+    def __init__(self, ai, board_size=3, k=None, workers=4, learn=False):
+        self.ai = ai
+        self.game = TicTacToe(board_size=board_size, k=k)
+        self.learn = learn
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.games_played = 0
+        self._server = None
+
+    async def start(self, host="127.0.0.1", port=0):
+        """Starts listening and returns the asyncio server. Port 0 picks
+        a free port."""
+        self._server = await asyncio.start_server(
+            self._handle_connection, host, port)
+        return self._server
+
+    async def serve_forever(self, host="127.0.0.1", port=8765):
+        server = await self.start(host, port)
+        async with server:
+            await server.serve_forever()
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        self.executor.shutdown(wait=False)
+
+    @property
+    def port(self):
+        return self._server.sockets[0].getsockname()[1]
+
+    async def _handle_connection(self, reader, writer):
+        session = _Session(self, writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    message = json.loads(line)
+                    if not isinstance(message, dict):
+                        raise ValueError("Messages must be JSON objects.")
+                    if not await session.handle(message):
+                        break
+                except ValueError as e:
+                    await session.send(
+                        {"type": "error", "message": str(e)})
+        except ConnectionError:
+            pass
+        finally:
+            session.stop()
+            writer.close()
+
+
+class _Session:
+    # Games of one connection. At most one game is played at a time.
+    def __init__(self, server, writer):
+        self.server = server
+        self.writer = writer
+        self.human = None
+        self.task = None
+
+    async def handle(self, message):
+        # Returns False when the connection should be closed.
+        kind = message.get("type")
+        if kind == "quit":
+            return False
+        if kind == "new_game":
+            if self.task is not None and not self.task.done():
+                raise ValueError("A game is already in progress.")
+            side = message.get("side", "X")
+            if side not in ("X", "O"):
+                raise ValueError("Side must be X or O.")
+            self.start_game(side)
+        elif kind == "move":
+            if self.task is None or self.task.done():
+                raise ValueError("No game in progress.")
+            try:
+                move = int(message["row"]), int(message["col"])
+            except (KeyError, TypeError):
+                raise ValueError("Moves need integer row and col.")
+            self.human.moves.put_nowait(move)
+        else:
+            raise ValueError("Unknown message type {0}.".format(kind))
+        return True
+
+    def start_game(self, side):
+        server = self.server
+        self.human = RemotePlayer("human", on_invalid=self.send_error)
+        computer = Player("computer", server.ai)
+        players = (self.human, computer) if side == "X" else (
+            computer, self.human)
+
+        async def send_state(gamestate):
+            outcome = gamestate.is_game_over()
+            await self.send({
+                "type": "state",
+                "board": ["".join(row) for row in gamestate.state.tolist()],
+                "next": gamestate.next_to_move(),
+                "side": side,
+                "outcome": outcome[1] if outcome[0] else None
+            })
+
+        async def play():
+            await server.game.play_game_async(
+                *players, executor=server.executor, on_move=send_state,
+                update=server.learn)
+            server.games_played += 1
+
+        self.task = asyncio.ensure_future(play())
+
+    async def send(self, message):
+        self.writer.write(json.dumps(message).encode() + b"\n")
+        await self.writer.drain()
+
+    async def send_error(self, message):
+        await self.send({"type": "error", "message": message})
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+
+
+if __name__ == "__main__":
+    from AI import WeightedGameStateAI
+    from local_db import load_db
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--db", help="weights saved with local_db.save_db")
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    db = load_db(args.db) if args.db else None
+    ai = WeightedGameStateAI(update_database=False, db=db)
+    server = GameServer(ai, ai.db.board.size, ai.db.board.k, args.workers)
+    asyncio.run(server.serve_forever(args.host, args.port))
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+
+"""Weight table in shared memory for training in several processes.
+
+SharedDB is a local_db.DenseDB whose weights, play counts and game count
+live in a multiprocessing.shared_memory block. Copies of it in other
+processes, made by pickling it or by forking, read and update the same
+weights in place, so workers of a parallel tournament or of
+selfplay.train_parallel all learn from each other's games as they are
+played.
+
+Without locks concurrent updates of the same state may overwrite each
+other and lose an update, as in Hogwild training. With stripes locks the
+states are divided among the locks by their ids and every update holds
+the locks of the states it changes. Reads never lock."""
+
+import contextlib
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+from local_db import DenseDB
+from state_graph import get_graph
+
+
+# The block starts with the game count and the default weight, followed
+# by the weights and the play counts.
+_header_size = 16
+
+
+class SharedDB(DenseDB):
+    """DenseDB in shared memory.
+
+    The database is pickled as the name of its memory block and its
+    locks, so databases with locks can only be passed to processes as
+    they are started, for example in the initargs of a process pool.
+    Attach opens the block of another process without locks.
+
+    Increments of games_trained are not locked and may be lost when
+    processes train at the same time. Close the database when done, the
+    process that created it also frees the memory."""
+    shared = True
+
+    def __init__(self, default_weight=0.7, board_size=3, k=None,
+                 graph=None, stripes=0):
+        self.graph = graph if graph is not None else get_graph(
+            board_size, k)
+        self._locks = [multiprocessing.Lock() for i in range(stripes)]
+        self._memory = shared_memory.SharedMemory(
+            create=True, size=_header_size + 8 * len(self.graph))
+        self._owner = True
+        self._map()
+        self._header[0] = 0
+        self._default_weight[0] = default_weight
+        self.weights[:] = default_weight
+        self.playcounts[:] = 0
+
+    @classmethod
+    def attach(cls, name, board_size=3, k=None, graph=None):
+        """Opens the memory block of a SharedDB created by another
+        process. Updates through the returned database take no locks."""
+        db = cls.__new__(cls)
+        db.graph = graph if graph is not None else get_graph(board_size, k)
+        db._locks = []
+        db._memory = _open_memory(name)
+        db._owner = False
+        db._map()
+        return db
+
+    def _map(self):
+        self.board = self.graph.board
+        count = len(self.graph)
+        buffer = self._memory.buf
+        self._header = np.ndarray(1, np.int64, buffer, 0)
+        self._default_weight = np.ndarray(1, np.float64, buffer, 8)
+        self.weights = np.ndarray(count, np.float32, buffer, _header_size)
+        self.playcounts = np.ndarray(
+            count, np.uint32, buffer, _header_size + 4 * count)
+
+    def __getstate__(self):
+        return {
+            "name": self.name,
+            "board_size": self.board.size,
+            "k": self.board.k,
+            "locks": self._locks
+        }
+
+    def __setstate__(self, state):
+        self.graph = get_graph(state["board_size"], state["k"])
+        self._locks = state["locks"]
+        self._memory = _open_memory(state["name"])
+        self._owner = False
+        self._map()
+
+    @property
+    def name(self):
+        return self._memory.name
+
+    @property
+    def stripes(self):
+        return len(self._locks)
+
+    @property
+    def default_weight(self):
+        return self._default_weight[0].item()
+
+    @property
+    def games_trained(self):
+        return self._header[0].item()
+
+    @games_trained.setter
+    def games_trained(self, value):
+        self._header[0] = value
+
+    def update_many(self, ids, results):
+        with self._locked(ids):
+            super().update_many(ids, results)
+
+    def add_weights(self, ids, deltas, playcounts):
+        with self._locked(ids):
+            super().add_weights(ids, deltas, playcounts)
+
+    @contextlib.contextmanager
+    def _locked(self, ids):
+        # Holds the locks of the stripes of given keys, taken in order so
+        # that updates never wait for each other in a cycle.
+        if not self._locks:
+            yield
+            return
+        stripes = np.unique(self.graph.ids_of(ids) % len(self._locks))
+        locks = [self._locks[stripe] for stripe in stripes.tolist()]
+        for lock in locks:
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    def close(self):
+        """Detaches this process from the shared memory, and frees it if
+        this process created it. Other processes keep their mappings."""
+        if self._memory is None:
+            return
+        # The views have to go before the block can be closed.
+        self._header = self._default_weight = None
+        self.weights = self.playcounts = None
+        self._memory.close()
+        if self._owner:
+            self._memory.unlink()
+        self._memory = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _open_memory(name):
+    # Blocks opened by name are left to the process that created them.
+    # Older Pythons always track them, which is harmless for processes
+    # that share the creator's resource tracker.
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        return shared_memory.SharedMemory(name)
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+
+"""Graph of every gamestate reachable from the empty board.
+
+Each canonical gamestate gets a dense id. Ids are ordered by rounds
+played and then by canonical key, so the states of a round are a
+contiguous range. The graph stores the key, outcome and rounds played of
+every id in flat arrays and the moves from every ongoing state in CSR
+form: the moves of state i are successor_ids[indptr[i]:indptr[i + 1]],
+made in successor_cells of the canonical orientation of state i. A table
+indexed by canonical key maps keys to ids.
+
+Graphs are only built for boards with lookup tables. The 3X3 graph has
+765 states and 2096 moves to distinct successors between them, and it
+is cached to disk by get_graph."""
+
+import os
+import numpy as np
+from gamestate import get_board, ONGOING
+
+
+# Version of the cached graph files, increased when their layout changes.
+_graph_version = 1
+
+_cache_directory = os.environ.get(
+    "TIC_TAC_TOE_CACHE",
+    os.path.join(os.path.expanduser("~"), ".cache", "ml_tic_tac_toe"))
+
+_graphs = {}
+
+
+class StateGraph:
+    """Reachable canonical gamestates of a board with dense ids.
+
+    Moves that lead to the same canonical successor are stored once, so
+    every successor of a state appears once in its row."""
+    def __init__(self, board, keys, rounds_played, outcomes, indptr,
+                 successor_ids, successor_cells):
+        self.board = board
+        self.keys = keys
+        self.rounds_played = rounds_played
+        self.outcomes = outcomes
+        self.indptr = indptr
+        self.successor_ids = successor_ids
+        self.successor_cells = successor_cells
+        self.id_table = np.full(3 ** board.cell_count, -1, dtype=np.int32)
+        self.id_table[keys] = np.arange(len(keys), dtype=np.int32)
+        self.round_starts = np.searchsorted(
+            rounds_played, np.arange(board.cell_count + 2))
+
+    @classmethod
+    def build(cls, board):
+        """Enumerates the reachable states of a board round by round."""
+        if not board.has_tables:
+            raise ValueError(
+                "State graphs need a board with lookup tables, at most "
+                "3X3.")
+        powers = board.power_array
+        frontier = np.zeros(1, dtype=np.int64)
+        rounds = [frontier]
+        edges = []
+        for rounds_played in range(board.cell_count):
+            ongoing = frontier[board.outcome_codes[frontier] == ONGOING]
+            empty = ongoing[:, np.newaxis] // powers % 3 == 0
+            parents, cells = np.nonzero(empty)
+            mark = 1 + rounds_played % 2
+            successors = board.canonical_codes[
+                ongoing[parents] + mark * powers[cells]]
+            edges.append((ongoing[parents], successors, cells))
+            frontier = np.unique(successors)
+            rounds.append(frontier)
+
+        keys = np.concatenate(rounds)
+        rounds_played = np.repeat(
+            np.arange(len(rounds), dtype=np.uint8),
+            [len(r) for r in rounds])
+        id_table = np.full(3 ** board.cell_count, -1, dtype=np.int32)
+        id_table[keys] = np.arange(len(keys), dtype=np.int32)
+
+        parents = id_table[np.concatenate([e[0] for e in edges])]
+        successors = id_table[np.concatenate([e[1] for e in edges])]
+        cells = np.concatenate([e[2] for e in edges])
+        # Keep the first cell leading to each distinct successor, rows
+        # ordered by parent id and then by successor id.
+        order = np.lexsort((cells, successors, parents))
+        parents, successors, cells = (
+            parents[order], successors[order], cells[order])
+        first = np.ones(len(parents), dtype=bool)
+        first[1:] = ((parents[1:] != parents[:-1]) |
+                     (successors[1:] != successors[:-1]))
+        parents, successors, cells = (
+            parents[first], successors[first], cells[first])
+        indptr = np.zeros(len(keys) + 1, dtype=np.int32)
+        indptr[1:] = np.cumsum(np.bincount(parents, minlength=len(keys)))
+
+        return cls(board, keys, rounds_played,
+                   board.outcome_codes[keys].astype(np.int8), indptr,
+                   successors.astype(np.int32), cells.astype(np.int8))
+
+    def save(self, path):
+        """Writes the graph to a .npz file."""
+        np.savez(
+            path, version=_graph_version, size=self.board.size,
+            k=self.board.k, keys=self.keys, rounds_played=self.rounds_played,
+            outcomes=self.outcomes, indptr=self.indptr,
+            successor_ids=self.successor_ids,
+            successor_cells=self.successor_cells)
+
+    @classmethod
+    def load(cls, path):
+        """Reads a graph written by save."""
+        with np.load(path) as data:
+            if int(data["version"]) != _graph_version:
+                raise ValueError(
+                    "Unsupported state graph version {0}.".format(
+                        int(data["version"])))
+            return cls(
+                get_board(int(data["size"]), int(data["k"])),
+                data["keys"], data["rounds_played"], data["outcomes"],
+                data["indptr"], data["successor_ids"],
+                data["successor_cells"])
+
+    def __len__(self):
+        return len(self.keys)
+
+    def ids_of(self, keys):
+        """Returns the ids of given canonical keys, -1 for keys of
+        unreachable states."""
+        return self.id_table[np.asarray(keys, dtype=np.int64)]
+
+    def successors(self, state_id):
+        """Returns the ids of the distinct successors of a state and the
+        cells, in the canonical orientation, that lead to them."""
+        start, end = self.indptr[state_id], self.indptr[state_id + 1]
+        return (self.successor_ids[start:end],
+                self.successor_cells[start:end])
+
+    def round_ids(self, rounds_played):
+        """Returns the range of ids of the states of a round."""
+        return range(self.round_starts[rounds_played],
+                     self.round_starts[rounds_played + 1])
+
+    def is_terminal(self, ids):
+        return self.outcomes[ids] != ONGOING
+
+
+def get_graph(size=3, k=None, cache=True):
+    """Returns the shared state graph of a board. The graph is read from
+    the cache directory, set with the TIC_TAC_TOE_CACHE environment
+    variable, and written there after it has been built. Without cache the
+    graph is always built."""
+    board = get_board(size, k)
+    graph = _graphs.get(board)
+    if graph is not None:
+        return graph
+
+    path = os.path.join(_cache_directory, "state_graph_{0}_{1}.npz".format(
+        board.size, board.k))
+    if cache and os.path.exists(path):
+        try:
+            graph = StateGraph.load(path)
+        except (OSError, ValueError, KeyError):
+            graph = None
+    if graph is None:
+        graph = StateGraph.build(board)
+        if cache:
+            try:
+                os.makedirs(_cache_directory, exist_ok=True)
+                # Written under a temporary name so that concurrent
+                # processes never read a partial file.
+                temporary = "{0}.{1}.tmp.npz".format(path, os.getpid())
+                graph.save(temporary)
+                os.replace(temporary, path)
+            except OSError:
+                pass
+    _graphs[board] = graph
+    return graph
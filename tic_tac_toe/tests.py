@@ -1,7 +1,37 @@
 import unittest
+from unittest import mock
 import array_comparison as ac
+import gamestate
 from gamestate import GameState
-from AI import get_possible_states
+from AI import (get_possible_states, SuccessorCache, WeightedGameStateAI,
+                RandomAI, SolverAI)
+from local_db import (DB, ArrayDB, DenseDB, BoundedDB, SQLiteDB, save_db,
+                      load_db, read_db_metadata, update_from_games)
+from player import Player
+from tictactoe import TicTacToe
+import selfplay
+import learning
+import game_records
+import remote_db
+import benchmarks
+import server
+import inference
+import instrumentation
+import progress
+import state_graph
+import shared_db
+import cli
+import subprocess
+import sys
+import asyncio
+import contextlib
+import copy
+import io
+import json
+import os
+import pickle
+import sqlite3
+import tempfile
 import numpy as np
 from typing import List, Any
 
@@ -78,6 +108,24 @@ class TestArrayComparison(unittest.TestCase):
         self.assertFalse(ac.are_sqr_arrays_equal(x, x_partial_rotation))
         self.assertFalse(ac.are_sqr_arrays_equal(x, x_partial_mirror))
 
+    def test_canonicalize(self):
+        x = np.array([
+            [1, 0, 1],
+            [2, 1, 0],
+            [2, 0, 0]
+        ])
+        boards = np.array([a.ravel() for a in ac.generate_equal_arrays(x)])
+        codes, transforms = ac.canonicalize(boards)
+        self.assertEqual(1, len(set(codes.tolist())))
+        for board, t in zip(boards, transforms):
+            self.assertEqual(
+                codes[0], ac.ternary_codes(board[ac.symmetry_permutations(3)[t]]))
+
+        canonical_codes, _ = ac.canonical_table(3)
+        self.assertTrue(np.array_equal(
+            codes, canonical_codes[ac.ternary_codes(boards)]))
+        self.assertRaises(ValueError, lambda: ac.canonicalize([[0, 1, 2]]))
+
 
 class TestGameState(unittest.TestCase):
     def test_gamestate(self):
@@ -124,6 +172,105 @@ class TestGameState(unittest.TestCase):
         self.assertTrue(b)
         self.assertEqual(m, "X won!")
 
+    def test_outcomes(self):
+        boards = [
+            [0, 0, 0, 0, 0, 0, 0, 0, 0],
+            [1, 2, 0, 1, 2, 0, 1, 0, 0],
+            [1, 1, 2, 0, 2, 1, 2, 0, 0],
+            [1, 2, 1, 1, 2, 2, 2, 1, 1]
+        ]
+        self.assertEqual(
+            [gamestate.ONGOING, gamestate.X_WON, gamestate.O_WON,
+             gamestate.DRAW],
+            gamestate.outcomes(boards).tolist())
+
+        gs = GameState([
+            ["X", "O", "X"],
+            ["X", "O", "O"],
+            ["O", "X", "X"]
+        ])
+        self.assertEqual(gamestate.DRAW, gs.outcome())
+        self.assertEqual((True, "Draw."), gs.is_game_over())
+
+    def test_large_boards(self):
+        gs = GameState([
+            ["X", "X", "X", "-"],
+            ["O", "O", "-", "-"],
+            ["-", "-", "-", "-"],
+            ["-", "-", "-", "-"]
+        ], k=3)
+        self.assertEqual(4, gs.size)
+        self.assertEqual(gamestate.X_WON, gs.outcome())
+        self.assertEqual(gamestate.ONGOING, GameState(gs.state).outcome())
+        self.assertEqual(gs, gs.rotated(1))
+        self.assertNotEqual(gs, GameState(gs.state))
+
+        # Five in a row on a diagonal of a gomoku board
+        gs = GameState.empty(15, k=5)
+        for x_cell, o_cell in zip(range(4), range(4)):
+            gs = gs.apply_move(x_cell + 3, x_cell + 2)
+            gs = gs.apply_move(0, o_cell)
+        self.assertEqual(gamestate.ONGOING, gs.outcome())
+        won = gs.apply_move(7, 6)
+        self.assertEqual(gamestate.X_WON, won.outcome())
+        self.assertEqual(
+            gamestate.X_WON,
+            GameState(won.state, k=5).outcome())
+        self.assertEqual(won.rotated(3).canonical_key, won.canonical_key)
+
+        cells, keys = gs.successor_keys()
+        self.assertEqual(
+            [gs.apply_move(*divmod(c, 15)).canonical_key for c in cells],
+            keys.tolist())
+        # Keys of 7X7 boards are above and below 2 ** 63, which must not
+        # turn them into floats.
+        rng = np.random.default_rng(0)
+        for i in range(20):
+            gs = GameState.empty(7, k=5)
+            while gs.outcome() == gamestate.ONGOING:
+                cells, keys = gs.successor_keys()
+                self.assertEqual(
+                    [gs.apply_move(*divmod(c, 7)).canonical_key
+                     for c in cells.tolist()],
+                    keys.tolist())
+                gs = gs.apply_move(*divmod(int(rng.choice(cells)), 7))
+        self.assertEqual(
+            [gamestate.O_WON],
+            gamestate.outcomes([[2, 2, 2, 2, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0, 1]],
+                               k=4).tolist())
+
+    def test_advance_to(self):
+        gs = GameState().apply_move(1, 1)
+        next_gs = GameState([
+            ["X", "-", "-"],
+            ["-", "X", "-"],
+            ["O", "-", "O"]
+        ])
+        self.assertRaises(ValueError, lambda: gs.advance_to(next_gs))
+        self.assertRaises(ValueError, lambda: gs.advance_to(gs))
+
+        next_gs = GameState([
+            ["-", "-", "-"],
+            ["-", "X", "-"],
+            ["O", "-", "-"]
+        ])
+        advanced = gs.advance_to(next_gs)
+        self.assertEqual(next_gs.code, advanced.code)
+        self.assertEqual(6, gs.get_move(advanced))
+
+    def test_apply_move(self):
+        gs = GameState().apply_move(1, 1).apply_move(0, 2)
+        self.assertEqual(2, gs.rounds_played)
+        self.assertEqual("X", gs.next_to_move())
+        self.assertEqual({"X": 1, "O": 1, "-": 7}, gs.char_counts)
+        self.assertTrue(np.array_equal(gs.state, [
+            ["-", "-", "O"],
+            ["-", "X", "-"],
+            ["-", "-", "-"]
+        ]))
+        self.assertEqual((0, 1, 3, 5, 6, 7, 8), gs.empty_cells())
+        self.assertRaises(ValueError, lambda: gs.apply_move(1, 1))
+
 
 class TestAI(unittest.TestCase):
     def test_get_possible_states(self):
@@ -165,6 +312,798 @@ class TestAI(unittest.TestCase):
             ["-", "-", "X"]
         ], res))
 
+    def test_successor_cache(self):
+        cache = SuccessorCache(maxsize=2)
+        gs = GameState()
+        successors = cache.get(gs)
+        self.assertEqual(9, len(successors))
+        self.assertEqual((0, 0), successors[0][0])
+        self.assertTrue(successors[0][1] is cache.get(gs)[0][1])
+        self.assertEqual(3, len(cache.get(gs, only_unique=True)))
+        self.assertEqual(2, cache.cache_info()["size"])
+
+        cache.get(successors[0][1])
+        info = cache.cache_info()
+        self.assertEqual((1, 3, 2), (info["hits"], info["misses"], info["size"]))
+
+        # Large boards are cached too, within maxsize.
+        cache.get(GameState.empty(7))
+        cache.get(GameState.empty(7))
+        info = cache.cache_info()
+        self.assertEqual((2, 4, 2), (info["hits"], info["misses"], info["size"]))
+
+    def test_mixed_board_sizes(self):
+        cache = SuccessorCache()
+        self.assertEqual(9, len(cache.get(GameState.empty(3))))
+        self.assertEqual(4, len(cache.get(GameState.empty(2))))
+        self.assertEqual(2, cache.get(GameState.empty(3, 2))[0][1].board.k)
+        self.assertEqual(16, len(cache.get(GameState.empty(4, 3))))
+        self.assertEqual(4, cache.get(GameState.empty(4, 4))[0][1].board.k)
+        self.assertEqual(5, cache.cache_info()["size"])
+
+        players = (Player("r1", RandomAI(seed=0)), Player("r2", RandomAI(seed=1)))
+        for size in (3, 4, 3):
+            outcome = TicTacToe(board_size=size).play_game(*players)
+            self.assertIn(outcome, ("X won!", "O won!", "Draw."))
+
+    def test_seeded_weighted_ai(self):
+        def play(seed):
+            ai = WeightedGameStateAI(update_database=False, seed=seed)
+            gs = GameState()
+            while gs.outcome() == gamestate.ONGOING:
+                gs = ai.get_next_gamestate(gs)
+            return gs.code
+
+        self.assertEqual(play(5), play(5))
+        ai = WeightedGameStateAI()
+        finished = GameState([
+            ["X", "X", "X"],
+            ["O", "O", "-"],
+            ["-", "-", "-"]
+        ])
+        self.assertEqual(
+            {"outcome": "X won!"}, ai.get_next_gamestate(finished))
+
+    def test_batched_moves(self):
+        ai = WeightedGameStateAI(db=ArrayDB(), seed=0)
+        selfplay.train(ai, 200, batch_size=50, rng=np.random.default_rng(0))
+        finished = gamestate.replay([0, 3, 1, 4, 2])[-1]
+        gamestates = [gs for gs in gamestate.replay([4, 0, 8, 2, 6])
+                      if gs.outcome() == gamestate.ONGOING] + [finished]
+
+        results = ai.get_next_gamestates(gamestates)
+        self.assertEqual({"outcome": "X won!"}, results[-1])
+        for gs, next_gamestate in zip(gamestates, results[:-1]):
+            gs.advance_to(next_gamestate)
+
+        with inference.BatchingAI(ai, max_batch_size=8,
+                                  max_wait_us=20000) as batching:
+            futures = [batching.submit(gs) for gs in gamestates * 4]
+            for gs, future in zip(gamestates * 4, futures):
+                if gs is finished:
+                    self.assertEqual({"outcome": "X won!"}, future.result())
+                else:
+                    gs.advance_to(future.result())
+            self.assertEqual(len(futures), batching.requests)
+            self.assertLess(batching.batches, len(futures))
+            game = TicTacToe()
+            game.play_game(Player("batched", batching),
+                           Player("random", RandomAI()))
+
+        with self.assertRaises(ValueError):
+            ai.get_next_gamestates([GameState(), GameState.empty(4)])
+        # Requests for different boards are answered separately.
+        mixed = [GameState(), GameState.empty(4), GameState().apply_move(1, 1)]
+        with inference.BatchingAI(WeightedGameStateAI(seed=0),
+                                  max_wait_us=200000) as batching:
+            futures = [batching.submit(gs) for gs in mixed]
+            for gs, future in zip(mixed, futures):
+                gs.advance_to(future.result())
+            self.assertEqual(2, batching.batches)
+
+    def test_solver_ai(self):
+        solver = SolverAI(seed=0)
+        self.assertEqual(0, solver.game_value(GameState()))
+        gs = GameState([
+            ["O", "X", "X"],
+            ["-", "X", "O"],
+            ["O", "-", "-"]
+        ])
+        self.assertEqual(1, solver.game_value(gs))
+        self.assertEqual([7], solver.optimal_moves(gs))
+        self.assertEqual(627, solver.precompute())
+        self.assertEqual(1.0, solver.accuracy(solver))
+
+        game = TicTacToe()
+        for i in range(10):
+            random_player = Player("random", RandomAI(seed=i))
+            solver_player = Player("solver", solver)
+            self.assertNotEqual(
+                "O won!", game.play_game(solver_player, random_player))
+            self.assertNotEqual(
+                "X won!", game.play_game(random_player, solver_player))
+
+
+class TestDB(unittest.TestCase):
+    def test_array_db(self):
+        states = [GameState()]
+        for cell in (4, 0, 8, 2):
+            states.append(states[-1].apply_move(*divmod(cell, 3)))
+        keys = [gs.canonical_key for gs in states]
+
+        db = DB()
+        array_db = ArrayDB(capacity=2)
+        for result in ("X won!", gamestate.DRAW, gamestate.O_WON):
+            for gs in states:
+                db.add_or_update(gs, result)
+        array_db.update_many(keys * 3, np.repeat(
+            [gamestate.X_WON, gamestate.DRAW, gamestate.O_WON], len(keys)))
+
+        self.assertEqual(len(db), len(array_db))
+        self.assertTrue(np.allclose(
+            db.get_weights(keys), array_db.get_weights(keys)))
+        for gs in states:
+            self.assertEqual(
+                db.get_weight(gs).playcount, array_db.get_weight(gs).playcount)
+        self.assertEqual(
+            set(db.get_weighted_states([1, 2])),
+            set(array_db.get_weighted_states([1, 2])))
+
+        unknown = GameState().apply_move(0, 1)
+        self.assertEqual(0.7, array_db.get_weight(unknown).weight)
+        self.assertEqual(
+            [0.7], array_db.get_weights([unknown.canonical_key]).tolist())
+
+    def test_large_board_dbs(self):
+        gs = GameState.empty(4, k=3).apply_move(0, 0).apply_move(1, 1)
+        for db in (DB(board_size=4, k=3), ArrayDB(board_size=4, k=3)):
+            db.update_many([gs.canonical_key], gamestate.X_WON)
+            self.assertEqual(0.85, round(db.get_weight(gs).weight, 6))
+            self.assertEqual(1, len(db))
+            self.assertEqual([gs], db.get_weighted_states([2]))
+        self.assertRaises(ValueError, lambda: ArrayDB(board_size=7))
+
+    def test_save_and_load_db(self):
+        ai = WeightedGameStateAI()
+        game = TicTacToe()
+        player = Player("player", ai)
+        opponent = Player("opponent", RandomAI())
+        for i in range(5):
+            game.play_game(player, opponent)
+        keys = [key for states in ai.db.rounds.values() for key in states]
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "weights.db")
+            save_db(ai.db, path)
+            metadata = read_db_metadata(path)
+            self.assertEqual(3, metadata["board_size"])
+            self.assertEqual(5, metadata["games_trained"])
+            self.assertEqual(1.0, metadata["weight_adjustments"]["X won!"])
+
+            loaded = load_db(path)
+            self.assertEqual(len(ai.db), len(loaded))
+            self.assertTrue(np.allclose(
+                ai.db.get_weights(keys), loaded.get_weights(keys)))
+            self.assertRaises(
+                ValueError, lambda: loaded.update_many(keys, "Draw."))
+
+            copied = load_db(path, mode="c")
+            copied.update_many(keys, "Draw.")
+            self.assertTrue(np.array_equal(
+                loaded.playcounts + 1, copied.playcounts))
+            del loaded, copied
+
+
+    def test_bounded_db(self):
+        moves, outcomes = selfplay.self_play(
+            ArrayDB(), 2000, rng=np.random.default_rng(0))
+        array_db = ArrayDB()
+        update_from_games(array_db, moves, outcomes)
+        keys = array_db.keys[:len(array_db)]
+        for weight_dtype, tolerance in (("uint8", 0.02), ("float16", 0.005)):
+            db = BoundedDB(weight_dtype=weight_dtype, seed=0)
+            update_from_games(db, moves, outcomes)
+            self.assertEqual(len(array_db), len(db))
+            self.assertEqual(0, db.evictions)
+            self.assertTrue(np.allclose(
+                array_db.get_weights(keys), db.get_weights(keys),
+                atol=tolerance))
+
+        for policy in ("lfu", "lru"):
+            db = BoundedDB(max_bytes=20000, policy=policy, seed=0)
+            update_from_games(db, moves, outcomes)
+            report = db.memory_report()
+            self.assertLessEqual(len(db), db.capacity)
+            self.assertLessEqual(report["nbytes"], 20000)
+            self.assertEqual(report["insertions"] - report["evictions"],
+                             len(db))
+            self.assertEqual(report["evictions"],
+                             sum(report["evictions_by_round"].values()))
+            self.assertEqual(sum(db.round_sizes().values()), len(db))
+            # The empty board is used by every game and never evicted.
+            self.assertEqual(2000, db.get_weight(GameState()).playcount)
+
+        # Keys of large boards do not fit into 64 bits.
+        db = BoundedDB(board_size=7, k=5, max_bytes=20000, seed=0)
+        ai = WeightedGameStateAI(db=db, seed=0)
+        player = Player("bounded", ai)
+        game = TicTacToe(board_size=7, k=5)
+        for i in range(5):
+            outcome, history, moves = game._play_game(player, player)
+            ai.update_db(history)
+        self.assertEqual(5, db.get_weight(GameState.empty(7, 5)).playcount)
+        self.assertGreater(db.evictions, 0)
+        self.assertLessEqual(db.nbytes(), 20000)
+
+        with self.assertRaises(ValueError):
+            BoundedDB(max_bytes=100)
+
+    def test_sqlite_db(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "weights.sqlite")
+            db = SQLiteDB(path, commit_every=4)
+            ai = WeightedGameStateAI(db=db)
+            reference = WeightedGameStateAI()
+            game = TicTacToe()
+            opponent = Player("random", RandomAI())
+            for i in range(6):
+                outcome, history, moves = game._play_game(
+                    Player("ai", ai), opponent)
+                ai.update_db(history)
+                reference.update_db(history)
+
+            keys = [key for states in reference.db.rounds.values()
+                    for key in states]
+            reader = SQLiteDB(path, read_only=True)
+            self.assertEqual(4, reader.games_trained)
+            self.assertRaises(
+                sqlite3.OperationalError,
+                lambda: reader.add_or_update(GameState(), "Draw."))
+            db.commit()
+            self.assertEqual(len(reference.db), len(reader))
+            self.assertTrue(np.allclose(
+                reference.db.get_weights(keys), reader.get_weights(keys)))
+            self.assertEqual(
+                set(reference.db.get_weighted_states([3, 4])),
+                set(reader.get_weighted_states([3, 4])))
+            gs = reference.db.get_weighted_states([1])[0]
+            self.assertAlmostEqual(
+                reference.db.get_weight(gs).weight, db.get_weight(gs).weight)
+
+            copied = copy.deepcopy(db)
+            self.assertTrue(np.allclose(
+                db.get_weights(keys), copied.get_weights(keys)))
+            for opened in (db, copied, reader):
+                opened.close()
+            with SQLiteDB(path) as reopened:
+                self.assertEqual(6, reopened.games_trained)
+                self.assertEqual(len(reference.db), len(reopened))
+            self.assertRaises(ValueError, lambda: SQLiteDB(path, board_size=4))
+
+    def test_remote_db(self):
+        store = remote_db.MemoryStore()
+        remote = remote_db.RemoteDB(store, batch_size=50)
+        local = DB()
+        players = [Player("remote", WeightedGameStateAI(db=remote)),
+                   Player("local", WeightedGameStateAI(db=local))]
+        game = TicTacToe()
+        for i in range(10):
+            game.play_game(*players)
+            game.play_game(*reversed(players))
+        self.assertEqual({}, store.documents)
+
+        keys = [key for states in local.rounds.values() for key in states]
+        self.assertTrue(np.allclose(
+            local.get_weights(keys), remote.get_weights(keys)))
+        self.assertEqual(len(local), len(remote))
+        self.assertEqual(
+            set(local.get_weighted_states([2])),
+            set(remote.get_weighted_states([2])))
+
+        other = remote_db.RemoteDB(store, batch_size=50)
+        requests = store.requests
+        self.assertTrue(np.allclose(
+            local.get_weights(keys), other.get_weights(keys)))
+        self.assertEqual(requests + -(-len(keys) // 50), store.requests)
+        other.get_weights(keys)
+        self.assertEqual(requests + -(-len(keys) // 50), store.requests)
+
+        gs = GameState()
+        other.add_or_update(gs, "X won!")
+        local.add_or_update(gs, "X won!")
+        other.close()
+        self.assertNotEqual(
+            local.get_weight(gs).weight, remote.get_weight(gs).weight)
+        remote.refresh()
+        self.assertAlmostEqual(
+            local.get_weight(gs).weight, remote.get_weight(gs).weight)
+
+    def test_connection_pool(self):
+        created = []
+        pool = remote_db.ConnectionPool(
+            lambda: created.append(len(created)) or created[-1], size=2)
+        with pool.connection() as first:
+            with pool.connection() as second:
+                self.assertEqual((0, 1), (first, second))
+        with pool.connection() as third:
+            self.assertIn(third, (0, 1))
+        self.assertEqual(2, len(created))
+        pool.close()
+
+
+class TestTicTacToe(unittest.TestCase):
+    def test_parallel_tournament(self):
+        def create_players():
+            return [
+                Player("weighted", WeightedGameStateAI(update_database=False)),
+                Player("random", RandomAI())
+            ]
+
+        game = TicTacToe()
+        with contextlib.redirect_stdout(io.StringIO()):
+            sequential = game.play_tournament(6, create_players(), seed=1)
+            parallel = game.play_tournament(
+                6, create_players(), workers=2, chunk_size=4, seed=1)
+            learner = Player("learner", WeightedGameStateAI())
+            game.play_tournament(
+                3, [learner, Player("random", RandomAI())], workers=2, seed=1)
+
+        self.assertEqual(sequential, parallel)
+        self.assertEqual(6, learner.ai.db.games_trained)
+
+
+class TestServer(unittest.TestCase):
+    def test_concurrent_sessions(self):
+        async def play(port, side):
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+
+            async def receive():
+                return json.loads(await reader.readline())
+
+            async def send(message):
+                writer.write(json.dumps(message).encode() + b"\n")
+                await writer.drain()
+
+            await send({"type": "move", "row": 0, "col": 0})
+            errors = [(await receive())["message"]]
+            await send({"type": "new_game", "side": side})
+            while True:
+                message = await receive()
+                if message["type"] == "error":
+                    errors.append(message["message"])
+                    continue
+                if message["outcome"] is not None:
+                    break
+                if message["next"] == side:
+                    cells = "".join(message["board"])
+                    if len(errors) == 1 and cells.count("-") < 9:
+                        taken = cells.index(cells.replace("-", "")[0])
+                        await send({"type": "move", "row": taken // 3,
+                                    "col": taken % 3})
+                    cell = cells.index("-")
+                    await send({"type": "move", "row": cell // 3,
+                                "col": cell % 3})
+            await send({"type": "quit"})
+            writer.close()
+            return message["outcome"], errors
+
+        async def run():
+            game_server = server.GameServer(
+                WeightedGameStateAI(update_database=False, seed=0))
+            await game_server.start()
+            results = await asyncio.gather(*(
+                play(game_server.port, side) for side in "XO" * 10))
+            await game_server.close()
+            return game_server.games_played, results
+
+        games_played, results = asyncio.run(run())
+        self.assertEqual(20, games_played)
+        for outcome, errors in results:
+            self.assertIn(outcome, ("X won!", "O won!", "Draw."))
+            self.assertEqual("No game in progress.", errors[0])
+            self.assertEqual(2, len(errors))
+            self.assertIn("already taken", errors[1])
+
+
+class TestInstrumentation(unittest.TestCase):
+    def test_instrumented_tournament(self):
+        original_advance_to = GameState.advance_to
+        players = [Player("weighted", WeightedGameStateAI()),
+                   Player("random", RandomAI())]
+        game = TicTacToe()
+        instrumentation.enable(log_interval=0)
+        try:
+            with self.assertLogs("instrumentation") as logs, \
+                    contextlib.redirect_stdout(io.StringIO()):
+                game.play_tournament(3, players)
+            snapshot = instrumentation.snapshot(
+                {"weighted": players[0].ai.db})
+        finally:
+            instrumentation.disable()
+        self.assertIs(original_advance_to, GameState.advance_to)
+        self.assertEqual(6, len(logs.records))
+        logged = json.loads(logs.records[-1].getMessage())
+        self.assertEqual(
+            sum(snapshot["db_sizes"]["weighted"].values()),
+            sum(logged["db_sizes"]["weighted"].values()))
+
+        calls = snapshot["calls"]
+        self.assertEqual(6, calls["DB.update_many"]["count"])
+        self.assertGreater(calls["DB.get_weights"]["count"], 0)
+        self.assertGreater(calls["SuccessorCache.get"]["count"], 0)
+        for name in ("apply_move", "advance_to", "outcome"):
+            self.assertGreater(calls["GameState." + name]["count"], 0)
+        for name in ("__init__", "__hash__", "is_game_over"):
+            self.assertIn("GameState." + name, calls)
+        self.assertEqual(1, snapshot["db_sizes"]["weighted"][0])
+        self.assertEqual(len(players[0].ai.db),
+                         sum(snapshot["db_sizes"]["weighted"].values()))
+        self.assertIn("hit_rate", snapshot["caches"]["successor_cache"])
+
+        instrumentation.reset()
+        self.assertEqual(
+            0, instrumentation.snapshot()["calls"]["DB.update_many"]["count"])
+        with contextlib.redirect_stdout(io.StringIO()):
+            results, report = instrumentation.profile(
+                game.play_tournament, 1, players)
+        self.assertEqual(2, results["random"]["wins"] +
+                         results["random"]["draws"] +
+                         results["random"]["losses"])
+        self.assertIn("play_tournament", report)
+
+
+class TestProgress(unittest.TestCase):
+    def test_reporters(self):
+        players = [Player("weighted", WeightedGameStateAI()),
+                   Player("random", RandomAI()),
+                   Player("random2", RandomAI()),
+                   Player("random3", RandomAI())]
+        game = TicTacToe()
+        stream = io.StringIO()
+        game.play_tournament(
+            5, players, progress=progress.DotReporter(dots=7, stream=stream))
+        lines = stream.getvalue().splitlines()
+        self.assertIn("60", lines[0])
+        self.assertEqual("." * 7, lines[1])
+        self.assertIn("Tournament finished, 60 games", lines[2])
+
+        for workers in (1, 2):
+            reporter = progress.LogReporter(interval=0)
+            with self.assertLogs("progress") as logs:
+                game.play_tournament(
+                    2, players[:3], workers=workers, seed=0,
+                    progress=reporter)
+            records = [record.progress for record in logs.records]
+            self.assertEqual(["start"] + ["progress"] * 12 + ["finish"],
+                             [record["event"] for record in records])
+            self.assertEqual(list(range(13)), [
+                record["played"] for record in records[:13]])
+            self.assertEqual(
+                {"played": 1, "total": 2},
+                records[1]["pairings"]["weighted vs random"])
+            final = records[-1]
+            self.assertEqual((12, 12, 1.0), (
+                final["played"], final["total"], final["fraction"]))
+            self.assertEqual(0, final["eta_seconds"])
+            self.assertEqual(len(players[0].ai.db),
+                             final["db_sizes"]["weighted"])
+            self.assertNotIn("random", final["db_sizes"])
+            self.assertTrue(all(pairing["played"] == 2
+                                for pairing in final["pairings"].values()))
+
+
+class TestStateGraph(unittest.TestCase):
+    def test_graph(self):
+        graph = state_graph.StateGraph.build(gamestate.get_board(3))
+        self.assertEqual(765, len(graph))
+        self.assertEqual(627, np.count_nonzero(~graph.is_terminal(
+            np.arange(len(graph)))))
+        self.assertEqual(range(1, 4), graph.round_ids(1))
+        self.assertTrue(np.array_equal(
+            graph.rounds_played,
+            gamestate.rounds_played_of(graph.keys)))
+
+        for state_id in range(len(graph)):
+            gs = GameState.from_code(int(graph.keys[state_id]))
+            ids, cells = graph.successors(state_id)
+            if gs.outcome() != gamestate.ONGOING:
+                self.assertEqual(0, len(ids))
+                continue
+            self.assertEqual(
+                sorted(set(gs.successor_keys()[1].tolist())),
+                sorted(graph.keys[ids].tolist()))
+            for successor_id, cell in zip(ids, cells):
+                self.assertEqual(
+                    graph.keys[successor_id],
+                    gs.apply_move(*divmod(int(cell), 3)).canonical_key)
+
+        with tempfile.TemporaryDirectory() as directory:
+            cache_directory = state_graph._cache_directory
+            state_graph._cache_directory = directory
+            state_graph._graphs.clear()
+            try:
+                built = state_graph.get_graph()
+                state_graph._graphs.clear()
+                loaded = state_graph.get_graph()
+            finally:
+                state_graph._cache_directory = cache_directory
+                state_graph._graphs.clear()
+            self.assertIsNot(built, loaded)
+            for name in ("keys", "indptr", "successor_ids",
+                         "successor_cells", "id_table"):
+                self.assertTrue(np.array_equal(
+                    getattr(graph, name), getattr(loaded, name)))
+
+    def test_dense_db(self):
+        graph = state_graph.StateGraph.build(gamestate.get_board(3))
+        dense = WeightedGameStateAI(db=DenseDB(graph=graph))
+        array = WeightedGameStateAI(db=ArrayDB())
+        moves, outcomes = selfplay.self_play(
+            array.db, 50, rng=np.random.default_rng(0))
+        dense.update_db_many(moves, outcomes)
+        array.update_db_many(moves, outcomes)
+
+        keys = array.db.keys[:len(array.db)]
+        self.assertEqual(len(array.db), len(dense.db))
+        self.assertTrue(np.allclose(
+            array.db.get_weights(keys), dense.db.get_weights(keys)))
+        self.assertEqual(array.db.round_sizes(), dense.db.round_sizes())
+        self.assertEqual(set(array.db.get_weighted_states([4])),
+                         set(dense.db.get_weighted_states([4])))
+        gs = GameState()
+        self.assertAlmostEqual(array.db.get_weight(gs).weight,
+                               dense.db.get_weight(gs).weight, places=6)
+        self.assertEqual(0.7, dense.db.get_weights([2])[0])
+        self.assertRaises(
+            ValueError, lambda: dense.db.update_many([2], "Draw."))
+
+
+class TestCLI(unittest.TestCase):
+    def run_cli(self, *argv):
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout), \
+                contextlib.redirect_stderr(io.StringIO()):
+            self.assertEqual(0, cli.main(list(argv)))
+        return json.loads(stdout.getvalue().splitlines()[-1])
+
+    def test_commands(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "weights.db")
+            summary = self.run_cli(
+                "train", "--games", "300", "--db", path, "--seed", "0")
+            self.assertEqual("train", summary["command"])
+            self.assertEqual(300, sum(summary["results"].values()))
+            self.assertEqual(300, load_db(path).games_trained)
+
+            with self.assertRaises(SystemExit):
+                self.run_cli("train", "--games", "10", "--board-size", "4",
+                             "--db", path)
+            with self.assertRaises(SystemExit):
+                self.run_cli("evaluate", "--db", path, "-k", "2")
+
+            path_4x4 = os.path.join(directory, "weights_4x4.db")
+            summary = self.run_cli(
+                "train", "--games", "20", "--board-size", "4", "--db",
+                path_4x4, "--seed", "0")
+            self.assertEqual(20, summary["games_trained"])
+            db = load_db(path_4x4)
+            self.assertEqual(
+                20, db.get_weight(GameState.empty(4)).playcount)
+            del db
+
+            summary = self.run_cli(
+                "evaluate", "--db", path, "--games", "5", "--seed", "1")
+            self.assertEqual(10, sum(summary["results"].values()))
+
+            sqlite_path = os.path.join(directory, "weights.sqlite")
+            summary = self.run_cli(
+                "tournament", "--players", "trained=weighted:" + sqlite_path,
+                "random", "--rounds", "3", "--seed", "0", "--save")
+            self.assertEqual({"trained": sqlite_path, "random2": None},
+                             summary["players"])
+            self.assertEqual(6, sum(summary["results"]["random2"].values()))
+            with SQLiteDB(sqlite_path) as db:
+                self.assertEqual(6, db.games_trained)
+
+        # Starting the CLI does not import NumPy or the engine.
+        output = subprocess.run(
+            [sys.executable, "-c",
+             "import sys, cli; print('numpy' in sys.modules)"],
+            cwd=os.path.dirname(os.path.abspath(cli.__file__)),
+            capture_output=True, text=True, check=True).stdout
+        self.assertEqual("False", output.strip())
+
+
+class TestSelfPlay(unittest.TestCase):
+    def test_self_play(self):
+        trained = WeightedGameStateAI(db=ArrayDB())
+        selfplay.train(trained, 50, batch_size=20,
+                       rng=np.random.default_rng(0))
+        moves, outcomes = selfplay.self_play(
+            trained.db, 20, rng=np.random.default_rng(1))
+
+        batched = WeightedGameStateAI(db=ArrayDB())
+        batched.update_db_many(moves, outcomes)
+        sequential = WeightedGameStateAI()
+        for game_moves, outcome in zip(moves.tolist(), outcomes.tolist()):
+            gamestates = gamestate.replay([m for m in game_moves if m >= 0])
+            self.assertEqual(outcome, gamestates[-1].outcome())
+            sequential.update_db(gamestates)
+
+        with self.assertRaises(ValueError):
+            selfplay.train(WeightedGameStateAI(db=DB(board_size=4, k=3)), 10)
+
+        keys = batched.db.keys[:len(batched.db)]
+        self.assertEqual(len(sequential.db), len(batched.db))
+        self.assertEqual(20, batched.db.games_trained)
+        self.assertTrue(np.allclose(
+            sequential.db.get_weights(keys), batched.db.get_weights(keys)))
+
+
+class TestLearning(unittest.TestCase):
+    def test_td_lambda(self):
+        moves, outcomes = selfplay.self_play(
+            ArrayDB(), 1, rng=np.random.default_rng(0))
+        gamestates = gamestate.replay([m for m in moves[0] if m >= 0])
+        keys = [gs.canonical_key for gs in gamestates]
+        target = {gamestate.X_WON: 1.0, gamestate.O_WON: 0.0,
+                  gamestate.DRAW: 0.7}[outcomes[0]]
+
+        # Lambda 1 with rate 1 sets every weight to the outcome value.
+        ai = WeightedGameStateAI(db=DB(), learning=learning.TDLambda(1, 1))
+        ai.update_db(gamestates)
+        self.assertTrue(np.allclose(target, ai.db.get_weights(keys)))
+        self.assertEqual(1, ai.db.games_trained)
+
+        # Batched and single game updates agree, lambda 0 only moves the
+        # weights next to the end of the game.
+        rule = learning.TDLambda(0.5, 0)
+        single = WeightedGameStateAI(db=DB(), learning=rule)
+        single.update_db(gamestates)
+        batched = WeightedGameStateAI(db=ArrayDB(), learning=rule)
+        batched.update_db_many(moves, outcomes)
+        self.assertTrue(np.allclose(
+            single.db.get_weights(keys), batched.db.get_weights(keys)))
+        default = single.db.default_weight
+        self.assertAlmostEqual(
+            (default + target) / 2, single.db.get_weights([keys[-1]])[0])
+        self.assertAlmostEqual(
+            (default + target) / 2, single.db.get_weights([keys[-2]])[0])
+        self.assertAlmostEqual(default, single.db.get_weights([keys[0]])[0])
+
+        with self.assertRaises(ValueError):
+            learning.TDLambda(0, 0.5)
+
+    def test_td_lambda_databases(self):
+        moves, outcomes = selfplay.self_play(
+            ArrayDB(), 20, rng=np.random.default_rng(1))
+        rule = learning.TDLambda()
+        local = WeightedGameStateAI(db=DB(default_weight=0.6), learning=rule)
+        remote = WeightedGameStateAI(
+            db=remote_db.RemoteDB(remote_db.MemoryStore(), default_weight=0.6),
+            learning=rule)
+        for game_moves in moves.tolist():
+            gamestates = gamestate.replay([m for m in game_moves if m >= 0])
+            local.update_db(gamestates)
+            remote.update_db(gamestates)
+
+        keys = [key for states in local.db.rounds.values() for key in states]
+        self.assertTrue(np.allclose(
+            local.db.get_weights(keys), remote.db.get_weights(keys)))
+        gs = GameState()
+        self.assertEqual(20, local.db.get_weight(gs).playcount)
+        self.assertEqual(20, remote.db.get_weight(gs).playcount)
+        unknown = max(keys) + 1
+        self.assertNotIn(unknown, keys)
+        self.assertEqual(0.6, local.db.get_weights([unknown])[0])
+
+
+class TestSharedDB(unittest.TestCase):
+    def setUp(self):
+        # Graphs loaded by copies of the databases are cached in a
+        # temporary directory instead of the user's cache.
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        for name, value in (("_cache_directory", directory.name),
+                            ("_graphs", {})):
+            patcher = mock.patch.object(state_graph, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_shared_db(self):
+        with shared_db.SharedDB() as db:
+            copy_db = pickle.loads(pickle.dumps(db))
+            copy_db.update_many([0], [gamestate.X_WON])
+            self.assertAlmostEqual(0.85, db.get_weights([0])[0])
+            self.assertEqual(1, db.get_weight(GameState()).playcount)
+            copy_db.close()
+
+        with shared_db.SharedDB(stripes=4) as db:
+            with self.assertRaises(RuntimeError):
+                pickle.dumps(db)
+            ai = WeightedGameStateAI(db=db)
+            results = selfplay.train_parallel(
+                ai, 400, workers=2, batch_size=50, seed=0)
+            self.assertEqual(400, sum(results.values()))
+            self.assertEqual(400, db.games_trained)
+            # Locked updates are never lost.
+            self.assertEqual(400, db.playcounts[0])
+
+            p1 = Player("shared", ai)
+            p2 = Player("random", RandomAI())
+            with contextlib.redirect_stdout(io.StringIO()):
+                TicTacToe().play_tournament(5, [p1, p2], workers=2, seed=0)
+            self.assertEqual(410, db.playcounts[0])
+
+        with self.assertRaises(ValueError):
+            selfplay.train_parallel(WeightedGameStateAI(db=ArrayDB()), 10)
+
+
+class TestGameRecords(unittest.TestCase):
+    def test_write_and_replay(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "games.rec")
+            ai = WeightedGameStateAI()
+            with game_records.GameRecordWriter(path) as writer:
+                game = TicTacToe(record_writer=writer)
+                for i in range(10):
+                    game.play_game(Player("x", ai), Player("o", RandomAI()))
+            with game_records.GameRecordWriter(path) as writer:
+                writer.write_many(
+                    [[0, 4, 8, 1, 7, 6, 2, 5, 3],
+                     [0, 3, 1, 4, 2, -1, -1, -1, -1]],
+                    [gamestate.DRAW, gamestate.X_WON])
+            self.assertRaises(
+                ValueError,
+                lambda: game_records.GameRecordWriter(path, board_size=4))
+
+            chunks = list(game_records.read_records(path, chunk_size=3))
+            self.assertEqual([3, 3, 3, 3], [len(o) for m, o in chunks])
+            moves, outcomes = chunks[-1]
+            self.assertEqual(
+                [0, 3, 1, 4, 2], moves[-1][moves[-1] >= 0].tolist())
+            self.assertEqual([gamestate.DRAW, gamestate.X_WON],
+                             outcomes[1:].tolist())
+
+            db = ArrayDB()
+            game_records.replay_records(path, db, chunk_size=3)
+            self.assertEqual(12, db.games_trained)
+            ai.db.update_many(
+                [state.canonical_key for state in gamestate.replay(
+                    [0, 3, 1, 4, 2])], gamestate.X_WON)
+            ai.db.update_many(
+                [state.canonical_key for state in gamestate.replay(
+                    [0, 4, 8, 1, 7, 6, 2, 5, 3])], gamestate.DRAW)
+            keys = [key for states in ai.db.rounds.values() for key in states]
+            self.assertEqual(len(ai.db), len(db))
+            self.assertTrue(np.allclose(
+                ai.db.get_weights(keys), db.get_weights(keys)))
+
+            large_path = os.path.join(directory, "large.rec")
+            with game_records.GameRecordWriter(large_path, 4, k=3) as writer:
+                writer.write([0, 5, 1, 6, 2], gamestate.X_WON)
+            large_db = DB(board_size=4, k=3)
+            self.assertEqual(
+                1, game_records.replay_records([large_path], large_db))
+            self.assertEqual(6, len(large_db))
+
+
+class TestBenchmarks(unittest.TestCase):
+    def test_run_and_compare(self):
+        results = benchmarks.run_benchmarks(
+            ["gamestate_apply_move", "is_game_over"], repeat=1, min_time=0)
+        self.assertEqual(
+            {"gamestate_apply_move", "is_game_over"},
+            set(results["benchmarks"]))
+        json.dumps(results)
+
+        slower = copy.deepcopy(results)
+        slower["benchmarks"]["is_game_over"]["operations_per_second"] /= 2
+        rows = dict((row[0], row) for row in
+                    benchmarks.compare(results, slower))
+        self.assertFalse(rows["gamestate_apply_move"][4])
+        self.assertTrue(rows["is_game_over"][4])
+
 
 def are_arrays_equal(array1: List[List], array2: List[List], 
                      check_order: bool = True) -> bool:
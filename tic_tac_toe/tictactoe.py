@@ -1,22 +1,52 @@
 # -*- coding: utf-8 -*-
 
-from gamestate import GameState
+import numpy as np
+from gamestate import GameState, ONGOING, outcome_message, replay
 from player import Player
 from AI import WeightedGameStateAI, RandomAI
 from itertools import permutations
+from concurrent.futures import ProcessPoolExecutor
+import asyncio
+import copy
 import time
+import instrumentation
+from progress import TournamentProgress, ProgressReporter, DotReporter
 from typing import Iterable
-from math import factorial
 
 
 class TicTacToe:
-    def __init__(self, time_between_moves=0, print_moves=False):
+    def __init__(self, time_between_moves=0, print_moves=False,
+                 board_size=3, k=None, record_writer=None):
+        """Games are played on board_size X board_size boards where k
+        marks in a row win. K defaults to the board size.
+
+        If record_writer is given, every finished game is appended to it.
+        It is any object with the write method of
+        game_records.GameRecordWriter."""
         self.time_between_moves = time_between_moves
         self.print_moves = print_moves
+        self.board_size = board_size
+        self.k = k
+        self.record_writer = record_writer
 
     def play_game(self, x_player: Player, o_player: Player):
-        current_gamestate = GameState()
+        outcome, gamestate_history, moves = self._play_game(
+            x_player, o_player)
+        self._record(moves, outcome)
+
+        if x_player.ai:
+            x_player.ai.update_db(gamestate_history)
+        if o_player.ai:
+            o_player.ai.update_db(gamestate_history)
+
+        return outcome_message(outcome)
+
+    def _play_game(self, x_player, o_player):
+        # Plays a game without updating the players. Returns the outcome
+        # code, the gamestate history and the moved cell indexes.
+        current_gamestate = GameState.empty(self.board_size, self.k)
         gamestate_history = []
+        moves = []
         players = {
             "X": x_player,
             "O": o_player
@@ -26,27 +56,91 @@ class TicTacToe:
             gamestate_history.append(current_gamestate)
             if self.print_moves:
                 print(current_gamestate)
-            is_game_over, msg = current_gamestate.is_game_over()
-            if is_game_over:
+            # Every gamestate after the first one comes from advance_to,
+            # so its outcome is already known.
+            outcome = current_gamestate.outcome()
+            if outcome != ONGOING:
                 break
             next_player = players[current_gamestate.next_to_move()]
-            current_gamestate = next_player.get_next_gamestate(
-                current_gamestate
-            )
+            next_gamestate = current_gamestate.advance_to(
+                next_player.get_next_gamestate(current_gamestate))
+            moves.append(current_gamestate.get_move(next_gamestate))
+            current_gamestate = next_gamestate
             time.sleep(self.time_between_moves)
 
-        if x_player.ai:
-            x_player.ai.update_db(gamestate_history)
-        if o_player.ai:
-            o_player.ai.update_db(gamestate_history)
+        return outcome, gamestate_history, moves
 
-        return msg
+    async def play_game_async(self, x_player: Player, o_player: Player,
+                              executor=None, on_move=None, update=True):
+        """Coroutine version of play_game that waits for moves without
+        blocking the event loop. Moves are asked with the players'
+        get_next_gamestate_async, which computes AI moves in executor.
+
+        On_move is an optional coroutine function that is awaited with
+        every gamestate of the game, including the empty board. If update
+        is False, the AIs are not updated after the game."""
+        current_gamestate = GameState.empty(self.board_size, self.k)
+        gamestate_history = []
+        moves = []
+        players = {
+            "X": x_player,
+            "O": o_player
+        }
+
+        while True:
+            gamestate_history.append(current_gamestate)
+            if on_move is not None:
+                await on_move(current_gamestate)
+            outcome = current_gamestate.outcome()
+            if outcome != ONGOING:
+                break
+            next_player = players[current_gamestate.next_to_move()]
+            next_gamestate = current_gamestate.advance_to(
+                await next_player.get_next_gamestate_async(
+                    current_gamestate, executor))
+            moves.append(current_gamestate.get_move(next_gamestate))
+            current_gamestate = next_gamestate
+            if self.time_between_moves:
+                await asyncio.sleep(self.time_between_moves)
 
-    def play_tournament(self, rounds: int, players: Iterable[Player]):
+        self._record(moves, outcome)
+        if update:
+            if x_player.ai:
+                x_player.ai.update_db(gamestate_history)
+            if o_player.ai:
+                o_player.ai.update_db(gamestate_history)
+
+        return outcome_message(outcome)
+
+    def _record(self, moves, outcome):
+        if self.record_writer is not None:
+            self.record_writer.write(moves, outcome)
+
+    def play_tournament(self, rounds: int, players: Iterable[Player],
+                        workers: int = 1, chunk_size: int = None,
+                        seed: int = None,
+                        progress: ProgressReporter = None):
         """Plays a round robin tournament between all players.
 
         All players will play both as 'X' and as 'O' against all the 
-        other players for given number of rounds."""
+        other players for given number of rounds.
+
+        If seed is given, the AIs are seeded with values derived from the
+        seed, the pairing and the round before each match.
+
+        With more than one worker the matches are played in a process pool
+        in chunks of chunk_size matches. Workers play against copies of
+        the players taken when the tournament starts, so AIs only learn
+        from the tournament after all matches have been played. The games
+        are then passed to the AIs in the order they would have been
+        played sequentially. AIs with a shared_db.SharedDB instead learn
+        in the workers as the games are played, in no fixed order.
+        Parallel tournaments are always seeded, a random seed is drawn if
+        none is given.
+
+        Progress is reported to a progress.ProgressReporter, which prints
+        dots to stdout by default. When instrumentation is enabled,
+        snapshots of it are logged while the tournament is played."""
         results = dict([
             (p.name, {
                 "wins": 0,
@@ -61,44 +155,131 @@ class TicTacToe:
                 "losses": 0
             }
 
-        print_interval = _get_print_interval(rounds, len(players), 50)
-        print("Running a tournament. Total number of matches to be played {0}.".format(
-            _get_match_count(rounds, len(players))
-        ))
+        if progress is None:
+            progress = DotReporter()
+        tracker = TournamentProgress(rounds, players)
+        progress.start(tracker)
 
-        for p1, p2 in permutations(players, 2):
-            i = 0
+        if workers > 1:
+            self._play_parallel_tournament(
+                rounds, players, results, tracker, progress, workers,
+                chunk_size, seed)
+            progress.finish(tracker)
+            return results
+
+        dbs = _player_dbs(players)
+        for pairing, (p1, p2) in enumerate(permutations(players, 2)):
             for j in range(rounds):
-                if (i * rounds + j) % print_interval == 0:
-                    print(".", end="") 
+                if seed is not None:
+                    _seed_match(seed, pairing, j, p1, p2)
                 res = self.play_game(p1, p2)
-                if res == "X won!":
-                    results[p1.name]["wins"] += 1
-                    results[p2.name]["losses"] += 1
-                elif res == "O won!":
-                    results[p1.name]["losses"] += 1
-                    results[p2.name]["wins"] += 1
-                else:
-                    results[p1.name]["draws"] += 1
-                    results[p2.name]["draws"] += 1
-            i += 1
-
-        print("\nTournament finished")
+                _add_result(results, p1, p2, res)
+                tracker.game_played(pairing)
+                progress.update(tracker)
+                instrumentation.maybe_log(dbs)
+
+        progress.finish(tracker)
         return results
 
+    def _play_parallel_tournament(self, rounds, players, results, tracker,
+                                  progress, workers, chunk_size, seed):
+        players = list(players)
+        if seed is None:
+            seed = int(np.random.SeedSequence().generate_state(1)[0])
+        if chunk_size is None:
+            chunk_size = max(1, rounds // (4 * workers))
+
+        pairings = list(permutations(range(len(players)), 2))
+        tasks = [
+            (pairing, start, min(chunk_size, rounds - start))
+            for pairing in range(len(pairings))
+            for start in range(0, rounds, chunk_size)
+        ]
+
+        # Games are recorded here as they are merged, so the workers get
+        # a game without the writer.
+        worker_game = copy.copy(self)
+        worker_game.record_writer = None
+
+        dbs = _player_dbs(players)
+        with ProcessPoolExecutor(
+                max_workers=workers, initializer=_init_worker,
+                initargs=(worker_game, players, pairings, seed)) as executor:
+            for (pairing, start, count), games in zip(
+                    tasks, executor.map(_play_matches, tasks)):
+                p1, p2 = (players[i] for i in pairings[pairing])
+                for outcome, moves in games:
+                    self._record(moves, outcome)
+                    gamestate_history = replay(
+                        moves, self.board_size, self.k)
+                    # Workers have already updated shared databases.
+                    if p1.ai and not _has_shared_db(p1):
+                        p1.ai.update_db(gamestate_history)
+                    if p2.ai and not _has_shared_db(p2):
+                        p2.ai.update_db(gamestate_history)
+                    _add_result(results, p1, p2, outcome_message(outcome))
+                    tracker.game_played(pairing)
+                    progress.update(tracker)
+                    instrumentation.maybe_log(dbs)
+
+
+def _add_result(results, x_player, o_player, res):
+    if res == "X won!":
+        results[x_player.name]["wins"] += 1
+        results[o_player.name]["losses"] += 1
+    elif res == "O won!":
+        results[x_player.name]["losses"] += 1
+        results[o_player.name]["wins"] += 1
+    else:
+        results[x_player.name]["draws"] += 1
+        results[o_player.name]["draws"] += 1
+
+
+def _player_dbs(players):
+    return dict((p.name, p.ai.db) for p in players
+                if getattr(p.ai, "db", None) is not None)
+
+
+def _has_shared_db(player):
+    # Players with a shared_db.SharedDB learn in the worker processes.
+    return getattr(getattr(player.ai, "db", None), "shared", False)
+
+
+def _seed_match(seed, pairing, round_number, x_player, o_player):
+    # Seeds both AIs with values derived from the tournament seed, the
+    # pairing and the round.
+    seeds = np.random.SeedSequence([seed, pairing, round_number]).spawn(2)
+    for player, player_seed in zip((x_player, o_player), seeds):
+        if player.ai:
+            player.ai.seed(player_seed)
+
+
+# State of a tournament worker process, set by _init_worker.
+_worker = {}
+
 
-def _get_match_count(round_count, player_count):
-    if player_count < 2 or round_count < 1:
-        return 0
-    permutation_count = int(
-        factorial(player_count / factorial(player_count - 2)))
-    return round_count * permutation_count
+def _init_worker(game, players, pairings, seed):
+    _worker["game"] = game
+    _worker["players"] = players
+    _worker["pairings"] = pairings
+    _worker["seed"] = seed
 
 
-def _get_print_interval(round_count, player_count, print_count):
-    interval = int(_get_match_count(
-        round_count, player_count) / print_count)
-    return interval if interval != 0 else 1
+def _play_matches(task):
+    # Plays count matches of a pairing starting from round start. Returns
+    # a list of (outcome, moves) tuples.
+    pairing, start, count = task
+    game = _worker["game"]
+    p1, p2 = (_worker["players"][i] for i in _worker["pairings"][pairing])
+    games = []
+    for j in range(start, start + count):
+        _seed_match(_worker["seed"], pairing, j, p1, p2)
+        outcome, gamestate_history, moves = game._play_game(p1, p2)
+        for player in (p1, p2):
+            if player.ai and _has_shared_db(player):
+                player.ai.update_db(gamestate_history)
+        games.append((outcome, moves))
+    return games
 
 
 if __name__ == "__main__":